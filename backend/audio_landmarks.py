@@ -0,0 +1,398 @@
+# backend/audio_landmarks.py
+import os
+import re
+import sys
+import json
+import time
+import struct
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from shazam_helper import collapse_matches, _fmt
+
+# Локальное распознавание музыки из своего каталога (библиотечная музыка, которую
+# внешние сервисы не знают, и черный список). Классическая схема "созвездий":
+#   1. спектрограмма -> пики (в каждой частотной полосе - локальные максимумы по времени);
+#   2. пары пиков (якорь + до FAN_OUT следующих) -> 24-битный хеш (f1, f2, dt);
+#   3. индекс: отсортированные хеши + (track_id, время якоря) в одном файле, читается через mmap;
+#   4. поиск: хеши запроса -> совпадения -> голосование по (трек, смещение) в блоках
+#      по MATCH_BLOCK_S; совпавшие блоки подряд склеиваются во фрагменты с таймкодами.
+#
+# Формат landmarks.idx (little-endian):
+#   header: magic "LMRK" | format u16 | reserved u16 | count u64 | built_at u64
+#   hashes: count x u32 (по возрастанию), затем values: count x u64 (track_id << 32 | frame)
+INDEX_DIR = os.getenv("MUSIC_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "music_index"))
+INDEX_FILE = "landmarks.idx"
+CATALOG_FILE = "catalog.json"
+
+SAMPLE_RATE = 8000
+N_FFT = 1024
+HOP = 256                       # 32 мс на кадр
+FRAMES_PER_S = SAMPLE_RATE / HOP
+# Полосы для поиска пиков: 300-3600 Гц (там основная энергия музыки, и это переживает сжатие)
+BAND_EDGES_HZ = [300, 500, 800, 1200, 1800, 2600, 3600]
+PEAK_SPAN = 8                   # пик - максимум полосы на +-8 кадров (~0.25 с)
+FAN_OUT = 5
+MAX_DT = 63                     # 6 бит на разницу времени (~2 с)
+CHUNK_S = 60                    # декодируем и считаем спектр кусками
+
+# before - сначала свой каталог, внешний распознаватель только для остального;
+# only - внешний не вызываем вовсе; off - каталог не используется
+CATALOG_MODE = os.getenv("MUSIC_CATALOG_MODE", "before")
+MATCH_BLOCK_S = float(os.getenv("MUSIC_MATCH_BLOCK_S", "5"))
+MIN_VOTES = int(os.getenv("MUSIC_MATCH_MIN_VOTES", "12"))
+OFFSET_BIN = 2                  # допуск по смещению, кадров
+# Хеш, который встречается чаще, - тишина/шум, голосовать им бессмысленно
+MAX_POSTING = int(os.getenv("MUSIC_MAX_POSTING", "2000"))
+INGEST_WORKERS = int(os.getenv("MUSIC_INGEST_WORKERS", str(os.cpu_count() or 1)))
+
+MAGIC = b"LMRK"
+FORMAT = 1
+_HEADER = struct.Struct("<4sHHQQ")
+
+
+# --- ОТПЕЧАТОК ---
+
+def _decode(path: str):
+    """Поток кусков PCM (float32, моно, SAMPLE_RATE) по CHUNK_S секунд: фильм целиком в память не грузим."""
+    command = ["ffmpeg", "-v", "error", "-i", path, "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE),
+               "-f", "s16le", "pipe:1"]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    block = SAMPLE_RATE * CHUNK_S * 2
+    try:
+        while True:
+            chunk = proc.stdout.read(block)
+            if not chunk:
+                break
+            yield np.frombuffer(chunk[: len(chunk) // 2 * 2], dtype="<i2").astype(np.float32)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def band_maxima(chunks):
+    """
+    Для каждого кадра и полосы - самый громкий бин и его уровень (дБ).
+    Возвращает (bins[frames, bands], levels[frames, bands]).
+    """
+    edges = np.searchsorted(np.fft.rfftfreq(N_FFT, 1 / SAMPLE_RATE), BAND_EDGES_HZ)
+    window = np.hanning(N_FFT).astype(np.float32)
+    bins, levels = [], []
+    tail = np.zeros(0, dtype=np.float32)
+    for samples in chunks:
+        # Хвост прошлого куска: кадры идут без разрывов на границах
+        samples = np.concatenate([tail, samples])
+        if len(samples) < N_FFT:
+            tail = samples
+            continue
+        frames = sliding_window_view(samples, N_FFT)[::HOP]
+        tail = samples[len(frames) * HOP:]
+        spectrum = np.abs(np.fft.rfft(frames * window, axis=1)).astype(np.float32)
+        chunk_bins = np.empty((len(frames), len(edges) - 1), dtype=np.int16)
+        chunk_levels = np.empty((len(frames), len(edges) - 1), dtype=np.float32)
+        for b, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            band = spectrum[:, lo:hi]
+            arg = band.argmax(axis=1)
+            chunk_bins[:, b] = arg + lo
+            chunk_levels[:, b] = 20 * np.log10(band[np.arange(len(band)), arg] + 1e-6)
+        bins.append(chunk_bins)
+        levels.append(chunk_levels)
+    if not bins:
+        return np.zeros((0, len(BAND_EDGES_HZ) - 1), np.int16), np.zeros((0, len(BAND_EDGES_HZ) - 1), np.float32)
+    return np.concatenate(bins), np.concatenate(levels)
+
+
+def find_peaks(bins, levels):
+    """Пики "созвездия": максимум полосы в окне +-PEAK_SPAN кадров и громче среднего по полосе."""
+    if len(levels) < 2 * PEAK_SPAN + 1:
+        return np.zeros(0, np.int32), np.zeros(0, np.int16)
+    padded = np.pad(levels, ((PEAK_SPAN, PEAK_SPAN), (0, 0)), constant_values=-np.inf)
+    local_max = sliding_window_view(padded, 2 * PEAK_SPAN + 1, axis=0).max(axis=2)
+    # Тишина и ровный шум дают "пики" на уровне фона - отсекаем по среднему полосы
+    floor = np.median(levels, axis=0) + 6
+    mask = (levels == local_max) & (levels > floor)
+    frames, band_ids = np.nonzero(mask)
+    return frames.astype(np.int32), bins[frames, band_ids]
+
+
+def landmarks(peak_frames, peak_bins):
+    """Пары пиков -> (hashes u32, anchor_frames u32). Хеш: f1 (9 бит) | f2 (9 бит) | dt (6 бит)."""
+    order = np.lexsort((peak_bins, peak_frames))
+    frames, freqs = peak_frames[order].astype(np.int64), peak_bins[order].astype(np.int64)
+    hashes, anchors = [], []
+    for j in range(1, FAN_OUT + 1):
+        dt = frames[j:] - frames[:-j]
+        ok = (dt >= 1) & (dt <= MAX_DT)
+        f1, f2 = freqs[:-j][ok], freqs[j:][ok]
+        hashes.append(((f1 & 0x1FF) << 15) | ((f2 & 0x1FF) << 6) | dt[ok])
+        anchors.append(frames[:-j][ok])
+    if not hashes:
+        return np.zeros(0, np.uint32), np.zeros(0, np.uint32)
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchors).astype(np.uint32)
+
+
+def fingerprint(path: str):
+    """Файл -> (hashes, anchor_frames, duration_s)."""
+    bins, levels = band_maxima(_decode(path))
+    hashes, anchors = landmarks(*find_peaks(bins, levels))
+    return hashes, anchors, len(levels) / FRAMES_PER_S
+
+
+# --- ИНДЕКС ---
+
+def _track_meta(path: str, defaults: dict) -> dict:
+    """Название из имени файла "Исполнитель - Название.mp3"; манифест может все переопределить."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    artist, _, title = stem.partition(" - ")
+    meta = {"title": title.strip() or stem, "artist": artist.strip() if title else "", "status": "licensed"}
+    meta.update({k: v for k, v in defaults.items() if v is not None})
+    meta["path"] = path
+    return meta
+
+
+def _fingerprint_job(path: str):
+    try:
+        return path, fingerprint(path), None
+    except Exception as e:
+        return path, None, str(e)
+
+
+def _write_index(directory: str, hashes, values, tracks):
+    """Атомарная публикация: сначала каталог и индекс во временные файлы, потом os.replace."""
+    os.makedirs(directory, exist_ok=True)
+    built_at = time.time_ns()
+    order = np.argsort(hashes, kind="stable")
+    index_path = os.path.join(directory, INDEX_FILE)
+    catalog_path = os.path.join(directory, CATALOG_FILE)
+    tmp_index, tmp_catalog = f"{index_path}.tmp-{os.getpid()}", f"{catalog_path}.tmp-{os.getpid()}"
+    with open(tmp_index, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT, 0, len(hashes), built_at))
+        hashes[order].astype("<u4").tofile(f)
+        values[order].astype("<u8").tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(tmp_catalog, "w", encoding="utf-8") as f:
+        json.dump({"built_at": built_at, "tracks": tracks}, f, ensure_ascii=False)
+    os.replace(tmp_catalog, catalog_path)
+    os.replace(tmp_index, index_path)
+    return built_at
+
+
+def ingest(paths, directory: str = None, status: str = None, manifest: dict = None, workers: int = None) -> dict:
+    """
+    Добавляет треки в каталог (пакетно, отпечатки считаются в нескольких процессах)
+    и пересобирает индекс. manifest: {path: {"title", "artist", "status"}}.
+    Уже проиндексированные пути пропускаются.
+    """
+    directory = directory or INDEX_DIR
+    manifest = manifest or {}
+    hashes, values, tracks = [np.zeros(0, np.uint32)], [np.zeros(0, np.uint64)], []
+
+    existing = open_index(directory)
+    if existing is not None:
+        tracks = list(existing.tracks)
+        hashes.append(np.array(existing.hashes))
+        values.append(np.array(existing.values))
+        existing.close()
+    known = {t["path"] for t in tracks}
+    todo = [p for p in paths if p not in known]
+
+    started = time.time()
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers or INGEST_WORKERS) as pool:
+        for path, result, error in pool.map(_fingerprint_job, todo, chunksize=4):
+            if result is None:
+                print(f"⚠️ Landmark Ingest Error ({path}): {error}")
+                failed.append(path)
+                continue
+            track_hashes, anchors, duration_s = result
+            track_id = len(tracks)
+            tracks.append({"id": track_id, **_track_meta(path, {"status": status, **manifest.get(path, {})}),
+                           "duration_s": round(duration_s, 1), "hashes": int(len(track_hashes))})
+            hashes.append(track_hashes)
+            values.append((np.uint64(track_id) << np.uint64(32)) | anchors.astype(np.uint64))
+
+    all_hashes = np.concatenate(hashes)
+    _write_index(directory, all_hashes, np.concatenate(values), tracks)
+    report = {"added": len(todo) - len(failed), "failed": failed, "tracks": len(tracks),
+              "hashes": int(len(all_hashes)), "seconds": round(time.time() - started, 1)}
+    print(f"🎼 Каталог музыки: {report}")
+    return report
+
+
+class LandmarkIndex:
+    def __init__(self, directory: str = None):
+        self.directory = directory or INDEX_DIR
+        self.path = os.path.join(self.directory, INDEX_FILE)
+        self._stat = os.stat(self.path)
+        with open(self.path, "rb") as f:
+            magic, fmt, _, self.count, self.built_at = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError(f"Bad landmark index: {self.path}")
+        # Страницы индекса общие для всех процессов воркера (page cache), в память не копируются
+        self.hashes = np.memmap(self.path, dtype="<u4", mode="r", offset=_HEADER.size, shape=(self.count,))
+        self.values = np.memmap(self.path, dtype="<u8", mode="r", offset=_HEADER.size + 4 * self.count,
+                                shape=(self.count,))
+        with open(os.path.join(self.directory, CATALOG_FILE), "r", encoding="utf-8") as f:
+            catalog = json.load(f)
+        if catalog.get("built_at") != self.built_at:
+            raise ValueError("Landmark catalog does not match index (publishing in progress?)")
+        self.tracks = catalog["tracks"]
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def is_stale(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (st.st_ino, st.st_mtime_ns) != (self._stat.st_ino, self._stat.st_mtime_ns)
+
+    def close(self):
+        for arr in (self.hashes, self.values):
+            if arr._mmap is not None:
+                arr._mmap.close()
+
+    def _lookup(self, hashes, anchors):
+        """Все совпадения хешей: (кадр запроса, track_id, кадр трека)."""
+        left = np.searchsorted(self.hashes, hashes, side="left")
+        right = np.searchsorted(self.hashes, hashes, side="right")
+        lengths = right - left
+        keep = (lengths > 0) & (lengths <= MAX_POSTING)
+        left, lengths, anchors = left[keep], lengths[keep], anchors[keep]
+        total = int(lengths.sum())
+        if not total:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+        # Развертка диапазонов [left, left+len) без цикла по Python
+        starts = np.repeat(left - np.cumsum(lengths) + lengths, lengths)
+        positions = starts + np.arange(total)
+        values = np.asarray(self.values[positions])
+        query_frames = np.repeat(anchors.astype(np.int64), lengths)
+        return query_frames, (values >> np.uint64(32)).astype(np.int64), (values & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+    def match(self, path: str):
+        """
+        Какие треки каталога звучат в файле и когда. Возвращает (cues, stats);
+        cue: {"start_ms", "end_ms", "title", "artist", "status", "track_id", "track_offset_s", "votes", "windows"}.
+        """
+        started = time.time()
+        hashes, anchors, duration_s = fingerprint(path)
+        query_frames, track_ids, track_frames = self._lookup(hashes, anchors)
+
+        block_frames = MATCH_BLOCK_S * FRAMES_PER_S
+        n_blocks = int(np.ceil(duration_s / MATCH_BLOCK_S)) or 1
+        blocks = (query_frames / block_frames).astype(np.int64)
+        offsets = (track_frames - query_frames) // OFFSET_BIN
+        # Голос = (блок, трек, смещение): у верного трека смещение одно и то же
+        keys = (blocks << 44) | (track_ids << 24) | (offsets + (1 << 23))
+        unique, votes = np.unique(keys, return_counts=True)
+        best = {}
+        for key, count in zip(unique[votes >= MIN_VOTES].tolist(), votes[votes >= MIN_VOTES].tolist()):
+            block = key >> 44
+            if count > best.get(block, (0,))[0]:
+                best[block] = (count, (key >> 24) & 0xFFFFF, (key & 0xFFFFFF) - (1 << 23))
+
+        windows = []
+        for block in range(n_blocks):
+            start_s, end_s = block * MATCH_BLOCK_S, min((block + 1) * MATCH_BLOCK_S, duration_s)
+            match = None
+            if block in best:
+                count, track_id, offset = best[block]
+                track = self.tracks[track_id]
+                match = {"key": track_id, "title": track["title"], "artist": track["artist"],
+                         "status": track.get("status"), "votes": count,
+                         "track_offset_s": round(max(0.0, offset * OFFSET_BIN / FRAMES_PER_S + start_s), 1)}
+            windows.append((start_s, end_s, match))
+
+        cues = collapse_matches(windows)
+        for cue in cues:
+            # Блоки не перекрываются: фрагменту принадлежат блоки внутри его границ
+            parts = [m for s, _, m in windows if m and m["key"] == cue["key"] and cue["start_ms"] <= s * 1000 < cue["end_ms"]]
+            cue.update({"track_id": cue["key"], "status": parts[0]["status"],
+                        "track_offset_s": parts[0]["track_offset_s"], "votes": sum(m["votes"] for m in parts)})
+        stats = {"tracks": len(self.tracks), "query_hashes": int(len(hashes)), "matches": int(len(track_ids)),
+                 "cues": len(cues), "seconds": round(time.time() - started, 2)}
+        return cues, stats
+
+
+def open_index(directory: str = None):
+    """Индекс или None, если каталог еще не собран."""
+    directory = directory or INDEX_DIR
+    if not os.path.exists(os.path.join(directory, INDEX_FILE)):
+        return None
+    return LandmarkIndex(directory)
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс процесса; переоткрывается после новой сборки каталога. None - каталога нет."""
+    global _index
+    with _lock:
+        if _index is None or _index.is_stale():
+            try:
+                _index = open_index()
+            except Exception as e:
+                print(f"⚠️ Landmark Index Error: {e}")
+                return _index
+    return _index
+
+
+def catalog_version() -> int:
+    """Версия каталога для ключа кэша результатов (0 - каталог не используется)."""
+    index = get_index() if CATALOG_MODE != "off" else None
+    return index.built_at if index is not None else 0
+
+
+def cues_to_evidence(cues, prefix: str = "catalog"):
+    """Фрагменты каталога -> evidence типа audio_span."""
+    return [{
+        "id": f"{prefix}_{i + 1}",
+        "type": "audio_span",
+        "start_ms": c["start_ms"],
+        "end_ms": c["end_ms"],
+        "text_quote": f"{c['title']} - {c['artist']}" if c["artist"] else c["title"],
+        "notes": f"Каталог музыки ({c['status']}): с {c['track_offset_s']:.0f} с трека, голосов {c['votes']}",
+    } for i, c in enumerate(cues)]
+
+
+def cue_sheet_text(cues) -> str:
+    """Подсказка для промпта: треки из своего каталога (со статусом лицензии) по таймкодам."""
+    if not cues:
+        return ""
+    lines = [f"{_fmt(c['start_ms'])}-{_fmt(c['end_ms'])} {c['title']}"
+             + (f" - {c['artist']}" if c["artist"] else "") + f" [{c['status']}]" for c in cues]
+    return "КАТАЛОГ МУЗЫКИ (локальные отпечатки, статус лицензии в скобках):\n" + "\n".join(lines)
+
+
+_AUDIO_EXTENSIONS = re.compile(r"\.(mp3|wav|flac|m4a|aac|ogg|opus|aif|aiff)$", re.IGNORECASE)
+
+
+if __name__ == "__main__":
+    # python audio_landmarks.py ingest <папка|manifest.json> [licensed|blacklisted]
+    # python audio_landmarks.py match <файл>
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "ingest":
+        source = sys.argv[2]
+        manifest = {}
+        if source.endswith(".json"):
+            with open(source, "r", encoding="utf-8") as f:
+                manifest = {item["path"]: item for item in json.load(f)}
+            paths = list(manifest)
+        else:
+            paths = sorted(os.path.join(root, name) for root, _, names in os.walk(source)
+                           for name in names if _AUDIO_EXTENSIONS.search(name))
+        ingest(paths, status=sys.argv[3] if len(sys.argv) > 3 else None, manifest=manifest)
+    elif command == "match":
+        cues, stats = LandmarkIndex().match(sys.argv[2])
+        print(json.dumps({"cues": cues, "stats": stats}, ensure_ascii=False, indent=2))
+    else:
+        print("usage: python audio_landmarks.py ingest <папка|manifest.json> [status] | match <файл>")
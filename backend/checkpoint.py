@@ -0,0 +1,58 @@
+# backend/checkpoint.py
+import os
+import json
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from redis_helper import get_redis
+from celery_app import app
+
+# Чекпоинт задачи анализа перед паузой по квоте Gemini (429): всё, что сделано до
+# генерации (имя загруженного файла в Google, промпт, RAG, музыка, таблица тишины...),
+# кладем в Redis и перезапускаем задачу через self.retry с отсрочкой - слот воркера
+# свободен сразу, а не спит минутами. Повтор идет с тем же task_id и продолжает
+# с генерации. Ключ checkpoint:<task_id>, значение - JSON {"resume_at", "attempt", "state"}.
+CHECKPOINT_TTL_S = int(os.getenv("CHECKPOINT_TTL_S", str(24 * 3600)))
+
+
+def _key(task_id: str) -> str:
+    return f"checkpoint:{task_id}"
+
+
+def save(task_id: str, state: dict, countdown: float, attempt: int):
+    payload = {"resume_at": time.time() + countdown, "attempt": attempt, "state": state}
+    get_redis().set(_key(task_id), json.dumps(payload, ensure_ascii=False), ex=CHECKPOINT_TTL_S)
+
+
+def load(task_id: str):
+    """Сохраненный state или None (чекпоинта нет, истек или Redis недоступен)."""
+    if not task_id:
+        return None
+    try:
+        raw = get_redis().get(_key(task_id))
+    except Exception as e:
+        print(f"⚠️ Checkpoint Load Error: {e}")
+        return None
+    return json.loads(raw)["state"] if raw else None
+
+
+def drop(task_id: str):
+    try:
+        get_redis().delete(_key(task_id))
+    except Exception as e:
+        print(f"⚠️ Checkpoint Drop Error: {e}")
+
+
+def resume_status(task_id: str):
+    """Строка статуса для ждущей задачи: когда продолжим. None - чекпоинта нет."""
+    try:
+        raw = get_redis().get(_key(task_id))
+    except Exception:
+        return None
+    if not raw:
+        return None
+    payload = json.loads(raw)
+    # Время - в часовом поясе приложения (в контейнере локальное время - UTC)
+    resume_at = datetime.fromtimestamp(payload["resume_at"], ZoneInfo(app.conf.timezone or "UTC")).strftime("%H:%M:%S")
+    return f"Ждем квоту Google, продолжим в {resume_at} (попытка {payload['attempt'] + 1})"
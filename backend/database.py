@@ -1,7 +1,7 @@
 import os
 import uuid
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, Boolean, Text, ForeignKey, Float
+from sqlalchemy import create_engine, text, Column, Integer, String, JSON, DateTime, Boolean, Text, ForeignKey, Float, BigInteger, Index
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from sqlalchemy.dialects.postgresql import UUID, ARRAY
 
@@ -43,6 +43,9 @@ class LegalRequirement(Base):
     risk_floor = Column(String)
     summary = Column(String, nullable=False)
     full_text = Column(Text)
+    # Эмбеддинг summary+full_text для отбора политик (policy_index) и md5 текста, по которому он посчитан
+    embedding = Column(Text)
+    embedding_hash = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 # --- 2. ДАННЫЕ АНАЛИЗА ---
@@ -57,6 +60,20 @@ class MediaAsset(Base):
     metadata_json = Column("metadata", JSON, default={})
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class AssetFingerprint(Base):
+    # Перцептивные отпечатки (64 бита) + 4 индексированных куска по 16 бит для быстрого поиска
+    __tablename__ = "asset_fingerprint"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    asset_id = Column(UUID(as_uuid=True), ForeignKey("media_asset.id", ondelete="CASCADE"), index=True)
+    kind = Column(String, nullable=False) # video, audio
+    position_ms = Column(Integer, default=0)
+    hash = Column(BigInteger, nullable=False)
+    c0 = Column(Integer, nullable=False)
+    c1 = Column(Integer, nullable=False)
+    c2 = Column(Integer, nullable=False)
+    c3 = Column(Integer, nullable=False)
+    __table_args__ = tuple(Index(f"ix_asset_fingerprint_kind_c{i}", "kind", f"c{i}") for i in range(4))
+
 class AgentRun(Base):
     __tablename__ = "agent_run"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -65,6 +82,10 @@ class AgentRun(Base):
     output_json = Column(JSON)
     overall_risk = Column(String)
     overall_confidence = Column(Float)
+    # Ключ кэша результатов (хеш файла + модель + профиль + версии политик/промпта)
+    cache_key = Column(String, index=True, nullable=True)
+    # Служебные сведения о прогоне (план прокси, оценка и фактический размер и т.п.)
+    meta = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class Evidence(Base):
@@ -119,5 +140,17 @@ class CaseMemory(Base):
     meta = Column(JSON, default={})
     embedding = Column(Text) # Храним как текст для совместимости с raw SQL
 
+# create_all не добавляет колонки в уже существующие таблицы - доводим схему вручную
+MIGRATIONS = [
+    "ALTER TABLE agent_run ADD COLUMN IF NOT EXISTS cache_key VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_agent_run_cache_key ON agent_run (cache_key)",
+    "ALTER TABLE agent_run ADD COLUMN IF NOT EXISTS meta JSON",
+    "ALTER TABLE legal_requirement ADD COLUMN IF NOT EXISTS embedding TEXT",
+    "ALTER TABLE legal_requirement ADD COLUMN IF NOT EXISTS embedding_hash VARCHAR",
+]
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for sql in MIGRATIONS:
+            conn.execute(text(sql))
\ No newline at end of file
@@ -0,0 +1,236 @@
+# backend/documents.py
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pypdf import PdfReader
+
+from windowing import merge_window_reports, WINDOW_CONCURRENCY
+
+# Текстовый путь для сценариев и расшифровок (PDF / DOCX): никакого ffmpeg,
+# Shazam и загрузки файла - модель получает сам текст, нарезанный на куски.
+DOCUMENT_EXTENSIONS = {".pdf", ".docx"}
+DOCUMENT_MIME = {
+    ".pdf": "application/pdf",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+# Размер куска текста для одного запроса (~30 тыс. токенов русского текста)
+CHUNK_CHARS = int(os.getenv("DOC_CHUNK_CHARS", "100000"))
+# В DOCX нет страниц, пока Word их не отрисовал: без явных разрывов режем по объему
+DOCX_PAGE_CHARS = int(os.getenv("DOCX_PAGE_CHARS", "4000"))
+# Шкала времени документа: страница N = N секунд (так работают таймлайн и склейка окон)
+PAGE_MS = 1000
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def is_document(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in DOCUMENT_EXTENSIONS
+
+
+def _pdf_pages(path: str):
+    # PdfReader читает страницы лениво - в памяти только текущая
+    reader = PdfReader(path)
+    for i, page in enumerate(reader.pages, start=1):
+        try:
+            text = page.extract_text() or ""
+        except Exception as e:
+            print(f"⚠️ PDF Page {i} Error: {e}")
+            text = ""
+        yield i, text
+
+
+def _docx_pages(path: str):
+    """
+    Потоковый разбор word/document.xml (iterparse): python-docx строит дерево
+    всего документа, а на сценарии в сотни страниц это лишняя память.
+    Страница заканчивается на разрыве страницы; пока разрывов не встретилось -
+    после DOCX_PAGE_CHARS символов (номера страниц тогда условные).
+    """
+    page_no = 1
+    lines, size = [], 0
+    para = []
+    seen_break = False
+
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        for _, el in ET.iterparse(xml, events=("end",)):
+            tag = el.tag
+            if tag == _W + "t":
+                para.append(el.text or "")
+            elif tag == _W + "tab":
+                para.append("\t")
+            elif (tag == _W + "br" and el.get(_W + "type") == "page") or tag == _W + "lastRenderedPageBreak":
+                # Текст абзаца до разрыва остается на прошлой странице
+                seen_break = True
+                if para:
+                    lines.append("".join(para))
+                    para = []
+                if any(lines):
+                    yield page_no, "\n".join(lines)
+                    page_no += 1
+                lines, size = [], 0
+            elif tag == _W + "p":
+                text = "".join(para)
+                para = []
+                lines.append(text)
+                size += len(text)
+                el.clear()
+                if size >= DOCX_PAGE_CHARS and not seen_break:
+                    yield page_no, "\n".join(lines)
+                    page_no += 1
+                    lines, size = [], 0
+
+    if para:
+        lines.append("".join(para))
+    if any(lines):
+        yield page_no, "\n".join(lines)
+
+
+def iter_pages(path: str):
+    """(номер_страницы, текст) по одной странице за раз."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        return _pdf_pages(path)
+    if ext == ".docx":
+        return _docx_pages(path)
+    raise ValueError(f"Unsupported document type: {ext}")
+
+
+def iter_chunks(pages, max_chars: int = None):
+    """
+    Склеивает страницы в куски до max_chars символов с маркерами страниц.
+    Возвращает {"index", "page_start", "page_end", "text"}; пустые страницы пропускаются.
+    """
+    max_chars = max_chars or CHUNK_CHARS
+    buf, size, first, last = [], 0, None, None
+    index = 0
+
+    def flush():
+        return {"index": index, "page_start": first, "page_end": last, "text": "\n".join(buf)}
+
+    for page_no, text in pages:
+        text = text.strip()
+        if not text:
+            continue
+        # Очень длинная "страница" (DOCX без разрывов, таблица) режется по символам
+        for start in range(0, len(text), max_chars):
+            part = f"=== СТРАНИЦА {page_no} ===\n{text[start:start + max_chars]}"
+            if buf and size + len(part) > max_chars:
+                yield flush()
+                index += 1
+                buf, size, first = [], 0, None
+            buf.append(part)
+            size += len(part)
+            first = first or page_no
+            last = page_no
+    if buf:
+        yield flush()
+
+
+DOCUMENT_INSTRUCTION = (
+    "МАТЕРИАЛ - ТЕКСТОВЫЙ ДОКУМЕНТ (сценарий, расшифровка), страницы отмечены маркерами "
+    "'=== СТРАНИЦА N ==='. Для доказательств используй type='transcript_span', "
+    f"start_ms = N * {PAGE_MS}, end_ms = (номер последней страницы цитаты) * {PAGE_MS}, "
+    "в notes укажи 'стр. N'. Видеоряда и звука нет - анализируй только текст."
+)
+
+
+def analyze_chunks(chunks: list, build_content, generate_fn, on_progress=None):
+    """
+    Анализ кусков параллельно (лимит как у окон видео). build_content(chunk) -> content,
+    generate_fn(content) -> dict|None. Несколько кусков склеиваются merge_window_reports
+    (номера страниц в тексте сквозные, поэтому смещение у всех кусков нулевое).
+    Возвращает (отчет|None, число_неудачных_кусков).
+    """
+    reports = [None] * len(chunks)
+    done = 0
+
+    def run_chunk(i):
+        try:
+            return i, generate_fn(build_content(chunks[i]))
+        except Exception as e:
+            print(f"⚠️ Document chunk {i} Error: {e}")
+            return i, None
+
+    with ThreadPoolExecutor(max_workers=WINDOW_CONCURRENCY) as pool:
+        for future in as_completed([pool.submit(run_chunk, i) for i in range(len(chunks))]):
+            i, report = future.result()
+            reports[i] = report
+            done += 1
+            if on_progress:
+                on_progress(done, len(chunks))
+
+    ok = [(chunks[i], r) for i, r in enumerate(reports) if r is not None]
+    failed = len(chunks) - len(ok)
+    if not ok:
+        return None, failed
+    if len(chunks) == 1:
+        return ok[0][1], failed
+    merged = merge_window_reports(
+        [(0, r) for _, r in ok],
+        headings=[f"стр. {c['page_start']}-{c['page_end']}" for c, _ in ok],
+        # Куски пересекаются только по разрезанной длинной странице
+        spans=[(c["page_start"] * PAGE_MS, (c["page_end"] + 1) * PAGE_MS) for c, _ in ok]
+    )
+    return merged, failed
+
+
+# --- СУБТИТРЫ И ПРЕСКРИНИНГ ---
+
+SUBTITLE_EXTENSIONS = {".srt", ".vtt"}
+_CUE_TIME = re.compile(
+    r"(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{3})\s*-->\s*(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{3})"
+)
+
+
+def _cue_ms(h, m, s, ms) -> int:
+    return ((int(h or 0) * 60 + int(m)) * 60 + int(s)) * 1000 + int(ms)
+
+
+def iter_subtitle_cues(path: str):
+    """(start_ms, end_ms, text) для каждой реплики SRT/VTT; файл читается построчно."""
+    start = end = None
+    lines = []
+    with open(path, "r", encoding="utf-8-sig", errors="ignore") as f:
+        for raw in f:
+            line = raw.strip()
+            m = _CUE_TIME.search(line)
+            if m:
+                if start is not None and lines:
+                    yield start, end, " ".join(lines)
+                start, end = _cue_ms(*m.groups()[:4]), _cue_ms(*m.groups()[4:])
+                lines = []
+            elif line and start is not None and not line.isdigit():
+                lines.append(re.sub(r"<[^>]+>", "", line))
+    if start is not None and lines:
+        yield start, end, " ".join(lines)
+
+
+def scan_pages(pages, lexicon, hits: list):
+    """Пропускает страницы дальше без изменений, попутно собирая словарные совпадения в hits."""
+    for page_no, text in pages:
+        for h in lexicon.scan(text, page=page_no):
+            hits.append({**h, "start_ms": page_no * PAGE_MS, "end_ms": page_no * PAGE_MS})
+        yield page_no, text
+
+
+def prescreen_file(path: str, lexicon):
+    """
+    Быстрый словарный проход по тексту файла (документ, субтитры, .txt).
+    Каждое совпадение получает start_ms/end_ms: реплика субтитров или страница документа.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    hits = []
+    if ext in SUBTITLE_EXTENSIONS:
+        for start_ms, end_ms, text in iter_subtitle_cues(path):
+            for h in lexicon.scan(text):
+                hits.append({**h, "start_ms": start_ms, "end_ms": end_ms})
+    elif ext in DOCUMENT_EXTENSIONS:
+        for _ in scan_pages(iter_pages(path), lexicon, hits):
+            pass
+    else:
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            hits = lexicon.scan(f.read())
+    return hits
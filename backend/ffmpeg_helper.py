@@ -0,0 +1,335 @@
+# backend/ffmpeg_helper.py
+import os
+import json
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from redis_helper import incr_metric, get_metrics
+
+# --- НАСТРОЙКИ ПРОКСИ ---
+# Какой исходник можно отдать в Gemini "как есть" (без перекодирования)
+COPY_MAX_WIDTH = int(os.getenv("PROXY_COPY_MAX_WIDTH", "1280"))
+COPY_MAX_FPS = float(os.getenv("PROXY_COPY_MAX_FPS", "30"))
+COPY_MAX_MB = int(os.getenv("PROXY_COPY_MAX_MB", "1024"))
+COPY_VIDEO_PROFILES = {"baseline", "constrained baseline", "main", "high"}
+
+# Сколько секунд CPU уходит на 1 секунду материала при полном кодировании.
+# Используется для оценки сэкономленного времени, пока не накопилась своя статистика.
+DEFAULT_ENCODE_RATIO = float(os.getenv("TRANSCODE_ENCODE_RATIO", "0.25"))
+
+
+def probe_media(path: str):
+    """
+    Запускает ffprobe и возвращает краткую сводку о файле:
+    длительность, контейнер, параметры видео/аудио и раскладку потоков.
+    Если ffprobe не смог прочитать файл (например, это PDF) - возвращает None.
+    """
+    command = [
+        "ffprobe", "-v", "error",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        path
+    ]
+    try:
+        out = subprocess.run(command, check=True, capture_output=True, timeout=120)
+        data = json.loads(out.stdout or b"{}")
+    except Exception as e:
+        print(f"⚠️ FFprobe Error: {e}")
+        return None
+
+    return summarize_probe(data)
+
+
+def _parse_fps(rate: str) -> float:
+    # ffprobe отдает частоту дробью: "24000/1001"
+    try:
+        num, den = rate.split("/")
+        return round(float(num) / float(den), 3) if float(den) else 0.0
+    except Exception:
+        return 0.0
+
+
+def summarize_probe(data: dict):
+    streams = data.get("streams", [])
+    fmt = data.get("format", {})
+    if not streams:
+        return None
+
+    video, audio = None, None
+    for s in streams:
+        # Обложка альбома в mp3 - это тоже "video", но смотреть там нечего
+        is_cover = s.get("disposition", {}).get("attached_pic") == 1
+        if s.get("codec_type") == "video" and not is_cover and video is None:
+            video = {
+                "codec": s.get("codec_name"),
+                "profile": (s.get("profile") or "").lower(),
+                "width": s.get("width", 0),
+                "height": s.get("height", 0),
+                "pix_fmt": s.get("pix_fmt"),
+                "fps": _parse_fps(s.get("avg_frame_rate") or s.get("r_frame_rate") or "0/0"),
+            }
+        elif s.get("codec_type") == "audio" and audio is None:
+            audio = {
+                "codec": s.get("codec_name"),
+                "channels": s.get("channels", 0),
+                "sample_rate": int(s.get("sample_rate") or 0),
+            }
+
+    try:
+        duration_ms = int(float(fmt.get("duration", 0)) * 1000)
+    except (TypeError, ValueError):
+        duration_ms = 0
+
+    return {
+        "duration_ms": duration_ms,
+        "format": fmt.get("format_name"),
+        "size": int(fmt.get("size") or 0),
+        "bit_rate": int(fmt.get("bit_rate") or 0),
+        "video": video,
+        "audio": audio,
+        "streams": [
+            {"index": s.get("index"), "type": s.get("codec_type"), "codec": s.get("codec_name")}
+            for s in streams
+        ],
+    }
+
+
+def choose_transcode_path(probe: dict) -> str:
+    """
+    Выбирает самый дешевый способ получить прокси для Gemini:
+      "copy"   - видео уже H.264 yuv420p скромного размера: только перепаковка в mp4
+      "audio"  - видеодорожки нет: извлекаем легкий AAC
+      "encode" - полное перекодирование (последний вариант)
+    """
+    video = probe.get("video")
+    if not video:
+        return "audio"
+
+    acceptable = (
+        video["codec"] == "h264"
+        and video["pix_fmt"] == "yuv420p"
+        and video["profile"] in COPY_VIDEO_PROFILES
+        and 0 < video["width"] <= COPY_MAX_WIDTH
+        and video["fps"] <= COPY_MAX_FPS
+        and probe.get("size", 0) <= COPY_MAX_MB * 1024 * 1024
+    )
+    return "copy" if acceptable else "encode"
+
+
+def record_transcode(path_kind: str, media_s: float, wall_s: float):
+    """
+    Пишет счетчики по путям сжатия и оценку сэкономленного времени.
+    Экономия = сколько заняло бы полное кодирование (по нашей же статистике) минус факт.
+    """
+    incr_metric("transcode", f"path_{path_kind}")
+    incr_metric("transcode", f"{path_kind}_media_s", float(media_s))
+    incr_metric("transcode", f"{path_kind}_wall_s", float(wall_s))
+
+    if path_kind == "encode" or media_s <= 0:
+        return
+
+    stats = get_metrics("transcode")
+    if stats.get("encode_media_s"):
+        ratio = stats.get("encode_wall_s", 0) / stats["encode_media_s"]
+    else:
+        ratio = DEFAULT_ENCODE_RATIO
+    saved = max(0.0, media_s * ratio - wall_s)
+    incr_metric("transcode", "saved_s", float(saved))
+    print(f"⏱ Путь '{path_kind}': сэкономлено ~{saved:.1f} сек. кодирования")
+
+
+# --- СЕГМЕНТНОЕ КОДИРОВАНИЕ (длинные фильмы) ---
+# "off" - всегда один процесс ffmpeg (как раньше), "auto" - резать длинные файлы на куски
+SEGMENTED_MODE = os.getenv("TRANSCODE_SEGMENTED", "auto")
+SEGMENTED_MIN_S = int(os.getenv("TRANSCODE_SEGMENT_MIN_S", "600"))
+SEGMENT_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "0")) or (os.cpu_count() or 1)
+
+
+def use_segmented(duration_s: float) -> bool:
+    return SEGMENTED_MODE != "off" and SEGMENT_WORKERS > 1 and duration_s >= SEGMENTED_MIN_S
+
+
+# --- ПРОГРЕСС И ОТМЕНА ---
+PROGRESS_INTERVAL_S = float(os.getenv("TRANSCODE_PROGRESS_INTERVAL_S", "2"))
+CANCEL_POLL_S = 1.0
+
+
+class TranscodeCancelled(Exception):
+    """Задачу отменили, пока работал ffmpeg."""
+
+
+def _parse_speed(value) -> float:
+    try:
+        return float(str(value).rstrip("x"))
+    except ValueError:
+        return 0.0
+
+
+def progress_info(done_s: float, duration_s: float, speed: float) -> dict:
+    """Процент, скорость (x реального времени) и оценка оставшегося времени."""
+    percent = min(100.0, done_s / duration_s * 100) if duration_s else None
+    eta_s = int((duration_s - done_s) / speed) if duration_s and speed > 0 and done_s < duration_s else None
+    return {
+        "percent": round(percent, 1) if percent is not None else None,
+        "speed": round(speed, 2),
+        "eta_s": eta_s,
+        "done_s": round(done_s, 1),
+    }
+
+
+def _terminate(proc):
+    # Сначала просим ffmpeg завершиться сам, через 5 секунд - убиваем
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_ffmpeg(command: list, duration_s: float = 0, on_progress=None, should_cancel=None):
+    """
+    Запуск ffmpeg с машиночитаемым прогрессом (-progress pipe:1).
+    Отдельный поток читает блоки key=value и не чаще раза в PROGRESS_INTERVAL_S
+    вызывает on_progress(info). Раз в секунду проверяется should_cancel():
+    если задачу отменили - ffmpeg завершается и бросается TranscodeCancelled.
+    """
+    command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            text=True, errors="ignore")
+
+    def reader():
+        block = {}
+        last_sent = 0.0
+        for line in proc.stdout:
+            key, _, value = line.strip().partition("=")
+            block[key] = value
+            if key != "progress":
+                continue
+            now = time.time()
+            if on_progress and (now - last_sent >= PROGRESS_INTERVAL_S or value == "end"):
+                last_sent = now
+                # out_time_us - позиция в выходном файле (у старых сборок в out_time_ms тоже мкс)
+                us = block.get("out_time_us") or block.get("out_time_ms") or "0"
+                done_s = int(us) / 1_000_000 if us.isdigit() else 0.0
+                if value == "end":
+                    done_s = max(done_s, duration_s)
+                try:
+                    on_progress(progress_info(done_s, duration_s, _parse_speed(block.get("speed", "0"))))
+                except Exception as e:
+                    print(f"⚠️ Progress Error: {e}")
+            block = {}
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                returncode = proc.wait(timeout=CANCEL_POLL_S)
+                break
+            except subprocess.TimeoutExpired:
+                if should_cancel and should_cancel():
+                    _terminate(proc)
+                    raise TranscodeCancelled()
+    finally:
+        if proc.poll() is None:
+            _terminate(proc)
+        thread.join(timeout=5)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def encode_segmented(input_path: str, output_path: str, video_args: list, audio_args: list,
+                     duration_s: float, workers: int = None, on_progress=None, should_cancel=None,
+                     has_audio: bool = True) -> bool:
+    """
+    Параллельное кодирование длинного видео:
+      1. режем видеодорожку по ключевым кадрам на N кусков (-c copy, это быстро);
+      2. кодируем куски одновременно, по процессу ffmpeg на ядро;
+      3. аудио кодируем целиком параллельно с видео (без щелчков на стыках);
+      4. склеиваем куски concat-демультиплексором и добавляем звук без перекодирования.
+    Параметры кодирования те же, что и в обычном режиме, поэтому результат
+    для Gemini ничем не отличается. Возвращает True, если файл собран.
+    has_audio=False (по пробе звука нет) - шаг 3 пропускается, склеивается только видео.
+    """
+    # Celery-воркеры - daemon-процессы, им нельзя создавать multiprocessing-пул.
+    # Но вся тяжелая работа и так в отдельных процессах ffmpeg, поэтому
+    # потоков-"диспетчеров" достаточно.
+    workers = workers or SEGMENT_WORKERS
+    work_dir = f"{os.path.splitext(output_path)[0]}_segments"
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        # 1. Нарезка (ffmpeg режет только на ключевых кадрах, поэтому кусок >= segment_time).
+        # Кусков вдвое больше, чем процессов: неровные по длине куски выравнивают нагрузку.
+        segment_time = max(10, int(duration_s / (workers * 2)) + 1)
+        run_ffmpeg([
+            "ffmpeg", "-y", "-i", input_path,
+            "-map", "0:v:0", "-an", "-c", "copy",
+            "-f", "segment", "-segment_time", str(segment_time),
+            "-reset_timestamps", "1",
+            os.path.join(work_dir, "src_%04d.mkv")
+        ], should_cancel=should_cancel)
+        sources = sorted(f for f in os.listdir(work_dir) if f.startswith("src_"))
+        if not sources:
+            return False
+
+        # 2-3. Кодирование кусков и звука в пуле
+        threads = str(max(1, (os.cpu_count() or 1) // workers))
+        jobs = []
+        encoded = []
+        for name in sources:
+            out = os.path.join(work_dir, name.replace("src_", "enc_").replace(".mkv", ".mp4"))
+            encoded.append(out)
+            jobs.append(["ffmpeg", "-y", "-i", os.path.join(work_dir, name),
+                         *video_args, "-threads", threads, "-an", out])
+
+        audio_path = os.path.join(work_dir, "audio.m4a") if has_audio else None
+        if audio_path:
+            jobs.append(["ffmpeg", "-y", "-i", input_path, "-vn", *audio_args, audio_path])
+
+        print(f"🧩 Сегментное кодирование: {len(sources)} кусков, {workers} процессов")
+        # Общий прогресс - сумма закодированных секунд по всем кускам (звук не считаем)
+        done = {}
+        lock = threading.Lock()
+        started = time.time()
+
+        def run_job(index):
+            def job_progress(info):
+                with lock:
+                    done[index] = info["done_s"]
+                    total = sum(done.values())
+                if on_progress:
+                    on_progress(progress_info(total, duration_s, total / max(time.time() - started, 0.001)))
+            is_audio = audio_path is not None and index == len(jobs) - 1
+            run_ffmpeg(jobs[index], should_cancel=should_cancel,
+                       on_progress=None if is_audio else job_progress)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(run_job, range(len(jobs))))
+
+        # 4. Склейка
+        list_path = os.path.join(work_dir, "concat.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for path in encoded:
+                f.write(f"file '{path}'\n")
+
+        audio_input = ["-i", audio_path, "-map", "0:v", "-map", "1:a?"] if audio_path else ["-map", "0:v"]
+        run_ffmpeg([
+            "ffmpeg", "-y",
+            "-f", "concat", "-safe", "0", "-i", list_path,
+            *audio_input,
+            "-c", "copy", "-movflags", "+faststart",
+            output_path
+        ], should_cancel=should_cancel)
+        return os.path.exists(output_path)
+    except TranscodeCancelled:
+        raise
+    except Exception as e:
+        print(f"⚠️ Segmented FFmpeg Error: {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
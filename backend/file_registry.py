@@ -0,0 +1,251 @@
+# backend/file_registry.py
+import os
+import time
+import hashlib
+
+import requests
+import google.generativeai as genai
+
+from redis_helper import get_redis, incr_metric
+from gemini_uploader import API_BASE
+
+# Реестр уже загруженных в Gemini файлов: ключ - хеш содержимого прокси + API-ключ.
+# Повторный прогон того же материала (другой профиль, другая модель) берет живой
+# ACTIVE-файл из реестра и не грузит прокси заново. Файл на стороне Google живет ~48 ч.
+#
+# Ключи Redis:
+#   gemini_file:<key_id>:<proxy_hash>         hash: name, uri, mime_type, expire_at, last_used
+#   gemini_file:<key_id>:<proxy_hash>:leases  zset: task_id -> до какого времени файл нужен задаче
+#   gemini_files                              zset: ключи записей по expire_at (для уборщика)
+# Сам API-ключ в Redis не хранится (key_id - префикс его sha256). Поэтому удалить файл
+# в Google может только задача с тем же ключом: закончив, она убирает файлы своего ключа,
+# которые никто не держит дольше IDLE_TTL_S (не чаще раза в SWEEP_INTERVAL_MIN).
+# Уборщик в backend (APScheduler, как обновление реестров) ключа не знает и только
+# вычищает из реестра истекшие записи - такие файлы Google удаляет сам через ~48 ч.
+INDEX_KEY = "gemini_files"
+# Файл должен прожить весь анализ: ближе к истечению не переиспользуем
+REUSE_MARGIN_S = int(os.getenv("GEMINI_FILE_REUSE_MARGIN_S", str(2 * 3600)))
+IDLE_TTL_S = int(os.getenv("GEMINI_FILE_IDLE_S", str(6 * 3600)))
+# Аренда задачи с запасом на лимит задачи и паузы по квоте
+LEASE_TTL_S = int(os.getenv("GEMINI_FILE_LEASE_S", str(4 * 3600)))
+DEFAULT_LIFETIME_S = 48 * 3600
+SWEEP_INTERVAL_MIN = int(os.getenv("GEMINI_FILE_SWEEP_MIN", "30"))
+SWEEP_LOCK_TTL_S = 600
+
+
+def _key_id(api_key: str) -> str:
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+
+
+def _entry_key(api_key: str, proxy_hash: str) -> str:
+    return f"gemini_file:{_key_id(api_key)}:{proxy_hash}"
+
+
+def _expire_at(handle) -> float:
+    expiration = getattr(handle, "expiration_time", None)
+    try:
+        if expiration and expiration.timestamp() > 0:
+            return expiration.timestamp()
+    except (AttributeError, ValueError, OverflowError):
+        pass
+    return time.time() + DEFAULT_LIFETIME_S
+
+
+def lookup(api_key: str, proxy_hash: str, task_id: str):
+    """
+    Живой ACTIVE-файл для этого прокси или None. Найденный файл арендуется задачей
+    (уборщик его не тронет) - после анализа вызвать release.
+    """
+    key = _entry_key(api_key, proxy_hash)
+    try:
+        r = get_redis()
+        entry = r.hgetall(key)
+        if not entry:
+            return None
+        if float(entry["expire_at"]) - time.time() < REUSE_MARGIN_S:
+            return None
+        # Аренда до проверки: пока проверяем, уборщик не удалит файл
+        r.zadd(f"{key}:leases", {task_id: time.time() + LEASE_TTL_S})
+    except Exception as e:
+        print(f"⚠️ File Registry Error: {e}")
+        return None
+
+    try:
+        handle = genai.get_file(entry["name"])
+        if handle.state.name == "ACTIVE":
+            r.hset(key, "last_used", time.time())
+            incr_metric("gemini_files", "reused")
+            return handle
+        print(f"⚠️ Файл {entry['name']} в реестре, но в состоянии {handle.state.name}")
+    except Exception as e:
+        print(f"⚠️ Файл {entry['name']} из реестра недоступен: {e}")
+    # Файла больше нет (удален, истек раньше срока) - запись убираем, грузим заново
+    forget(key)
+    return None
+
+
+# Запись чужого файла, который еще кто-то арендует, не перезаписываем: две задачи
+# загрузили один прокси одновременно - в реестре остается первая копия, вторую
+# удаляет загрузившая ее задача. Запись без живых аренд (файл близок к истечению,
+# lookup его не отдал) заменяем, старую копию удаляем сразу - ее больше никто не найдет.
+_REGISTER_SCRIPT = """
+local old = redis.call('hget', KEYS[1], 'name')
+if old and old ~= ARGV[1] and redis.call('zcount', KEYS[2], ARGV[5], '+inf') > 0 then
+    return {0, old}
+end
+redis.call('del', KEYS[1])
+redis.call('zremrangebyscore', KEYS[2], '-inf', ARGV[5])
+redis.call('hset', KEYS[1], 'name', ARGV[1], 'uri', ARGV[2], 'mime_type', ARGV[3],
+           'expire_at', ARGV[4], 'last_used', ARGV[5])
+redis.call('expireat', KEYS[1], math.floor(tonumber(ARGV[4])))
+redis.call('zadd', KEYS[2], ARGV[7], ARGV[6])
+redis.call('expireat', KEYS[2], math.floor(tonumber(ARGV[4])))
+redis.call('zadd', KEYS[3], ARGV[4], KEYS[1])
+return {1, old or ''}
+"""
+
+
+def register(api_key: str, proxy_hash: str, handle, task_id: str) -> bool:
+    """
+    Запомнить загруженный файл (с арендой задачи). False - в реестре уже другой живой
+    файл этого прокси или реестр недоступен: свою копию задача удаляет сама.
+    """
+    key = _entry_key(api_key, proxy_hash)
+    expire_at = _expire_at(handle)
+    now = time.time()
+    try:
+        ok, old = get_redis().eval(_REGISTER_SCRIPT, 3, key, f"{key}:leases", INDEX_KEY,
+                                   handle.name, handle.uri, handle.mime_type, expire_at, now,
+                                   task_id, now + LEASE_TTL_S)
+    except Exception as e:
+        print(f"⚠️ File Registry Error: {e}")
+        return False
+    if not ok:
+        print(f"♻️ Прокси уже загружен параллельной задачей ({old}), копия {handle.name} не нужна")
+        incr_metric("gemini_files", "duplicate")
+        return False
+    incr_metric("gemini_files", "registered")
+    if old and old != handle.name:
+        _delete_remote(old, api_key)
+    return True
+
+
+def renew(api_key: str, proxy_hash: str, task_id: str):
+    """Продлить аренду (повтор после паузы по квоте продолжает с тем же файлом)."""
+    key = _entry_key(api_key, proxy_hash)
+    try:
+        get_redis().zadd(f"{key}:leases", {task_id: time.time() + LEASE_TTL_S})
+    except Exception as e:
+        print(f"⚠️ File Registry Error: {e}")
+
+
+def release(api_key: str, proxy_hash: str, task_id: str):
+    """Задача закончила с файлом; удалит его sweep_idle, когда файл станет никому не нужен."""
+    key = _entry_key(api_key, proxy_hash)
+    try:
+        r = get_redis()
+        r.zrem(f"{key}:leases", task_id)
+        if r.exists(key):
+            r.hset(key, "last_used", time.time())
+    except Exception as e:
+        print(f"⚠️ File Registry Error: {e}")
+
+
+def forget(key: str):
+    r = get_redis()
+    r.delete(key, f"{key}:leases")
+    r.zrem(INDEX_KEY, key)
+
+
+def _delete_remote(name: str, api_key: str) -> bool:
+    try:
+        response = requests.delete(f"{API_BASE}/v1beta/{name}", headers={"x-goog-api-key": api_key}, timeout=30)
+        # 404/403 - файла уже нет (истек или удален вручную)
+        return response.status_code in (200, 403, 404)
+    except Exception as e:
+        print(f"⚠️ Gemini File Delete Error ({name}): {e}")
+        return False
+
+
+def sweep(api_key: str = None) -> dict:
+    """
+    Один проход уборщика: истекшие записи и, если передан api_key, файлы этого ключа
+    без аренды дольше IDLE_TTL_S (без ключа удалить их в Google нельзя).
+    """
+    r = get_redis()
+    now = time.time()
+    prefix = f"gemini_file:{_key_id(api_key)}:" if api_key else None
+    stats = {"expired": 0, "idle": 0, "kept": 0}
+    for key in r.zrange(INDEX_KEY, 0, -1):
+        entry = r.hgetall(key)
+        if not entry:
+            r.zrem(INDEX_KEY, key)
+            continue
+        leases = f"{key}:leases"
+        r.zremrangebyscore(leases, "-inf", now)
+        if float(entry["expire_at"]) <= now:
+            # Google удаляет такие файлы сам, чистим только реестр
+            forget(key)
+            stats["expired"] += 1
+        elif prefix and key.startswith(prefix) and not r.zcard(leases) \
+                and now - float(entry.get("last_used") or 0) > IDLE_TTL_S:
+            if _delete_remote(entry["name"], api_key):
+                forget(key)
+                stats["idle"] += 1
+        else:
+            stats["kept"] += 1
+    incr_metric("gemini_files", "swept_expired", stats["expired"])
+    incr_metric("gemini_files", "swept_idle", stats["idle"])
+    return stats
+
+
+def locked_sweep():
+    """Запуск по расписанию: при нескольких процессах backend убирает только один."""
+    owner = f"{os.getpid()}:{time.time()}"
+    try:
+        r = get_redis()
+        if not r.set("lock:gemini_file_sweep", owner, nx=True, ex=SWEEP_LOCK_TTL_S):
+            return None
+        try:
+            stats = sweep()
+            if stats["expired"]:
+                print(f"🧹 Файлы Gemini: {stats}")
+            return stats
+        finally:
+            if r.get("lock:gemini_file_sweep") == owner:
+                r.delete("lock:gemini_file_sweep")
+    except Exception as e:
+        print(f"⚠️ Gemini File Sweep Error: {e}")
+        return None
+
+
+def sweep_idle(api_key: str):
+    """
+    Уборка файлов своего ключа из задачи (вызывается после release). Не чаще раза
+    в SWEEP_INTERVAL_MIN на ключ: метку не снимаем, она истекает сама.
+    """
+    if SWEEP_INTERVAL_MIN <= 0:
+        return None
+    try:
+        r = get_redis()
+        if not r.set(f"lock:gemini_file_sweep:{_key_id(api_key)}", 1, nx=True, ex=SWEEP_INTERVAL_MIN * 60):
+            return None
+        stats = sweep(api_key)
+        if stats["expired"] or stats["idle"]:
+            print(f"🧹 Файлы Gemini: {stats}")
+        return stats
+    except Exception as e:
+        print(f"⚠️ Gemini File Sweep Error: {e}")
+        return None
+
+
+def start_sweeper():
+    """Фоновый уборщик (вызывается при старте backend). None - если выключен."""
+    if SWEEP_INTERVAL_MIN <= 0:
+        return None
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(locked_sweep, "interval", minutes=SWEEP_INTERVAL_MIN, id="gemini_file_sweep",
+                      max_instances=1, coalesce=True)
+    scheduler.start()
+    return scheduler
@@ -0,0 +1,247 @@
+# backend/fingerprint.py
+import os
+import uuid
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from sqlalchemy import text
+
+# Перцептивные отпечатки для поиска перезаливок одной и той же программы
+# (другой контейнер, битрейт, "жучок" канала). Каждый отпечаток - 64 бита:
+#   video: dHash кадра 9x8 в градациях серого;
+#   audio: знаки разностей энергий соседних частотных полос (2 секунды звука).
+# Поиск - multi-index hashing: 64 бита режутся на 4 куска по 16 бит, каждый кусок
+# индексирован. Если расстояние Хэмминга <= 3, хотя бы один кусок совпадает точно
+# (принцип Дирихле), поэтому кандидатов достаем по индексу, без полного перебора.
+# Пары с расстоянием до MAX_DISTANCE тоже находятся, если отличия легли в 1-3 куска
+# (у перезаливок так почти всегда) - точное расстояние проверяется уже в Python.
+
+HASH_BITS = 64
+CHUNKS = 4
+MAX_DISTANCE = int(os.getenv("FINGERPRINT_MAX_DISTANCE", "10"))
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.6"))
+MAX_HASHES = 64          # на один актив и тип
+QUERY_HASHES = 16        # сколько отпечатков запроса идет в индекс
+# Шаг выборки берем из фиксированной лестницы: у двух версий одной программы
+# длительности близки, значит и сетка кадров совпадет
+STEP_LADDER = [2, 5, 10, 30, 60, 120, 300]
+
+# Параллельных ffmpeg при выборке кадров
+FRAME_WORKERS = int(os.getenv("FINGERPRINT_FRAME_WORKERS", "4"))
+
+AUDIO_RATE = 5512
+AUDIO_WINDOW_S = 2
+AUDIO_BANDS = HASH_BITS + 1
+
+
+def _sample_step(duration_s: float) -> int:
+    for step in STEP_LADDER:
+        if duration_s / step <= MAX_HASHES:
+            return step
+    return STEP_LADDER[-1]
+
+
+def _to_int64(bits: np.ndarray) -> int:
+    """64 булевых значения -> знаковое целое (влезает в BIGINT Postgres)."""
+    value = 0
+    for b in bits:
+        value = (value << 1) | int(b)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _informative(h: int) -> bool:
+    # Черные кадры и тишина дают почти пустые хеши - они совпадают у всех
+    ones = bin(h & 0xFFFFFFFFFFFFFFFF).count("1")
+    return 8 <= ones <= 56
+
+
+def _frame_at(path: str, position_s: float):
+    """Кадр 9x8 (серый) ровно на position_s: -ss до -i - быстрый переход к ключевому кадру и точное декодирование до метки."""
+    command = [
+        "ffmpeg", "-v", "error", "-ss", str(position_s), "-i", path,
+        "-frames:v", "1", "-vf", "scale=9:8:flags=area,format=gray",
+        "-f", "rawvideo", "pipe:1"
+    ]
+    raw = subprocess.run(command, check=True, capture_output=True, timeout=120).stdout
+    if len(raw) < 72:
+        return None
+    return np.frombuffer(raw[:72], dtype=np.uint8).reshape(8, 9).astype(np.int16)
+
+
+def video_hashes(path: str, duration_s: float):
+    """
+    [(position_ms, hash)] по кадрам на фиксированных метках времени с шагом из STEP_LADDER.
+    Метки не зависят от расстановки ключевых кадров: у перезаливки (другой GOP) кадры те же.
+    """
+    step = _sample_step(duration_s)
+    positions = [i * step for i in range(MAX_HASHES) if i * step < duration_s]
+    with ThreadPoolExecutor(FRAME_WORKERS) as pool:
+        frames = list(pool.map(lambda t: _frame_at(path, t), positions))
+
+    result = []
+    for position, frame in zip(positions, frames):
+        if frame is None:
+            continue
+        bits = (frame[:, 1:] > frame[:, :-1]).flatten()
+        h = _to_int64(bits)
+        if _informative(h):
+            result.append((position * 1000, h))
+    return result
+
+
+def _band_edges():
+    # Логарифмические полосы 300-2000 Гц, как в классических аудио-отпечатках
+    freqs = np.fft.rfftfreq(AUDIO_RATE * AUDIO_WINDOW_S, 1 / AUDIO_RATE)
+    edges = np.geomspace(300, 2000, AUDIO_BANDS + 1)
+    return np.searchsorted(freqs, edges)
+
+
+def audio_hashes(path: str, duration_s: float):
+    """[(position_ms, hash)]: спектр 2-секундного окна в начале каждого шага."""
+    step = _sample_step(duration_s)
+    window = AUDIO_RATE * AUDIO_WINDOW_S
+    block = AUDIO_RATE * step * 2  # байт на шаг (s16le)
+    edges = _band_edges()
+    hann = np.hanning(window)
+
+    command = [
+        "ffmpeg", "-v", "error", "-i", path, "-vn",
+        "-ac", "1", "-ar", str(AUDIO_RATE), "-f", "s16le", "pipe:1"
+    ]
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    result = []
+    try:
+        position = 0
+        while len(result) < MAX_HASHES:
+            # Читаем поблочно: весь фильм в память не грузим
+            chunk = proc.stdout.read(block)
+            if len(chunk) < window * 2:
+                break
+            samples = np.frombuffer(chunk[: window * 2], dtype=np.int16).astype(np.float32)
+            spectrum = np.abs(np.fft.rfft(samples * hann)) ** 2
+            energy = np.array([spectrum[a:b].sum() for a, b in zip(edges[:-1], edges[1:])])
+            h = _to_int64(energy[1:] > energy[:-1])
+            if _informative(h):
+                result.append((position * 1000, h))
+            position += step
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+    return result
+
+
+def compute_fingerprints(path: str, probe: dict) -> dict:
+    """{'video': [...], 'audio': [...]} - по тем дорожкам, что есть в файле."""
+    duration_s = (probe or {}).get("duration_ms", 0) / 1000
+    prints = {}
+    if not probe or duration_s <= 0:
+        return prints
+    try:
+        if probe.get("video"):
+            prints["video"] = video_hashes(path, duration_s)
+        if probe.get("audio"):
+            prints["audio"] = audio_hashes(path, duration_s)
+    except Exception as e:
+        print(f"⚠️ Fingerprint Error: {e}")
+    return prints
+
+
+def _chunks(h: int):
+    u = h & 0xFFFFFFFFFFFFFFFF
+    return [(u >> (16 * (CHUNKS - 1 - i))) & 0xFFFF for i in range(CHUNKS)]
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def save_fingerprints(db, asset_id, prints: dict):
+    rows = []
+    for kind, hashes in prints.items():
+        for position_ms, h in hashes:
+            c = _chunks(h)
+            rows.append({"id": uuid.uuid4(), "aid": asset_id, "kind": kind, "pos": position_ms, "hash": h,
+                         "c0": c[0], "c1": c[1], "c2": c[2], "c3": c[3]})
+    if not rows:
+        return
+    db.execute(text("""
+        INSERT INTO asset_fingerprint (id, asset_id, kind, position_ms, hash, c0, c1, c2, c3)
+        VALUES (:id, :aid, :kind, :pos, :hash, :c0, :c1, :c2, :c3)
+    """), rows)
+    db.commit()
+
+
+def find_near_duplicates(db, prints: dict, threshold: float = None, limit: int = 5):
+    """
+    Ищет активы, у которых >= threshold отпечатков запроса находят пару
+    на расстоянии Хэмминга <= MAX_DISTANCE. Возвращает список словарей
+    с asset_id, filename, score и последним agent_run по этому активу.
+    """
+    threshold = DUPLICATE_THRESHOLD if threshold is None else threshold
+    scores = defaultdict(dict)
+
+    for kind, hashes in prints.items():
+        if not hashes:
+            continue
+        # Равномерная подвыборка: в индекс идет не больше QUERY_HASHES запросов
+        idx = np.linspace(0, len(hashes) - 1, min(QUERY_HASHES, len(hashes))).astype(int)
+        query = [hashes[i][1] for i in sorted(set(idx))]
+
+        by_chunk = [defaultdict(list) for _ in range(CHUNKS)]
+        for qi, h in enumerate(query):
+            for ci, value in enumerate(_chunks(h)):
+                by_chunk[ci][value].append(qi)
+
+        rows = db.execute(text("""
+            SELECT asset_id, hash, c0, c1, c2, c3
+            FROM asset_fingerprint
+            WHERE kind = :kind
+              AND (c0 = ANY(:c0) OR c1 = ANY(:c1) OR c2 = ANY(:c2) OR c3 = ANY(:c3))
+        """), {
+            "kind": kind,
+            **{f"c{i}": list(by_chunk[i].keys()) for i in range(CHUNKS)}
+        }).fetchall()
+
+        matched = defaultdict(set)  # asset_id -> индексы совпавших отпечатков запроса
+        for row in rows:
+            chunk_values = (row.c0, row.c1, row.c2, row.c3)
+            for ci, value in enumerate(chunk_values):
+                for qi in by_chunk[ci].get(value, []):
+                    if qi not in matched[row.asset_id] and _distance(query[qi], row.hash) <= MAX_DISTANCE:
+                        matched[row.asset_id].add(qi)
+
+        for asset_id, hits in matched.items():
+            scores[asset_id][kind] = len(hits) / len(query)
+
+    # Вид без отпечатков у запроса (нет видео или звука) в среднее не входит
+    query_kinds = sum(1 for hashes in prints.values() if hashes)
+    candidates = []
+    for asset_id, per_kind in scores.items():
+        # Если у обоих файлов есть и видео, и звук - усредняем
+        score = sum(per_kind.values()) / query_kinds
+        if score >= threshold:
+            candidates.append((score, asset_id))
+    candidates.sort(reverse=True)
+
+    result = []
+    for score, asset_id in candidates[:limit]:
+        row = db.execute(text("""
+            SELECT a.filename, r.id AS run_id, r.model, r.overall_risk
+            FROM media_asset a
+            LEFT JOIN agent_run r ON r.asset_id = a.id
+            WHERE a.id = :aid
+            ORDER BY r.created_at DESC NULLS LAST
+            LIMIT 1
+        """), {"aid": asset_id}).fetchone()
+        result.append({
+            "asset_id": str(asset_id),
+            "filename": row.filename if row else None,
+            "score": round(score, 3),
+            "run_id": str(row.run_id) if row and row.run_id else None,
+            "model": row.model if row else None,
+            "overall_risk": row.overall_risk if row else None,
+        })
+    return result
@@ -0,0 +1,223 @@
+# backend/gemini_uploader.py
+import os
+import json
+import time
+import queue
+import asyncio
+
+import aiohttp
+from google.generativeai import protos
+from google.generativeai.types import file_types
+
+import rate_limiter
+import stage_graph
+from redis_helper import incr_metric
+from ffmpeg_helper import TranscodeCancelled
+
+# Асинхронная загрузка файлов в Gemini Files API (REST, resumable-протокол) вместо
+# блокирующего genai.upload_file + опроса раз в 3 секунды:
+#   - несколько файлов грузятся параллельно (не больше UPLOAD_CONCURRENCY), кусками,
+#     с прогрессом по байтам;
+#   - состояния PROCESSING опрашиваются одним циклом для всех файлов, у каждого свой
+#     интервал: сначала часто, потом реже (POLL_FIRST_S * POLL_FACTOR^n, до POLL_MAX_S);
+#   - готовые (ACTIVE) файлы отдаются сразу, не дожидаясь остальных.
+# GEMINI_API_BASE можно направить на локальную заглушку сервиса файлов.
+API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+UPLOAD_CONCURRENCY = int(os.getenv("GEMINI_UPLOAD_CONCURRENCY", "4"))
+CHUNK_BYTES = 8 * 1024 * 1024
+POLL_FIRST_S = 1.0
+POLL_FACTOR = 1.6
+POLL_MAX_S = 15.0
+PROCESSING_TIMEOUT_S = float(os.getenv("GEMINI_PROCESSING_TIMEOUT_S", "600"))
+HTTP_TIMEOUT_S = 300
+
+
+class UploadError(Exception):
+    """Файл не загрузился или Google не смог его обработать."""
+
+
+def to_handle(file: dict):
+    """JSON ресурса File -> объект SDK (годится в generate_content, есть .delete())."""
+    return file_types.File(protos.File.from_json(json.dumps(file), ignore_unknown_fields=True))
+
+
+async def _upload(session, path: str, mime_type: str, api_key: str, on_progress=None) -> dict:
+    """Resumable-загрузка: start, затем куски с finalize на последнем. Возвращает ресурс File."""
+    size = os.path.getsize(path)
+    headers = {
+        "x-goog-api-key": api_key,
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(size),
+        "X-Goog-Upload-Header-Content-Type": mime_type,
+    }
+    body = {"file": {"display_name": os.path.basename(path)}}
+    async with session.post(f"{API_BASE}/upload/v1beta/files", headers=headers, json=body) as resp:
+        if resp.status != 200:
+            raise UploadError(f"start {resp.status}: {(await resp.text())[:200]}")
+        upload_url = resp.headers["X-Goog-Upload-URL"]
+        granularity = int(resp.headers.get("X-Goog-Upload-Chunk-Granularity") or CHUNK_BYTES)
+    # Кусок - кратный гранулярности сервиса (кроме последнего)
+    chunk = max(granularity, CHUNK_BYTES // granularity * granularity)
+
+    # Чтение с диска - в потоке: event loop общий для всех загрузок и опросов процесса
+    loop = asyncio.get_running_loop()
+    offset = 0
+    with open(path, "rb") as f:
+        while True:
+            data = await loop.run_in_executor(None, f.read, chunk)
+            last = offset + len(data) >= size
+            headers = {
+                "X-Goog-Upload-Command": "upload, finalize" if last else "upload",
+                "X-Goog-Upload-Offset": str(offset),
+            }
+            async with session.post(upload_url, headers=headers, data=data) as resp:
+                if resp.status != 200:
+                    raise UploadError(f"chunk @{offset} {resp.status}: {(await resp.text())[:200]}")
+                offset += len(data)
+                if on_progress:
+                    on_progress(offset, size)
+                if last:
+                    return (await resp.json())["file"]
+
+
+async def _get(session, name: str, api_key: str) -> dict:
+    async with session.get(f"{API_BASE}/v1beta/{name}", headers={"x-goog-api-key": api_key}) as resp:
+        if resp.status != 200:
+            raise UploadError(f"get {name} {resp.status}")
+        return await resp.json()
+
+
+async def upload_stream(items, api_key: str, on_progress=None, should_cancel=None):
+    """
+    items - [(path, mime_type)]. Асинхронный генератор (index, handle|None, error|None)
+    в порядке готовности. on_progress(index, sent_bytes, total_bytes).
+    """
+    loop = asyncio.get_running_loop()
+    results = asyncio.Queue()
+    pending = {}  # index -> {"name", "since", "next", "interval"}
+    wake = asyncio.Event()
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def upload_one(session, i, path, mime_type):
+        async with semaphore:
+            try:
+                if should_cancel and should_cancel():
+                    raise TranscodeCancelled()
+                # Лимит общий с остальными вызовами Gemini; acquire блокирующий - в поток
+                await loop.run_in_executor(None, rate_limiter.acquire, api_key, "upload", 0, "upload")
+                started = time.time()
+                file = await _upload(session, path, mime_type, api_key,
+                                     (lambda sent, total: on_progress(i, sent, total)) if on_progress else None)
+                incr_metric("ratelimit", "upload_calls")
+                incr_metric("ratelimit", "upload_call_s", round(time.time() - started, 3))
+            except TranscodeCancelled:
+                raise
+            except Exception as e:
+                await results.put((i, None, f"upload: {e}"))
+                return
+        if file.get("state") == "ACTIVE":
+            await results.put((i, to_handle(file), None))
+        elif file.get("state") == "FAILED":
+            await results.put((i, None, f"{file['name']} FAILED"))
+        else:
+            now = time.monotonic()
+            pending[i] = {"name": file["name"], "since": now, "next": now + POLL_FIRST_S, "interval": POLL_FIRST_S}
+            wake.set()
+
+    async def poll_loop(session):
+        # Один цикл на все файлы: за проход опрашиваются (параллельно) те, чей срок подошел
+        while True:
+            now = time.monotonic()
+            due = [i for i, p in pending.items() if p["next"] <= now]
+            answers = await asyncio.gather(*(_get(session, pending[i]["name"], api_key) for i in due),
+                                           return_exceptions=True)
+            now = time.monotonic()
+            for i, answer in zip(due, answers):
+                p = pending[i]
+                state = None if isinstance(answer, Exception) else answer.get("state")
+                if state == "ACTIVE":
+                    del pending[i]
+                    print(f"✅ Файл {p['name']} ACTIVE за {int(now - p['since'])} сек.")
+                    await results.put((i, to_handle(answer), None))
+                elif state == "FAILED":
+                    del pending[i]
+                    await results.put((i, None, f"{p['name']} FAILED: {answer.get('error')}"))
+                elif now - p["since"] > PROCESSING_TIMEOUT_S:
+                    del pending[i]
+                    await results.put((i, None, f"{p['name']} still {state or 'unknown'} after {int(now - p['since'])}s"))
+                else:
+                    # Ошибка сети при опросе - не повод бросать файл, просто следующий опрос
+                    p["interval"] = min(POLL_MAX_S, p["interval"] * POLL_FACTOR)
+                    p["next"] = now + p["interval"]
+            if should_cancel and should_cancel():
+                raise TranscodeCancelled()
+            wake.clear()
+            delay = min((p["next"] for p in pending.values()), default=now + POLL_MAX_S) - now
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=max(0.05, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=HTTP_TIMEOUT_S, sock_connect=30)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        tasks = [loop.create_task(upload_one(session, i, path, mime)) for i, (path, mime) in enumerate(items)]
+        poller = loop.create_task(poll_loop(session))
+        watched = [*tasks, poller]
+        try:
+            for _ in range(len(items)):
+                getter = loop.create_task(results.get())
+                done, _ = await asyncio.wait([getter, *watched], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not getter and task.exception() is not None:
+                        getter.cancel()
+                        raise task.exception()
+                watched = [t for t in watched if not t.done()]
+                yield await getter
+        finally:
+            for task in [*tasks, poller]:
+                task.cancel()
+            await asyncio.gather(*tasks, poller, return_exceptions=True)
+
+
+_DONE = object()
+
+
+def iter_uploads(items, api_key: str, on_progress=None, should_cancel=None):
+    """
+    Синхронная версия для потоков воркера (на event loop процесса, см. stage_graph):
+    (index, handle|None, error|None) по мере готовности файлов.
+    """
+    out = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in upload_stream(items, api_key, on_progress, should_cancel):
+                out.put(item)
+        except BaseException as e:
+            out.put(e)
+            raise
+        finally:
+            out.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), stage_graph.get_loop())
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Потребитель ушел раньше - загрузки, которые еще идут, больше не нужны
+        future.cancel()
+
+
+def upload_file(path: str, mime_type: str, api_key: str, on_progress=None, should_cancel=None):
+    """Один файл: handle в состоянии ACTIVE или UploadError."""
+    progress = (lambda i, sent, total: on_progress(sent, total)) if on_progress else None
+    for _, handle, error in iter_uploads([(path, mime_type)], api_key, progress, should_cancel):
+        if error:
+            raise UploadError(error)
+        return handle
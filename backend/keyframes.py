@@ -0,0 +1,137 @@
+# backend/keyframes.py
+import os
+import re
+import shutil
+import subprocess
+
+# Режим "ключевые кадры + аудио": вместо непрерывного видео 24 fps Gemini получает
+# по кадру на каждую смену сцены (и по кадру раз в MAX_SHOT_S на длинных планах)
+# плюс моно-дорожку 16 кГц. Для ток-шоу и новостей это в разы меньше байт.
+SCENE_THRESHOLD = float(os.getenv("KEYFRAME_SCENE_THRESHOLD", "0.3"))
+MAX_SHOT_S = int(os.getenv("KEYFRAME_MAX_SHOT_S", "20"))
+MAX_FRAMES = int(os.getenv("KEYFRAME_MAX_FRAMES", "300"))
+# Кадры идут в запрос inline, а у Gemini лимит на весь запрос ~20 MB (в base64 байты растут на треть):
+# суммарный объем JPEG держим с запасом под промпт
+MAX_INLINE_BYTES = int(os.getenv("KEYFRAME_MAX_INLINE_MB", "12")) * 1024 * 1024
+# Средний битрейт обычного видео-прокси (640px, CRF 28) для сравнения объема
+VIDEO_PROXY_KBPS = int(os.getenv("VIDEO_PROXY_KBPS", "400"))
+
+_PTS_RE = re.compile(r"pts_time:\s*([0-9.]+)")
+
+
+def extract_keyframes(input_path: str, out_dir: str):
+    """
+    Детектор смены сцен ffmpeg (select=gt(scene,..)) + showinfo для таймкодов.
+    Возвращает [{"index", "t_ms", "path"}] в порядке времени.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    select = (f"select='isnan(prev_selected_t)+gt(scene,{SCENE_THRESHOLD})"
+              f"+gte(t-prev_selected_t,{MAX_SHOT_S})'")
+    command = [
+        "ffmpeg", "-y", "-i", input_path,
+        "-vf", f"{select},showinfo,scale=640:-2",
+        "-fps_mode", "vfr", "-q:v", "5",
+        os.path.join(out_dir, "frame_%05d.jpg")
+    ]
+    proc = subprocess.run(command, check=True, capture_output=True, timeout=3000)
+    times = [float(t) for t in _PTS_RE.findall(proc.stderr.decode("utf-8", "ignore"))]
+
+    names = sorted(f for f in os.listdir(out_dir) if f.startswith("frame_"))
+    frames = [
+        {"index": i, "t_ms": int(t * 1000), "path": os.path.join(out_dir, name)}
+        for i, (name, t) in enumerate(zip(names, times))
+    ]
+
+    # Слишком много сцен (клипы, реклама) - прореживаем равномерно
+    if len(frames) > MAX_FRAMES:
+        frames = _thin(frames, MAX_FRAMES)
+    # И по объему: детальные кадры тяжелее, их помещается меньше
+    total = sum(os.path.getsize(f["path"]) for f in frames)
+    while frames and total > MAX_INLINE_BYTES:
+        keep_count = max(1, min(len(frames) - 1, int(len(frames) * MAX_INLINE_BYTES / total)))
+        frames = _thin(frames, keep_count)
+        total = sum(os.path.getsize(f["path"]) for f in frames)
+    return frames
+
+
+def sample_frames(input_path: str, out_dir: str, count: int, duration_ms: int):
+    """
+    count кадров, равномерно по длительности (без детектора сцен - быстро, по кадру на seek).
+    Для режимов без ключевых кадров, где кадры нужны только для краткого описания материала.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    frames = []
+    for i in range(count):
+        t_ms = int(duration_ms * (i + 0.5) / count)
+        path = os.path.join(out_dir, f"sample_{i:03d}.jpg")
+        command = [
+            "ffmpeg", "-y", "-ss", f"{t_ms / 1000:.3f}", "-i", input_path,
+            "-frames:v", "1", "-vf", "scale=640:-2", "-q:v", "5", path
+        ]
+        try:
+            subprocess.run(command, check=True, capture_output=True, timeout=60)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            continue
+        if os.path.exists(path):
+            frames.append({"index": len(frames), "t_ms": t_ms, "path": path})
+    return frames
+
+
+def _thin(frames: list, keep_count: int) -> list:
+    """Равномерно оставляет keep_count кадров (лишние файлы удаляются), индексы - заново по порядку."""
+    step = len(frames) / keep_count
+    keep = {int(i * step) for i in range(keep_count)}
+    for i, f in enumerate(frames):
+        if i not in keep:
+            os.remove(f["path"])
+    frames = [f for i, f in enumerate(frames) if i in keep]
+    for i, f in enumerate(frames):
+        f["index"] = i
+    return frames
+
+
+def _tc(ms: int) -> str:
+    s = ms // 1000
+    return f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}"
+
+
+def keyframe_parts(frames: list) -> list:
+    """
+    Части запроса: подпись с таймкодом + сам кадр (inline, без отдельной загрузки).
+    Подпись нужна модели, чтобы ставить frame_span на реальную шкалу времени.
+    """
+    parts = []
+    for f in frames:
+        with open(f["path"], "rb") as fh:
+            data = fh.read()
+        parts.append(f"КАДР #{f['index']} @ {_tc(f['t_ms'])} (t_ms={f['t_ms']})")
+        parts.append({"mime_type": "image/jpeg", "data": data})
+    return parts
+
+
+KEYFRAME_INSTRUCTION = (
+    "ВИДЕОРЯД ПЕРЕДАН КЛЮЧЕВЫМИ КАДРАМИ (по кадру на сцену) + полная аудиодорожка. "
+    "Для визуальных доказательств (frame_span) ставь start_ms = t_ms кадра, "
+    "end_ms = t_ms следующего кадра. Для речи используй таймкоды аудиодорожки."
+)
+
+
+def payload_report(frames: list, audio_path: str, duration_ms: int) -> dict:
+    """Сколько байт уходит в модель по сравнению с обычным видео-прокси."""
+    frames_bytes = sum(os.path.getsize(f["path"]) for f in frames)
+    audio_bytes = os.path.getsize(audio_path) if audio_path and os.path.exists(audio_path) else 0
+    video_estimate = int(duration_ms / 1000 * VIDEO_PROXY_KBPS * 1000 / 8)
+    total = frames_bytes + audio_bytes
+    return {
+        "mode": "keyframes",
+        "frames": len(frames),
+        "frames_bytes": frames_bytes,
+        "audio_bytes": audio_bytes,
+        "total_bytes": total,
+        "video_proxy_estimate_bytes": video_estimate,
+        "ratio": round(total / video_estimate, 3) if video_estimate else None,
+    }
+
+
+def cleanup(out_dir: str):
+    shutil.rmtree(out_dir, ignore_errors=True)
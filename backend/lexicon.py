@@ -0,0 +1,391 @@
+# backend/lexicon.py
+import os
+import re
+import json
+from collections import deque
+
+# Лексический прескрининг: очевидные совпадения (запрещенные организации, иноагенты,
+# матерные корни) находятся словарем за миллисекунды, без запроса к модели.
+# Маленькие словари (мат, имена без индекса) компилируются в автомат Ахо-Корасик - один
+# проход по тексту независимо от числа шаблонов. Большие реестры имен в автомат не идут:
+# их ищет бинарный поиск по индексу registry_index, который все процессы воркера держат
+# через mmap (общие страницы page cache вместо своей копии реестров в каждом процессе).
+REGISTRIES_DIR = os.getenv("REGISTRIES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "registries"))
+
+# Реестры организаций/персон и политика, которую они задевают
+NAME_SOURCES = ["blacklist.json", "rosfin_terrorists.json", "foreign_agents.json"]
+MAT_SOURCE = "mat_roots.json"
+STATUS_REQ_CODES = [
+    ("иноагент", "RF_255_MENTION_LABEL"),
+    ("иностран", "RF_255_MENTION_LABEL"),
+    ("террорист", "RF_114_MEDIA_BAN"),
+    ("экстремист", "RF_114_MEDIA_BAN"),
+]
+MIN_NAME_LEN = 3
+
+# Приставки, после которых корень мата все еще считается началом слова (за-, на-, вы- ...)
+MAT_PREFIXES = ["вы", "за", "на", "от", "отъ", "по", "у", "съ", "разъ", "до", "при", "пере",
+                "про", "подъ", "объ", "о", "изъ", "въ", "недо", "наи"]
+# Падежные окончания, с которыми имя из реестра еще считается совпадением (Навального, Азовом)
+NAME_ENDINGS = {"а", "у", "е", "ы", "и", "ом", "ой", "ем", "ам", "ами", "ах", "ов", "ого", "ому",
+                "ым", "им", "ий", "ая", "ую"}
+
+# Латиница и цифры, которыми маскируют кириллицу ("xyй", "3ло", "п0рн")
+_LOOKALIKES = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "o": "о", "p": "р",
+    "t": "т", "x": "х", "y": "у", "u": "и", "3": "з", "0": "о", "6": "б", "@": "а",
+})
+_CYRILLIC = re.compile(r"[а-я]")
+_LATIN_OR_DIGIT = re.compile(r"[a-z0-9@]")
+_TOKEN = re.compile(r"[\w@*]+(?:[._\-][\w@*]+)*")
+# Точка/дефис/подчеркивание между буквами ("х.у.й") и повторы букв ("дааа")
+_INNER_SEPARATOR = re.compile(r"(?<=[^\W\d_])[._\-](?=[^\W\d_])")
+_REPEATS = re.compile(r"([^\W\d_])\1+")
+_WORD = re.compile(r"[^\W_]+")
+
+
+def _is_letter(ch: str) -> bool:
+    return ch.isalpha()
+
+
+def _drop_spans(text: str, index_map: list, spans):
+    """Вырезает куски текста, сохраняя соответствие позиций исходнику."""
+    if not spans:
+        return text, index_map
+    parts, maps, pos = [], [], 0
+    for start, end in spans:
+        parts.append(text[pos:start])
+        maps.extend(index_map[pos:start])
+        pos = end
+    parts.append(text[pos:])
+    maps.extend(index_map[pos:])
+    return "".join(parts), maps
+
+
+def normalize(text: str):
+    """
+    Нормализация текста и шаблонов одним и тем же способом:
+    регистр, ё->е, латиница/цифры внутри кириллических слов -> кириллица,
+    точки/дефисы внутри слова убираются ("х.у.й"), повторы букв схлопываются ("дааа").
+    Возвращает (нормализованный_текст, index_map): index_map[i] - позиция символа в исходном тексте.
+    """
+    lowered = text.lower().replace("ё", "е")
+    # Замены посимвольные, длина не меняется - index_map пока тождественный
+    pieces, pos = [], 0
+    for m in _TOKEN.finditer(lowered):
+        token = m.group(0)
+        if _LATIN_OR_DIGIT.search(token) and _CYRILLIC.search(token):
+            pieces.append(lowered[pos:m.start()])
+            pieces.append(token.translate(_LOOKALIKES))
+            pos = m.end()
+    if pieces:
+        pieces.append(lowered[pos:])
+        lowered = "".join(pieces)
+
+    norm, index_map = lowered, list(range(len(lowered)))
+    norm, index_map = _drop_spans(norm, index_map, [m.span() for m in _INNER_SEPARATOR.finditer(norm)])
+    norm, index_map = _drop_spans(norm, index_map, [(m.start() + 1, m.end()) for m in _REPEATS.finditer(norm)])
+    return norm, index_map
+
+
+class AhoCorasick:
+    """Классический автомат: бор + суффиксные ссылки, поиск всех шаблонов за один проход."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pid, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(pid)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if self.goto[f].get(ch, 0) != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def iter(self, text: str):
+        """(end_index, pattern_id) для каждого вхождения; end_index - исключительно."""
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for pid in out[node]:
+                yield i + 1, pid
+
+
+def _req_code_for_status(status: str) -> str:
+    status = (status or "").lower()
+    for marker, code in STATUS_REQ_CODES:
+        if marker in status:
+            return code
+    return "RF_114_MEDIA_BAN"
+
+
+def _split_name(name: str):
+    """'ФБК (Фонд борьбы с коррупцией)' -> ['ФБК', 'Фонд борьбы с коррупцией']."""
+    parts = [name.split("(")[0]] + re.findall(r"\(([^)]*)\)", name)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _load_json(filename: str):
+    path = os.path.join(REGISTRIES_DIR, filename)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Lexicon Source Error ({filename}): {e}")
+        return []
+
+
+def load_entries(name_sources=None):
+    """
+    Шаблоны из словарей: {"term", "match", "category", "req_code", "source"}.
+    name_sources - какие реестры имен читать из JSON (по умолчанию все NAME_SOURCES).
+    """
+    entries = []
+    for source in NAME_SOURCES if name_sources is None else name_sources:
+        for item in _load_json(source):
+            if isinstance(item, str):
+                item = {"name": item}
+            if not isinstance(item, dict):
+                continue
+            names = [item.get("name"), item.get("official_name"), *(item.get("aliases") or [])]
+            for name in filter(None, names):
+                for term in _split_name(name):
+                    if len(term) >= MIN_NAME_LEN:
+                        entries.append({
+                            "term": term, "match": "name",
+                            "category": item.get("status") or "Реестр",
+                            "req_code": _req_code_for_status(item.get("status")),
+                            "source": source,
+                        })
+    for item in _load_json(MAT_SOURCE):
+        entries.append({
+            "term": item["root"], "match": item.get("match", "prefix"),
+            "category": "Мат", "req_code": item.get("req_code", "DICT_MAT_ROOTS_OBSCENE"),
+            "source": MAT_SOURCE,
+        })
+    return entries
+
+
+class Lexicon:
+    def __init__(self, entries, names=None, index=None, index_sources=()):
+        self.entries = []
+        # Нечеткий поиск иноагентов (name_matcher.NameMatcher) поверх точных совпадений
+        self.names = names
+        # Индекс реестров (registry_index.RegistryIndex) и реестры имен, которые ищутся по нему
+        self.index = index
+        self.index_sources = set(index_sources) if index is not None else set()
+        patterns = []
+        seen = set()
+        for e in entries:
+            norm, _ = normalize(e["term"])
+            key = (norm, e["match"], e["req_code"])
+            if not norm or key in seen:
+                continue
+            seen.add(key)
+            self.entries.append({**e, "norm": norm})
+            patterns.append(norm)
+        self.automaton = AhoCorasick(patterns)
+        self._prefixes = {normalize(p)[0] for p in MAT_PREFIXES}
+
+    def __len__(self):
+        return len(self.entries) + (len(self.index) if self.index_sources else 0)
+
+    def _index_matches(self, norm: str):
+        """
+        Имена из индекса реестров: (start, end, payload) в координатах norm.
+        Фраза из подряд идущих слов (через пробелы) удлиняется, пока в индексе есть ключи
+        с таким началом; последнее слово может иметь падежное окончание (Навальному).
+        """
+        words = list(_WORD.finditer(norm))
+        lookups, prefixes = {}, {}
+
+        def lookup(key):
+            if key not in lookups:
+                lookups[key] = [p for p in self.index.lookup_key(key) if p.get("source") in self.index_sources]
+            return lookups[key]
+
+        def has_prefix(key):
+            if key not in prefixes:
+                prefixes[key] = self.index.has_prefix(key)
+            return prefixes[key]
+
+        for i, first in enumerate(words):
+            phrase = ""
+            for j in range(i, min(len(words), i + (self.index.max_words or 1))):
+                if j > i and not norm[words[j - 1].end():words[j].start()].isspace():
+                    break
+                word = words[j].group(0)
+                phrase = f"{phrase} {word}" if phrase else word
+                candidates = [(phrase, words[j].end())]
+                if _CYRILLIC.search(word[-1]):
+                    # "навальному" -> "навальн" + "ому": ключ без окончания, цитата - целое слово
+                    candidates += [(phrase[:-len(e)], words[j].end()) for e in NAME_ENDINGS
+                                   if word.endswith(e) and len(word) > len(e)]
+                for key, end in candidates:
+                    if len(key) < MIN_NAME_LEN:
+                        continue
+                    for payload in lookup(key):
+                        yield first.start(), end, payload
+                # Дальше удлинять фразу, только если в индексе есть ключи длиннее
+                if not has_prefix(f"{phrase} "):
+                    break
+
+    def _word_start(self, text: str, start: int) -> bool:
+        return start == 0 or not _is_letter(text[start - 1])
+
+    def _accept(self, entry: dict, text: str, start: int, end: int) -> bool:
+        mode = entry["match"]
+        if mode == "substring":
+            return True
+        if mode == "prefix":
+            if self._word_start(text, start):
+                return True
+            # Корень после приставки: "за|еб...", "отъ|еб..."
+            return any(start >= len(p) and text[start - len(p):start] == p
+                       and self._word_start(text, start - len(p)) for p in self._prefixes)
+        if not self._word_start(text, start):
+            return False
+        # Конец слова: сразу, либо (для кириллических имен) после падежного окончания
+        tail_end = end
+        while tail_end < len(text) and _is_letter(text[tail_end]):
+            tail_end += 1
+        if tail_end == end:
+            return True
+        return mode == "name" and bool(_CYRILLIC.search(entry["norm"][-1])) and text[end:tail_end] in NAME_ENDINGS
+
+    def scan(self, text: str, page: int = None):
+        """
+        Все совпадения в тексте: {"term", "category", "req_code", "source", "start", "end", "quote", "page"}.
+        start/end - смещения в символах исходного (ненормализованного) текста.
+        """
+        norm, index_map = normalize(text)
+        hits = []
+        for end, pid in self.automaton.iter(norm):
+            entry = self.entries[pid]
+            start = end - len(entry["norm"])
+            if not self._accept(entry, norm, start, end):
+                continue
+            # Цитата - целое слово исходного текста, а не только корень
+            o_start, o_end = index_map[start], index_map[end - 1] + 1
+            while o_start > 0 and _is_letter(text[o_start - 1]):
+                o_start -= 1
+            while o_end < len(text) and _is_letter(text[o_end]):
+                o_end += 1
+            hits.append({
+                "term": entry["term"], "category": entry["category"], "req_code": entry["req_code"],
+                "source": entry["source"], "start": o_start, "end": o_end,
+                "quote": text[o_start:o_end], "page": page,
+            })
+        if self.index_sources:
+            for start, end, payload in self._index_matches(norm):
+                o_start, o_end = index_map[start], index_map[end - 1] + 1
+                while o_start > 0 and _is_letter(text[o_start - 1]):
+                    o_start -= 1
+                while o_end < len(text) and _is_letter(text[o_end]):
+                    o_end += 1
+                status = payload.get("status")
+                hits.append({
+                    "term": payload.get("name") or payload.get("text"), "category": status or "Реестр",
+                    "req_code": _req_code_for_status(status), "source": payload["source"],
+                    "start": o_start, "end": o_end, "quote": text[o_start:o_end], "page": page,
+                })
+        # Несколько корней внутри одного слова - одно совпадение
+        unique = {}
+        for h in hits:
+            unique.setdefault((h["start"], h["end"], h["req_code"]), h)
+        if self.names is not None:
+            # Нечеткое совпадение нужно только там, где точного нет
+            exact = list(unique.values())
+            for h in self.names.scan(text, page=page):
+                if not any(h["start"] < e["end"] and e["start"] < h["end"] for e in exact):
+                    unique.setdefault((h["start"], h["end"], h["req_code"]), h)
+        return sorted(unique.values(), key=lambda h: h["start"])
+
+
+def build_lexicon() -> Lexicon:
+    """
+    Лексикон из текущих реестров: имена - по mmap-индексу (registry_index), мат - автоматом,
+    плюс нечеткий поиск имен. Индекса нет и собрать его не вышло - все из JSON, как раньше.
+    """
+    # name_matcher и registry_index сами импортируют lexicon, поэтому импорт здесь
+    from name_matcher import NameMatcher, load_records
+    from registry_index import ensure_index, SOURCES as INDEX_SOURCES
+    index = ensure_index()
+    index_sources = [s for s in NAME_SOURCES if s in INDEX_SOURCES] if index is not None else []
+    names = NameMatcher(load_records(index=index))
+    lexicon = Lexicon(load_entries([s for s in NAME_SOURCES if s not in index_sources]), names=names,
+                      index=index, index_sources=index_sources)
+    print(f"📚 Лексикон собран: {len(lexicon.entries)} шаблонов в автомате, "
+          f"{len(index) if index is not None else 0} ключей в индексе, {len(names)} имен для нечеткого поиска")
+    return lexicon
+
+
+def get_lexicon() -> Lexicon:
+    """Лексикон активной версии конфигурации: собирается один раз на версию (см. reloader)."""
+    from reloader import current
+    return current().lexicon
+
+
+def to_evidence(hits, start_ms: int = 0, end_ms: int = None, prefix: str = "lex"):
+    """Совпадения -> элементы evidence (схема EvidenceItem)."""
+    evidence = []
+    for i, h in enumerate(hits):
+        where = f"стр. {h['page']}, " if h.get("page") else ""
+        evidence.append({
+            "id": f"{prefix}_{i + 1}",
+            "type": "transcript_span",
+            "start_ms": h.get("start_ms", start_ms),
+            "end_ms": h.get("end_ms", start_ms if end_ms is None else end_ms),
+            "text_quote": h["quote"],
+            "notes": f"Словарь: {h['category']} [{h['req_code']}] ({where}символы {h['start']}-{h['end']})"
+                     + (f", похоже на «{h['term']}» ({h['score']})" if "score" in h else ""),
+        })
+    return evidence
+
+
+def format_hints(hits, limit: int = 50) -> str:
+    """Подсказка для промпта: что уже нашел словарь (модель проверяет контекст)."""
+    if not hits:
+        return ""
+    lines = []
+    for h in hits[:limit]:
+        where = f" (стр. {h['page']})" if h.get("page") else ""
+        similar = f" (похоже на «{h['term']}», {h['score']})" if "score" in h else ""
+        lines.append(f"- «{h['quote']}» -> {h['category']} [{h['req_code']}]{similar}{where}")
+    more = f"\n... и еще {len(hits) - limit}" if len(hits) > limit else ""
+    return ("ЛЕКСИЧЕСКИЙ ПРЕСКРИНИНГ (словарное совпадение без учета контекста - "
+            "подтверди или отклони каждое):\n" + "\n".join(lines) + more)
+
+
+def scan_report(report: dict, lexicon=None):
+    """Проход по репликам, которые модель процитировала в evidence (транскрипт)."""
+    lexicon = lexicon or get_lexicon()
+    hits = []
+    for ev in report.get("evidence", []):
+        if ev.get("type") != "transcript_span" or not ev.get("text_quote"):
+            continue
+        for h in lexicon.scan(ev["text_quote"]):
+            hits.append({**h, "start_ms": ev.get("start_ms") or 0, "end_ms": ev.get("end_ms") or 0})
+    return hits
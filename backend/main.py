@@ -1,7 +1,9 @@
 import os
+import uuid
 import shutil
 import google.generativeai as genai
-from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, Header, HTTPException, Form, Request
+from starlette.concurrency import run_in_threadpool
 from celery.result import AsyncResult
 from tasks import analyze_media_task
 from pydantic import BaseModel
@@ -9,12 +11,30 @@ from typing import List, Dict, Any, Optional
 from sqlalchemy import text # Используем прямой SQL для надежности
 from database import SessionLocal
 from tasks import get_embedding
+from redis_helper import get_metrics, request_cancel
+from checkpoint import resume_status
+import upload_sessions
+from lexicon import get_lexicon, to_evidence, format_hints
+from documents import prescreen_file
+import updater
+import file_registry
+import policy_index
+import reloader
+from registry_index import ensure_index
+from upload_sessions import UploadError
 
 app = FastAPI(title="AI-Lawyer Enterprise Backend")
 
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+@app.on_event("startup")
+def start_registry_updates():
+    # Реестры обновляются по расписанию (REGISTRY_UPDATE_HOURS, 0 - выключить)
+    app.state.registry_scheduler = updater.start_scheduler()
+    # Уборка файлов Gemini из реестра повторного использования (GEMINI_FILE_SWEEP_MIN, 0 - выключить)
+    app.state.file_sweeper = file_registry.start_sweeper()
+
 # --- МОДЕЛИ ДАННЫХ ---
 
 # Обновленная модель для сохранения правки
@@ -28,6 +48,19 @@ class VerificationRequest(BaseModel):
 class ApiKeyRequest(BaseModel):
     api_key: str
 
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+
+class FinalizeUploadRequest(BaseModel):
+    model_name: str = "gemini-1.5-flash"
+    profile: str = "ntv"
+    use_cache: bool = True  # False - пересчитать, даже если такой отчет уже есть
+    reuse_duplicates: bool = False  # True - взять отчет почти-дубликата (перезаливки)
+    analysis_mode: str = "full"  # full - один запрос, windowed - окна, keyframes - кадры сцен + аудио
+    trim_silence: bool = False  # True - вырезать тишину из аудио перед анализом
+    cue_sheet: bool = False  # True - вся музыка по таймкодам (Shazam по окнам), а не один трек
+
 # --- ЭНДПОИНТЫ ---
 
 @app.post("/list-models")
@@ -49,31 +82,209 @@ async def start_analysis(
     original_filename: str = Form(None),
     model_name: str = Form("gemini-1.5-flash"),
     profile: str = Form("ntv"), # <--- НОВОЕ ПОЛЕ
+    use_cache: bool = Form(True),
+    reuse_duplicates: bool = Form(False),
+    analysis_mode: str = Form("full"),
+    trim_silence: bool = Form(False),
+    cue_sheet: bool = Form(False),
     x_api_key: str = Header(..., alias="X-API-Key")
 ):
     try:
         real_name = original_filename if original_filename else file.filename
-        save_path = os.path.join(UPLOAD_DIR, file.filename)
+        # Уникальное имя: фронтенд всегда шлет "input_file.<ext>"
+        ext = os.path.splitext(file.filename)[1].lower()
+        save_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}{ext}")
+        # Копирование в пуле потоков, чтобы не блокировать event loop
         with open(save_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+            await run_in_threadpool(shutil.copyfileobj, file.file, buffer, 4 * 1024 * 1024)
 
-        task = analyze_media_task.delay(save_path, real_name, x_api_key, model_name, profile)
+        task = analyze_media_task.delay(save_path, real_name, x_api_key, model_name, profile, use_cache=use_cache,
+                                        reuse_duplicates=reuse_duplicates,
+                                        analysis_mode=analysis_mode, trim_silence=trim_silence,
+                                        cue_sheet=cue_sheet)
         return {"task_id": task.id, "status": "Queued"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- ЗАГРУЗКА ПО КУСКАМ (для многогигабайтных мастеров) ---
+
+def _upload_error(e: UploadError):
+    detail = {"error": e.detail}
+    if e.offset is not None:
+        detail["offset"] = e.offset
+    return HTTPException(status_code=e.status_code, detail=detail)
+
+@app.post("/uploads")
+async def create_upload(req: UploadSessionRequest):
+    if req.size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    meta = upload_sessions.create_session(req.filename, req.size)
+    return {"upload_id": meta["upload_id"], "offset": 0, "chunk_size": upload_sessions.CHUNK_SIZE}
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    # Клиент после обрыва спрашивает, с какого байта продолжать
+    try:
+        meta = upload_sessions.load_session(upload_id)
+    except UploadError as e:
+        raise _upload_error(e)
+    return {"upload_id": upload_id, "offset": meta["offset"], "size": meta["size"]}
+
+@app.put("/uploads/{upload_id}")
+async def put_upload_range(upload_id: str, request: Request, content_range: str = Header(...)):
+    try:
+        start, _, total = upload_sessions.parse_content_range(content_range)
+        meta = await upload_sessions.write_range(upload_id, start, total, request.stream())
+    except UploadError as e:
+        raise _upload_error(e)
+    return {"upload_id": upload_id, "offset": meta["offset"], "size": meta["size"]}
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, req: FinalizeUploadRequest, x_api_key: str = Header(..., alias="X-API-Key")):
+    # Задача ставится в очередь только когда все байты на диске
+    try:
+        save_path, content_hash, meta = await upload_sessions.finalize(upload_id)
+    except UploadError as e:
+        raise _upload_error(e)
+
+    task = analyze_media_task.delay(save_path, meta["filename"], x_api_key, req.model_name, req.profile,
+                                    content_hash=content_hash, use_cache=req.use_cache,
+                                    reuse_duplicates=req.reuse_duplicates,
+                                    analysis_mode=req.analysis_mode, trim_silence=req.trim_silence,
+                                    cue_sheet=req.cue_sheet)
+    return {"task_id": task.id, "status": "Queued", "sha256": content_hash}
+
 @app.get("/status/{task_id}")
 async def get_task_status(task_id: str):
     task_result = AsyncResult(task_id)
     response = {"task_id": task_id, "state": task_result.state}
     if task_result.state == 'PROGRESS':
         response["status"] = task_result.info.get('status', 'Processing...')
+        if task_result.info.get('progress'):
+            response["progress"] = task_result.info['progress']
+    elif task_result.state == 'RETRY':
+        # Пауза по квоте Gemini (время продолжения - в чекпоинте) или ожидание такой же задачи
+        response["status"] = resume_status(task_id) or (str(task_result.info) if task_result.info else "Повтор задачи...")
     elif task_result.state == 'SUCCESS':
         response["result"] = task_result.result
     elif task_result.state == 'FAILURE':
         response["error"] = str(task_result.result)
     return response
 
+@app.post("/prescreen")
+async def prescreen(file: UploadFile = File(None), text: str = Form(None)):
+    """
+    Быстрый словарный проход без модели: документ, субтитры (.srt/.vtt), .txt или просто текст.
+    Возвращает evidence в формате отчета и подсказку, которую можно подмешать в промпт.
+    """
+    if file is None and not text:
+        raise HTTPException(status_code=400, detail="Provide file or text")
+    lexicon = await run_in_threadpool(get_lexicon)
+    if file is None:
+        hits = await run_in_threadpool(lexicon.scan, text)
+    else:
+        ext = os.path.splitext(file.filename or "")[1].lower()
+        tmp_path = os.path.join(UPLOAD_DIR, f"prescreen_{uuid.uuid4()}{ext}")
+        try:
+            with open(tmp_path, "wb") as buffer:
+                await run_in_threadpool(shutil.copyfileobj, file.file, buffer, 4 * 1024 * 1024)
+            hits = await run_in_threadpool(prescreen_file, tmp_path, lexicon)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Prescreen failed: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return {"hits": len(hits), "evidence": to_evidence(hits), "hints": format_hints(hits)}
+
+@app.get("/registries")
+async def registries_status():
+    # Версии реестров, ETag и последний дифф (добавлено / удалено / изменено)
+    return await run_in_threadpool(updater.load_state)
+
+@app.post("/registries/update")
+async def registries_update():
+    result = await run_in_threadpool(updater.locked_update)
+    if result is None:
+        raise HTTPException(status_code=409, detail="Registry update already running")
+    return result
+
+@app.get("/registries/lookup")
+async def registries_lookup(name: str, fuzzy: bool = False):
+    if fuzzy:
+        # Иноагенты с учетом падежей, инициалов и латиницы: кандидаты по убыванию сходства
+        lexicon = await run_in_threadpool(get_lexicon)
+        matches = await run_in_threadpool(lexicon.names.match, name)
+        return {"name": name, "found": bool(matches), "matches": matches}
+    # Точная проверка имени по скомпилированному индексу (mmap, страницы общие с воркерами)
+    index = await run_in_threadpool(ensure_index)
+    if index is None:
+        raise HTTPException(status_code=503, detail="Registry index not built")
+    matches = await run_in_threadpool(index.lookup, name)
+    return {"name": name, "found": bool(matches), "matches": matches}
+
+@app.get("/reload")
+async def reload_status():
+    # Активная версия реестров/таксономии в этом процессе и последняя объявленная
+    return await run_in_threadpool(reloader.status)
+
+def embed_policies(api_key: str) -> int:
+    db = SessionLocal()
+    try:
+        return policy_index.embed_missing(db, api_key)
+    finally:
+        db.close()
+
+@app.post("/reload")
+async def reload_config(reason: str = "manual", x_api_key: Optional[str] = Header(None, alias="X-API-Key")):
+    """
+    Новая версия конфигурации (после сидов политик/таксономии или ручной правки реестров):
+    воркеры пересоберут снимок перед следующей задачей, текущие задачи доработают на старом.
+    С X-API-Key заодно считаются эмбеддинги новых и измененных политик (иначе - в первой задаче).
+    """
+    embedded = None
+    if x_api_key:
+        try:
+            embedded = await run_in_threadpool(embed_policies, x_api_key)
+        except Exception as e:
+            print(f"⚠️ Policy Embedding Error: {e}")
+    version = await run_in_threadpool(reloader.bump, reason)
+    if not version:
+        raise HTTPException(status_code=503, detail="Redis unavailable")
+    return {"version": version, "policies_embedded": embedded}
+
+@app.post("/cancel/{task_id}")
+async def cancel_task(task_id: str):
+    # Флаг для уже работающей задачи (воркер остановит ffmpeg и почистит файлы)
+    # + revoke, чтобы задача из очереди вообще не стартовала
+    try:
+        await run_in_threadpool(request_cancel, task_id)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Cancel flag not set: {e}")
+    AsyncResult(task_id).revoke()
+    return {"task_id": task_id, "status": "Cancelling"}
+
+@app.get("/metrics")
+async def get_pipeline_metrics():
+    # Счетчики конвейера: пути сжатия (copy/audio/encode), сэкономленное время, кэши
+    results = get_metrics("result_cache")
+    lookups = results.get("hit", 0) + results.get("shared", 0) + results.get("miss", 0)
+    results["hit_rate"] = round((results.get("hit", 0) + results.get("shared", 0)) / lookups, 3) if lookups else 0.0
+    # Лимит Gemini: доля времени в очереди от времени запросов (ожидание / (ожидание + вызов))
+    limits = get_metrics("ratelimit")
+    for kind in ("generate", "upload", "embed"):
+        busy = limits.get(f"{kind}_wait_s", 0) + limits.get(f"{kind}_call_s", 0)
+        if busy:
+            limits[f"{kind}_wait_share"] = round(limits.get(f"{kind}_wait_s", 0) / busy, 3)
+    return {
+        "transcode": get_metrics("transcode"),
+        "transcode_cache": get_metrics("transcode_cache"),
+        "result_cache": results,
+        "payload": get_metrics("payload"),
+        "ratelimit": limits,
+        "gemini_files": get_metrics("gemini_files"),
+        "policies": get_metrics("policies"),
+    }
+
 @app.put("/verify")
 async def verify_analysis(req: VerificationRequest, x_api_key: str = Header(..., alias="X-API-Key")):
     try:
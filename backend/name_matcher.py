@@ -0,0 +1,330 @@
+# backend/name_matcher.py
+import os
+import re
+import math
+import json
+from itertools import chain
+
+from lexicon import normalize, REGISTRIES_DIR, _split_name, _req_code_for_status
+
+# Нечеткий поиск иноагентов: в речи и титрах имя почти никогда не совпадает с реестром
+# буква в букву ("Навального", "А. Навальный", "Navalny"). Имя приводится к основам
+# (транслитерация, без падежных окончаний), основы сравниваются по символьным триграммам.
+#
+# Индекс двухуровневый: (первая буква, триграмма) -> основы словаря, основа -> записи реестра.
+# Кандидаты в записи берутся только по "редким" основам (фамилии, названия), поэтому
+# частые имена ("Алексей", "Фонд") не заставляют перебирать тысячи записей.
+SOURCES = ["foreign_agents.json", "blacklist.json"]
+MIN_SCORE = float(os.getenv("NAME_MATCH_MIN_SCORE", "0.6"))
+# Минимальное сходство двух основ (коэффициент Дайса по триграммам)
+TOKEN_MIN_SIM = float(os.getenv("NAME_MATCH_TOKEN_SIM", "0.7"))
+# Основа "редкая", если встречается не более чем в стольких записях (или 0.2% реестра)
+DISTINCT_MAX_DF = int(os.getenv("NAME_MATCH_DISTINCT_DF", "50"))
+# Вес несовпавшей основы записи относительно совпавшей
+UNMATCHED_PENALTY = 0.3
+TOP_K = 5
+
+# Латиница -> кириллица (сначала длинные сочетания)
+_TRANSLIT = [
+    ("shch", "щ"), ("sch", "щ"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"), ("ch", "ч"), ("sh", "ш"),
+    ("yu", "ю"), ("ju", "ю"), ("ya", "я"), ("ja", "я"), ("yo", "е"), ("ye", "е"), ("yy", "ый"),
+    ("iy", "ий"), ("ei", "ей"), ("x", "кс"), ("w", "в"), ("q", "к"), ("j", "й"),
+    ("a", "а"), ("b", "б"), ("c", "к"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"), ("h", "х"),
+    ("i", "и"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"), ("r", "р"),
+    ("s", "с"), ("t", "т"), ("u", "у"), ("v", "в"), ("z", "з"),
+]
+_TRANSLIT_RE = re.compile("|".join(re.escape(lat) for lat, _ in _TRANSLIT) + "|y")
+_TRANSLIT_MAP = dict(_TRANSLIT)
+_VOWELS = set("аеиоуыэюя")
+
+# Падежные окончания (длинные раньше). Суффиксы фамилий -ов/-ев/-ин не трогаем:
+# "Иванова", "Иванову", "Ивановым" -> "иванов"
+_CASE_ENDINGS = sorted([
+    "ого", "его", "ому", "ему", "ыми", "ими", "ами", "ями", "ой", "ей", "ий", "ый", "ая", "яя",
+    "ое", "ее", "ую", "юю", "ым", "им", "ом", "ем", "ам", "ям", "ах", "ях", "а", "я", "у", "ю",
+    "е", "ы", "и", "ь",
+], key=len, reverse=True)
+MIN_STEM = 3
+# Латиница неоднозначна (y -> ы/и/й), поэтому эти буквы сводятся к одной
+_FOLD = str.maketrans({"ь": None, "ъ": None, "й": "и", "ы": "и", "э": "е"})
+_STOPWORDS = {"и", "в", "во", "с", "со", "по", "на", "за", "для", "of", "the"}
+
+# Кандидаты в тексте: подряд идущие слова с заглавной буквы и инициалы ("А.", "А.А.")
+_NAME_TOKEN = r"(?:[A-ZА-ЯЁ](?:\.\s?[A-ZА-ЯЁ])*\.|[A-ZА-ЯЁ][a-zа-яё]+(?:-[A-ZА-ЯЁ]?[a-zа-яё]+)?)"
+_CANDIDATE = re.compile(rf"{_NAME_TOKEN}(?:\s+{_NAME_TOKEN}){{0,3}}")
+_WORD = re.compile(_NAME_TOKEN)
+
+
+def transliterate(token: str) -> str:
+    """Латинское написание -> кириллица (Navalny, Navalnyy, Aleksei)."""
+    def replace(m):
+        lat = m.group(0)
+        if lat == "y":
+            # y после гласной - й (Aleksey), иначе ы (Navalny)
+            prev = token[m.start() - 1] if m.start() else ""
+            return "й" if _TRANSLIT_MAP.get(prev, prev) in _VOWELS else "ы"
+        return _TRANSLIT_MAP[lat]
+    return _TRANSLIT_RE.sub(replace, token)
+
+
+def stem(token: str) -> str:
+    """Основа слова без падежного окончания; мягкий знак, й, э сведены к одному написанию."""
+    for ending in _CASE_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM:
+            token = token[:-len(ending)]
+            break
+    return token.translate(_FOLD)
+
+
+def name_tokens(name: str):
+    """
+    Имя -> (основы, инициалы). "А. Навального" -> (["навальн"], ["а"]);
+    "Navalny Alexei" -> (["навалн", "алекс"], []).
+    """
+    # "А.Навальный": без пробела normalize склеил бы инициал с фамилией
+    norm, _ = normalize(re.sub(r"\.(?=\S)", ". ", name))
+    stems, initials = [], []
+    for word in re.findall(r"[^\W\d_]+\.?", norm):
+        letters = word.rstrip(".")
+        if re.search(r"[a-z]", letters):
+            letters = transliterate(letters)
+        if word.endswith(".") and len(letters) <= 2:
+            initials.append(letters[0].translate(_FOLD) or letters[0])
+        elif letters in _STOPWORDS:
+            continue
+        elif len(letters) == 1:
+            initials.append(letters.translate(_FOLD) or letters)
+        else:
+            stems.append(stem(letters))
+    return stems, initials
+
+
+def trigrams(token: str) -> frozenset:
+    padded = f" {token} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameMatcher:
+    def __init__(self, records):
+        """records: [{"name", "status", "req_code", "source"}] - по записи на имя/алиас."""
+        self.entries = []
+        self.vocab = []                 # основа -> id
+        self._vocab_ids = {}
+        self._vocab_grams = []          # id -> триграммы основы
+        self._postings = []             # id основы -> [id записей]
+        seen = set()
+        for record in records:
+            stems, _ = name_tokens(record["name"])
+            key = (tuple(stems), record["req_code"])
+            if not stems or key in seen:
+                continue
+            seen.add(key)
+            entry_id = len(self.entries)
+            token_ids = []
+            for s in stems:
+                vid = self._vocab_ids.get(s)
+                if vid is None:
+                    vid = self._vocab_ids[s] = len(self.vocab)
+                    self.vocab.append(s)
+                    self._vocab_grams.append(trigrams(s))
+                    self._postings.append([])
+                if not self._postings[vid] or self._postings[vid][-1] != entry_id:
+                    self._postings[vid].append(entry_id)
+                token_ids.append(vid)
+            self.entries.append({**record, "tokens": token_ids})
+
+        # Вес основы - IDF по записям: фамилия весит больше, чем "Алексей"
+        n = max(len(self.entries), 1)
+        self._idf = [math.log(1 + n / len(p)) for p in self._postings]
+        self._distinct_df = max(DISTINCT_MAX_DF, int(n * 0.002))
+
+        # Блокировка по первой букве: при склонении и транслитерации она не меняется
+        # (й/ы/э уже сведены), а сравнивать приходится в десятки раз меньше основ
+        self._gram_index = {}
+        for vid, grams in enumerate(self._vocab_grams):
+            first = self.vocab[vid][0]
+            for g in grams:
+                self._gram_index.setdefault((first, g), []).append(vid)
+        self._similar_cache = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def similar_stems(self, token: str):
+        """[(id_основы, сходство)] для основ словаря с Дайсом >= TOKEN_MIN_SIM."""
+        cached = self._similar_cache.get(token)
+        if cached is not None:
+            return cached
+        grams = trigrams(token)
+        # Счетчик общих триграмм только внутри блока с той же первой буквой
+        index = self._gram_index
+        first = token[0]
+        size = len(grams)
+        # Префиксный фильтр: Дайс >= t требует хотя бы t*|Q|/(2-t) общих триграмм, поэтому
+        # кандидатов достаточно собрать по |Q| - min_common + 1 самым редким триграммам
+        min_common = math.ceil(TOKEN_MIN_SIM * size / (2 - TOKEN_MIN_SIM))
+        ordered = sorted(grams, key=lambda g: len(index.get((first, g), ())))
+        candidates = set(chain.from_iterable(index.get((first, g), ()) for g in ordered[:size - min_common + 1]))
+        result = []
+        for vid in candidates:
+            vgrams = self._vocab_grams[vid]
+            sim = 2 * len(grams & vgrams) / (size + len(vgrams))
+            if sim >= TOKEN_MIN_SIM:
+                result.append((vid, sim))
+        if len(self._similar_cache) > 100000:
+            self._similar_cache.clear()
+        self._similar_cache[token] = result
+        return result
+
+    def _score(self, entry, matches, initials):
+        """
+        Доля веса записи, покрытая упоминанием. Несовпавшие основы записи штрафуют слабо
+        (упоминание только по фамилии - норма), совместимые с инициалами - еще слабее.
+        Слово упоминания, похожее на другое имя из словаря ("Иван" при записи "Петров Алексей"),
+        штрафует полным весом - это скорее однофамилец. Возвращает (score, индексы совпавших слов упоминания) или None.
+        """
+        used_words = set()
+        matched_weight = covered = missing = 0.0
+        spare_initials = list(initials)
+        top_idf = max(self._idf[vid] for vid in entry["tokens"])
+        distinctive = False
+        unfilled = False
+        matched_at = []
+        for position, vid in enumerate(entry["tokens"]):
+            best = None
+            for word_i, sims in matches:
+                if word_i not in used_words and vid in sims and (best is None or sims[vid] > best[1]):
+                    best = (word_i, sims[vid])
+            weight = self._idf[vid]
+            if best:
+                used_words.add(best[0])
+                matched_weight += weight * best[1]
+                covered += weight
+                matched_at.append(position)
+                # Совпасть должно самое редкое слово записи (фамилия, а не "Юрий")
+                distinctive = distinctive or weight >= 0.9 * top_idf
+            elif self.vocab[vid][:1] in spare_initials:
+                spare_initials.remove(self.vocab[vid][:1])
+                missing += UNMATCHED_PENALTY / 2 * weight
+            else:
+                missing += UNMATCHED_PENALTY * weight
+                unfilled = True
+        # Совпали только частые слова ("Алексей") или инициал противоречит записи
+        if not distinctive or spare_initials:
+            return None
+        # В малом реестре IDF у имени и фамилии одинаковый: одно слово многословной записи
+        # засчитываем, только если это фамилия - первое слово ("Фамилия Имя Отчество")
+        if len(entry["tokens"]) > 1 and matched_at != [0] and len(matched_at) < 2:
+            return None
+        if unfilled:
+            for word_i, sims in matches:
+                if word_i not in used_words:
+                    missing += max(self._idf[vid] for vid in sims)
+        return matched_weight / (covered + missing), used_words
+
+    def _match_tokens(self, stems, initials, top_k):
+        matches = []
+        candidates = set()
+        for word_i, token in enumerate(stems):
+            sims = dict(self.similar_stems(token))
+            if not sims:
+                continue
+            matches.append((word_i, sims))
+            for vid in sims:
+                if len(self._postings[vid]) <= self._distinct_df:
+                    candidates.update(self._postings[vid])
+        ranked = []
+        for entry_id in candidates:
+            scored = self._score(self.entries[entry_id], matches, initials)
+            if scored and scored[0] >= MIN_SCORE:
+                ranked.append((scored[0], entry_id, scored[1]))
+        ranked.sort(key=lambda r: (-r[0], r[1]))
+        return ranked[:top_k]
+
+    def match(self, name: str, top_k: int = TOP_K):
+        """Ранжированные кандидаты из реестра: [{"name", "status", "req_code", "source", "score"}]."""
+        stems, initials = name_tokens(name)
+        result = []
+        for score, entry_id, _ in self._match_tokens(stems, initials, top_k):
+            entry = self.entries[entry_id]
+            result.append({k: entry[k] for k in ("name", "status", "req_code", "source")} | {"score": round(score, 3)})
+        return result
+
+    def scan(self, text: str, page: int = None):
+        """Упоминания имен в тексте, похожие на записи реестра - в формате совпадений Lexicon.scan."""
+        hits = []
+        for m in _CANDIDATE.finditer(text):
+            words = list(_WORD.finditer(m.group(0)))
+            stems, initials, positions = [], [], []
+            for w in words:
+                word_stems, word_initials = name_tokens(w.group(0))
+                for s in word_stems:
+                    stems.append(s)
+                    positions.append(w.span())
+                initials += word_initials
+            if not stems:
+                continue
+            ranked = self._match_tokens(stems, initials, 1)
+            if not ranked:
+                continue
+            score, entry_id, used = ranked[0]
+            entry = self.entries[entry_id]
+            # Цитата - только совпавшие слова ("Сегодня Навальный" -> "Навальный"), плюс инициалы перед ними
+            spans = [positions[i] for i in used]
+            start, end = m.start() + min(s for s, _ in spans), m.start() + max(e for _, e in spans)
+            for w in reversed(words):
+                w_start, w_end = m.start() + w.start(), m.start() + w.end()
+                if w_end > start:
+                    continue
+                if not w.group(0).endswith(".") or text[w_end:start].strip():
+                    break
+                start = w_start
+            hits.append({
+                "term": entry["name"], "category": entry["status"], "req_code": entry["req_code"],
+                "source": entry["source"], "start": start, "end": end,
+                "quote": text[start:end], "page": page, "match": "fuzzy", "score": round(score, 3),
+            })
+        return hits
+
+
+def _iter_items(sources, index=None):
+    """(источник, запись) из индекса реестров (mmap) или, если его нет, из JSON."""
+    if index is not None:
+        for payload in index.iter_payloads(set(sources)):
+            yield payload["source"], payload
+        return
+    for source in sources:
+        path = os.path.join(REGISTRIES_DIR, source)
+        if not os.path.exists(path):
+            continue
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Name Matcher Source Error ({source}): {e}")
+            continue
+        for item in items:
+            yield source, item
+
+
+def load_records(sources=None, index=None):
+    """
+    Имена и алиасы записей, требующих маркировки иноагента.
+    index - registry_index.RegistryIndex: записи берутся из него, JSON не читается.
+    """
+    records = []
+    for source, item in _iter_items(sources or SOURCES, index):
+        if isinstance(item, str):
+            item = {"name": item}
+        if not isinstance(item, dict):
+            continue
+        status = item.get("status") or ("Иноагент" if source == "foreign_agents.json" else "")
+        req_code = _req_code_for_status(status)
+        if req_code != "RF_255_MENTION_LABEL":
+            continue
+        # Строка реестра в индексе хранится как {"text": ...}
+        names = [item.get("name") or item.get("text"), item.get("official_name"), *(item.get("aliases") or [])]
+        for name in filter(None, names):
+            for part in _split_name(name):
+                records.append({"name": part, "status": status, "req_code": req_code, "source": source})
+    return records
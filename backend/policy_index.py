@@ -0,0 +1,199 @@
+# backend/policy_index.py
+import os
+import sys
+
+import numpy as np
+import google.generativeai as genai
+from sqlalchemy import text
+
+import rate_limiter
+from redis_helper import incr_metric
+from ffmpeg_helper import TranscodeCancelled
+
+# Отбор политик по смыслу вместо "все требования издателя в промпт": с каждым новым
+# сидом (реклама, дети, экстремизм, VK, Rutube...) промпт рос, а с ним время и цена
+# каждого вызова. Теперь:
+#   - у каждого legal_requirement есть эмбеддинг (колонки embedding, embedding_hash);
+#     считается при сиде/обновлении (POST /reload с X-API-Key или `python policy_index.py`),
+#     задачи анализа эмбеддинги политик не считают;
+#   - в промпт идут все обязательные требования (risk_floor из MANDATORY_RISKS -
+#     то, что ведет к P0: удаление, уголовка) и TOP_K самых близких к краткому
+#     описанию материала (по нескольким кадрам, см. quick_summary) из остальных.
+# Строка без эмбеддинга (не посчитался) попадает в промпт всегда - лучше лишнее,
+# чем пропущенное требование. Без описания материала (аудио, модель описания
+# недоступна) в промпт идут все требования: по имени файла подбирать нельзя.
+# POLICY_TOP_K=0 - старое поведение, все требования.
+EMBED_MODEL = "models/text-embedding-004"
+EMBED_BATCH = 100
+TOP_K = int(os.getenv("POLICY_TOP_K", "12"))
+MANDATORY_RISKS = {r.strip().upper() for r in os.getenv("POLICY_MANDATORY_RISKS", "CRITICAL").split(",") if r.strip()}
+# Краткое описание материала по нескольким кадрам (пусто - без него, в промпт все требования)
+SUMMARY_MODEL = os.getenv("POLICY_SUMMARY_MODEL", "gemini-1.5-flash")
+SUMMARY_FRAMES = int(os.getenv("POLICY_SUMMARY_FRAMES", "6"))
+SUMMARY_INSTRUCTION = (
+    "Кратко, в 2-3 предложениях, опиши материал для подбора применимых правил: тема, кто в кадре, "
+    "товары и бренды, символика, надписи, оружие, алкоголь, дети. Без оценок, только факты."
+)
+
+# Разобранные векторы: (req_code, embedding_hash) -> нормированный np.array
+_vectors = {}
+
+_ROW_HASH = "md5(r.summary || ':' || coalesce(r.full_text, ''))"
+
+
+def requirement_text(row) -> str:
+    return f"[{row.req_code}] {row.summary}\n{row.full_text or ''}".strip()
+
+
+def _embed_batch(texts, api_key: str):
+    genai.configure(api_key=api_key)
+    with rate_limiter.limited(api_key, "embed", kind="embed"):
+        result = genai.embed_content(model=EMBED_MODEL, content=texts, task_type="retrieval_document")
+    return result["embedding"]
+
+
+def embed_missing(db, api_key: str) -> int:
+    """
+    Эмбеддинги для новых и измененных требований (summary/full_text поменялись - хеш другой).
+    db - сессия или соединение SQLAlchemy. Возвращает число посчитанных строк.
+    """
+    rows = db.execute(text(f"""
+        SELECT r.id, r.req_code, r.summary, r.full_text, {_ROW_HASH} AS row_hash
+        FROM legal_requirement r
+        WHERE r.embedding IS NULL OR r.embedding_hash IS DISTINCT FROM {_ROW_HASH}
+        ORDER BY r.req_code
+    """)).fetchall()
+    done = 0
+    for start in range(0, len(rows), EMBED_BATCH):
+        batch = rows[start:start + EMBED_BATCH]
+        try:
+            vectors = _embed_batch([requirement_text(r) for r in batch], api_key)
+        except Exception as e:
+            print(f"⚠️ Policy Embedding Error: {e}")
+            break
+        for row, vector in zip(batch, vectors):
+            db.execute(text("""
+                UPDATE legal_requirement SET embedding = :vec, embedding_hash = :hash WHERE id = :id
+            """), {"vec": str(vector), "hash": row.row_hash, "id": row.id})
+        db.commit()
+        done += len(batch)
+    if done:
+        print(f"🧭 Эмбеддинги политик: {done} из {len(rows)}")
+        incr_metric("policies", "embedded", done)
+    return done
+
+
+def _vector(row):
+    key = (row.req_code, row.embedding_hash)
+    vector = _vectors.get(key)
+    if vector is None:
+        vector = np.asarray(_parse_vector(row.embedding), dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        if len(_vectors) > 10000:
+            _vectors.clear()
+        _vectors[key] = vector
+    return vector
+
+
+def _parse_vector(raw: str):
+    # Вектор хранится текстом "[0.1, 0.2, ...]", как в case_memory
+    return [float(x) for x in raw.strip("[] \n").split(",")]
+
+
+def select(db, publisher_pattern: str, query_vector, stats: dict = None):
+    """
+    Требования издателя для промпта: обязательные + TOP_K ближайших к query_vector.
+    query_vector None (эмбеддинг не посчитался) или TOP_K=0 - все требования.
+    stats (если передан) заполняется: всего, отобрано, обязательных, оценка токенов до/после.
+    """
+    rows = db.execute(text("""
+        SELECT r.req_code, r.summary, r.risk_floor, r.embedding, r.embedding_hash
+        FROM legal_requirement r
+        JOIN legal_doc d ON r.doc_id = d.id
+        WHERE d.publisher LIKE :pub
+        ORDER BY r.req_code
+    """), {"pub": publisher_pattern}).fetchall()
+
+    mandatory = [r for r in rows if (r.risk_floor or "").upper() in MANDATORY_RISKS or not r.embedding]
+    mandatory_codes = {r.req_code for r in mandatory}
+    candidates = [r for r in rows if r.req_code not in mandatory_codes]
+    if query_vector is None or TOP_K <= 0 or len(candidates) <= TOP_K:
+        selected, scores = list(rows), {}
+    else:
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        similarity = np.stack([_vector(r) for r in candidates]) @ query
+        best = np.argsort(-similarity)[:TOP_K]
+        scores = {candidates[i].req_code: round(float(similarity[i]), 3) for i in best}
+        # Сначала обязательные, потом по убыванию близости
+        selected = mandatory + [candidates[i] for i in best]
+
+    if stats is not None:
+        full_text = format_policies(rows)
+        selected_text = format_policies(selected)
+        stats.update({
+            "total": len(rows), "selected": len(selected), "mandatory": len(mandatory), "top_k": TOP_K,
+            "tokens_all": rate_limiter.estimate_tokens([full_text]),
+            "tokens_selected": rate_limiter.estimate_tokens([selected_text]),
+            "scores": scores,
+        })
+    return selected
+
+
+def format_policies(rows) -> str:
+    return "\n".join([f"- [{p.req_code}] {p.summary}" for p in rows])
+
+
+def quick_summary(frames, filename: str, extra_text: str, api_key: str, should_cancel=None,
+                  media_path: str = None, duration_ms: int = 0):
+    """
+    Текст для поиска политик и похожих кейсов: имя файла + музыка и 2-3 предложения
+    от легкой модели по нескольким кадрам. Ключевых кадров нет (полное видео, окна) -
+    берем SUMMARY_FRAMES кадров из media_path равномерно по длительности.
+    Возвращает (текст, есть ли описание): без описания отбирать политики не по чему.
+    """
+    base = " ".join(filter(None, [filename, extra_text]))
+    if not SUMMARY_MODEL or SUMMARY_FRAMES <= 0:
+        return base, False
+    from keyframes import keyframe_parts, sample_frames, cleanup
+    sample_dir = None
+    try:
+        if not frames and media_path and duration_ms > 0:
+            sample_dir = f"{os.path.splitext(media_path)[0]}_summary"
+            try:
+                frames = sample_frames(media_path, sample_dir, SUMMARY_FRAMES, duration_ms)
+            except Exception as e:
+                print(f"⚠️ Policy Summary Frames Error: {e}")
+        if not frames:
+            return base, False
+        step = max(1, len(frames) // SUMMARY_FRAMES)
+        content = [SUMMARY_INSTRUCTION, *keyframe_parts(frames[::step][:SUMMARY_FRAMES])]
+        genai.configure(api_key=api_key)
+        with rate_limiter.limited(api_key, SUMMARY_MODEL, rate_limiter.estimate_tokens(content),
+                                  kind="summary", should_cancel=should_cancel):
+            response = genai.GenerativeModel(SUMMARY_MODEL).generate_content(content)
+        summary = (response.text or "").strip()
+    except TranscodeCancelled:
+        raise
+    except Exception as e:
+        print(f"⚠️ Policy Summary Error: {e}")
+        return base, False
+    finally:
+        if sample_dir:
+            cleanup(sample_dir)
+    return (f"{base}\n{summary}", True) if summary else (base, False)
+
+
+if __name__ == "__main__":
+    # Разовый пересчет после сидов: python policy_index.py
+    from database import SessionLocal, init_db
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("❌ Ошибка: GEMINI_API_KEY не найден. Проверьте файл .env")
+        sys.exit(1)
+    init_db()
+    session = SessionLocal()
+    try:
+        print(f"✅ Посчитано эмбеддингов: {embed_missing(session, api_key)}")
+    finally:
+        session.close()
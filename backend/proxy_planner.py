@@ -0,0 +1,81 @@
+# backend/proxy_planner.py
+import os
+
+# Планировщик параметров прокси по длительности.
+# Вместо фиксированных 640px / CRF 28 / 24 fps выбираем ступень "лестницы",
+# которая укладывается в бюджет по размеру файла и по токенам модели:
+# 15-секундный ролик получает картинку получше, 3-часовой эфир - легкий 1 fps.
+
+# Бюджеты (настраиваются через окружение)
+TARGET_MB = int(os.getenv("PROXY_TARGET_MB", "500"))
+TOKEN_BUDGET = int(os.getenv("PROXY_TOKEN_BUDGET", "900000"))
+
+# Сколько токенов Gemini тратит на материал: ~258 на кадр (модель берет 1 кадр/сек)
+# и ~32 на секунду звука. Видео реже 1 fps дает пропорционально меньше кадров.
+TOKENS_PER_FRAME = 258
+AUDIO_TOKENS_PER_S = 32
+AUDIO_KBPS = 48
+
+# От лучшего качества к самому легкому. est_kbps - типичный видеобитрейт ступени,
+# maxrate ограничивает пики, чтобы оценка размера не "уплывала" на динамичных сценах.
+LADDER = [
+    {"name": "hq",       "width": 1280, "fps": 25,  "crf": 23, "est_kbps": 1800, "maxrate": 2500},
+    {"name": "standard", "width": 854,  "fps": 24,  "crf": 26, "est_kbps": 800,  "maxrate": 1200},
+    {"name": "proxy",    "width": 640,  "fps": 24,  "crf": 28, "est_kbps": 400,  "maxrate": 700},
+    {"name": "light",    "width": 480,  "fps": 12,  "crf": 30, "est_kbps": 200,  "maxrate": 350},
+    {"name": "lowfps",   "width": 640,  "fps": 1,   "crf": 28, "est_kbps": 60,   "maxrate": 150},
+    {"name": "lowfps_s", "width": 426,  "fps": 0.5, "crf": 32, "est_kbps": 20,   "maxrate": 60},
+]
+
+
+def estimate(rung: dict, duration_s: float) -> dict:
+    frames_per_s = min(rung["fps"], 1)
+    tokens = int(duration_s * (frames_per_s * TOKENS_PER_FRAME + AUDIO_TOKENS_PER_S))
+    size = int(duration_s * (rung["est_kbps"] + AUDIO_KBPS) * 1000 / 8)
+    return {"est_tokens": tokens, "est_bytes": size}
+
+
+def video_args(rung: dict) -> list:
+    return [
+        "-vf", f"scale={rung['width']}:-2,format=yuv420p",
+        "-c:v", "libx264",
+        "-profile:v", "high",
+        "-level", "4.1",
+        "-crf", str(rung["crf"]),
+        "-maxrate", f"{rung['maxrate']}k", "-bufsize", f"{rung['maxrate'] * 2}k",
+        "-preset", "faster",
+        "-r", str(rung["fps"]),
+    ]
+
+
+def plan_encoding(probe: dict, target_mb: int = None, token_budget: int = None, window_s: int = None):
+    """
+    Первая (самая качественная) ступень, которая влезает в оба бюджета.
+    Если не влезает ничего - самая легкая ступень с пометкой over_budget
+    (такой материал лучше анализировать в оконном режиме).
+    window_s - в оконном режиме бюджет действует на одно окно, а не на весь файл.
+    Для файла без видео (аудио) плана нет: лестница - про картинку.
+    """
+    if not probe or not probe.get("duration_ms") or not probe.get("video"):
+        return None
+    duration_s = probe["duration_ms"] / 1000
+    if window_s:
+        duration_s = min(duration_s, window_s)
+    target_bytes = (target_mb or TARGET_MB) * 1024 * 1024
+    budget = token_budget or TOKEN_BUDGET
+
+    source_width = probe["video"].get("width") or 0
+    for rung in LADDER:
+        # Не апскейлим: ступень шире исходника кодируем в ширину исходника (четную - для yuv420p)
+        if source_width and rung["width"] > source_width:
+            rung = {**rung, "width": max(2, source_width // 2 * 2)}
+        est = estimate(rung, duration_s)
+        if est["est_bytes"] <= target_bytes and est["est_tokens"] <= budget:
+            return {**rung, **est, "over_budget": False,
+                    "target_bytes": target_bytes, "token_budget": budget}
+
+    rung = LADDER[-1]
+    if source_width and rung["width"] > source_width:
+        rung = {**rung, "width": max(2, source_width // 2 * 2)}
+    return {**rung, **estimate(rung, duration_s), "over_budget": True,
+            "target_bytes": target_bytes, "token_budget": budget}
@@ -0,0 +1,233 @@
+# backend/rate_limiter.py
+import os
+import json
+import time
+import uuid
+import hashlib
+from contextlib import contextmanager
+
+from redis_helper import get_redis, incr_metric
+from ffmpeg_helper import TranscodeCancelled
+from proxy_planner import TOKENS_PER_FRAME
+
+# Общий на весь кластер лимит запросов к Gemini: token bucket в Redis на пару
+# (API-ключ, модель) - запросы в минуту и токены в минуту. Каждый вызов
+# generate/upload/embed сначала берет место в ведре, поэтому воркеры не упираются
+# в 429 толпой, а идут ровно на потолке квоты.
+#
+# Ключи (ключ API в Redis не пишем - только короткий хеш):
+#   ratelimit:<key_id>:<model>          hash: req, tok (остаток), ts (мс), seq, blocked_until
+#   ratelimit:<key_id>:<model>:queue    zset: ожидающие по порядку прихода (честная очередь)
+#   ratelimit:<key_id>:<model>:alive    zset: последний опрос ожидающего (мертвых выкидываем)
+#
+# Квоты: GEMINI_LIMITS - JSON {"модель": {"rpm": .., "tpm": ..}} поверх умолчаний;
+# "*" - любая другая модель, "upload" и "embed" - загрузка файлов и эмбеддинги.
+# 0 или отсутствие - без ограничения по этому измерению.
+DEFAULT_LIMITS = {
+    "*": {"rpm": 60, "tpm": 1000000},
+    "upload": {"rpm": 60},
+    "embed": {"rpm": 1500},
+}
+LIMITS = {**DEFAULT_LIMITS, **json.loads(os.getenv("GEMINI_LIMITS", "{}"))}
+# Емкость ведра - квота за столько секунд: небольшой всплеск можно, пачку на минуту вперед - нет
+BURST_S = float(os.getenv("RATE_LIMIT_BURST_S", "10"))
+# Сколько максимум ждем места, прежде чем сдаться
+ACQUIRE_TIMEOUT_S = float(os.getenv("RATE_LIMIT_TIMEOUT_S", "900"))
+# Ожидающий, который не опрашивал очередь столько времени, считается умершим
+STALE_MS = 15000
+POLL_MIN_S, POLL_MAX_S = 0.05, 1.0
+# Оценка токенов медиа-части без подсказки (реальный расход досчитываем по ответу)
+MEDIA_TOKENS = int(os.getenv("RATE_LIMIT_MEDIA_TOKENS", "30000"))
+KEY_TTL_MS = 3600 * 1000
+
+# Возвращает {ожидание в мс, место в очереди}; 0 мс и место 0 - место в ведре выдано
+_ACQUIRE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local id = ARGV[1]
+local req_rate, req_cap = tonumber(ARGV[2]), tonumber(ARGV[3])
+local tok_rate, tok_cap = tonumber(ARGV[4]), tonumber(ARGV[5])
+local need, stale, ttl = tonumber(ARGV[6]), tonumber(ARGV[7]), tonumber(ARGV[8])
+
+redis.call('ZADD', KEYS[3], now, id)
+if not redis.call('ZSCORE', KEYS[2], id) then
+  redis.call('ZADD', KEYS[2], redis.call('HINCRBY', KEYS[1], 'seq', 1), id)
+end
+for _, dead in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now - stale)) do
+  redis.call('ZREM', KEYS[2], dead)
+  redis.call('ZREM', KEYS[3], dead)
+end
+local rank = redis.call('ZRANK', KEYS[2], id)
+
+local b = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts', 'blocked_until')
+local req = tonumber(b[1]) or req_cap
+local tok = tonumber(b[2]) or tok_cap
+local elapsed = math.max(0, now - (tonumber(b[3]) or now))
+req = math.min(req_cap, req + elapsed * req_rate)
+tok = math.min(tok_cap, tok + elapsed * tok_rate)
+redis.call('HSET', KEYS[1], 'req', req, 'tok', tok, 'ts', now)
+for i = 1, 3 do redis.call('PEXPIRE', KEYS[i], ttl) end
+
+local blocked = tonumber(b[4]) or 0
+if blocked > now then
+  return {blocked - now, rank}
+end
+local wait = 0
+if req_rate > 0 and req < 1 then
+  wait = math.max(wait, (1 - req) / req_rate)
+end
+need = math.min(need, tok_cap)
+if tok_rate > 0 and tok < need then
+  wait = math.max(wait, (need - tok) / tok_rate)
+end
+if rank > 0 or wait > 0 then
+  return {math.max(1, math.ceil(wait)), rank}
+end
+if req_rate > 0 then redis.call('HSET', KEYS[1], 'req', req - 1) end
+if tok_rate > 0 then redis.call('HSET', KEYS[1], 'tok', tok - need) end
+redis.call('ZREM', KEYS[2], id)
+redis.call('ZREM', KEYS[3], id)
+return {0, 0}
+"""
+
+# Реальный расход токенов против оценки: разницу возвращаем в ведро (или дозабираем)
+_SETTLE = """
+local tok = tonumber(redis.call('HGET', KEYS[1], 'tok'))
+if tok then
+  redis.call('HSET', KEYS[1], 'tok', math.min(tonumber(ARGV[2]), tok + tonumber(ARGV[1])))
+end
+"""
+
+# 429: пауза для всех ожидающих этого ведра, а не только для получившего ошибку
+_PENALIZE = """
+local t = redis.call('TIME')
+local until_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000) + tonumber(ARGV[1])
+if until_ms > (tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0) then
+  redis.call('HSET', KEYS[1], 'blocked_until', until_ms)
+end
+redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[2]))
+"""
+
+
+class RateLimitTimeout(Exception):
+    """Место в ведре не освободилось за ACQUIRE_TIMEOUT_S."""
+
+
+class QuotaExceeded(Exception):
+    """Google вернул 429; retry_after - через сколько секунд пробовать снова."""
+
+    def __init__(self, retry_after: float, message: str = ""):
+        super().__init__(message or f"Quota exceeded, retry in {int(retry_after)}s")
+        self.retry_after = retry_after
+
+
+def _model_name(model: str) -> str:
+    return (model or "*").split("/")[-1]
+
+
+def limits_for(model: str) -> dict:
+    return LIMITS.get(_model_name(model)) or LIMITS["*"]
+
+
+def bucket_key(api_key: str, model: str) -> str:
+    key_id = hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+    return f"ratelimit:{key_id}:{_model_name(model)}"
+
+
+def _rates(model: str):
+    """Скорости пополнения (в мс) и емкости ведер запросов и токенов."""
+    limits = limits_for(model)
+    rpm, tpm = limits.get("rpm") or 0, limits.get("tpm") or 0
+    req_cap = max(1.0, rpm * BURST_S / 60) if rpm else 0
+    tok_cap = tpm * BURST_S / 60 if tpm else 0
+    return rpm / 60000, req_cap, tpm / 60000, tok_cap
+
+
+def estimate_tokens(content, media_tokens: int = None) -> int:
+    """Грубая оценка токенов запроса до вызова: текст ~3 символа на токен, кадр - 258."""
+    total = 0
+    for part in content:
+        if isinstance(part, str):
+            total += len(part) // 3
+        elif isinstance(part, dict) and str(part.get("mime_type", "")).startswith("image"):
+            total += TOKENS_PER_FRAME
+        else:
+            total += media_tokens or MEDIA_TOKENS
+    return total
+
+
+def acquire(api_key: str, model: str, tokens: int = 0, kind: str = "generate",
+            should_cancel=None, on_wait=None) -> float:
+    """
+    Ждет своей очереди и места в ведре. Возвращает время ожидания, с.
+    Redis недоступен - пропускаем без лимита (анализ важнее).
+    """
+    key = bucket_key(api_key, model)
+    req_rate, req_cap, tok_rate, tok_cap = _rates(model)
+    if not req_rate and not tok_rate:
+        return 0.0
+    waiter = uuid.uuid4().hex
+    started = time.time()
+    notified = False
+    try:
+        r = get_redis()
+        while True:
+            wait_ms, rank = r.eval(_ACQUIRE, 3, key, f"{key}:queue", f"{key}:alive", waiter,
+                                   req_rate, req_cap, tok_rate, tok_cap, int(tokens), STALE_MS, KEY_TTL_MS)
+            if wait_ms == 0:
+                break
+            waited = time.time() - started
+            if waited > ACQUIRE_TIMEOUT_S:
+                r.zrem(f"{key}:queue", waiter)
+                raise RateLimitTimeout(f"{_model_name(model)}: нет места в лимите за {int(waited)} с")
+            if should_cancel and should_cancel():
+                r.zrem(f"{key}:queue", waiter)
+                raise TranscodeCancelled()
+            if on_wait and not notified and wait_ms > 1000:
+                on_wait(wait_ms / 1000, rank)
+                notified = True
+            # Первый в очереди спит ровно до пополнения, остальные - опрашивают очередь
+            delay = wait_ms / 1000 if rank == 0 else min(max(wait_ms / 1000, POLL_MIN_S), POLL_MAX_S)
+            # Но не дольше таймаута: сдаемся вовремя, а не после полного пополнения
+            time.sleep(min(delay, STALE_MS / 3000, max(POLL_MIN_S, ACQUIRE_TIMEOUT_S - waited)))
+    except (RateLimitTimeout, TranscodeCancelled):
+        raise
+    except Exception as e:
+        print(f"⚠️ Rate Limit Error: {e}")
+    waited = time.time() - started
+    incr_metric("ratelimit", f"{kind}_wait_s", round(waited, 3))
+    return waited
+
+
+def settle(api_key: str, model: str, estimated: int, actual: int):
+    """Поправка ведра токенов по фактическому расходу из ответа."""
+    _, _, tok_rate, tok_cap = _rates(model)
+    if not tok_rate or actual is None:
+        return
+    try:
+        get_redis().eval(_SETTLE, 1, bucket_key(api_key, model), int(estimated) - int(actual), tok_cap)
+    except Exception as e:
+        print(f"⚠️ Rate Limit Error: {e}")
+
+
+def penalize(api_key: str, model: str, seconds: float) -> bool:
+    """Пауза ведра после 429. False - Redis недоступен, ждать придется самому."""
+    incr_metric("ratelimit", "quota_errors")
+    try:
+        get_redis().eval(_PENALIZE, 1, bucket_key(api_key, model), int(seconds * 1000), KEY_TTL_MS)
+        return True
+    except Exception as e:
+        print(f"⚠️ Rate Limit Error: {e}")
+        return False
+
+
+@contextmanager
+def limited(api_key: str, model: str, tokens: int = 0, kind: str = "generate", should_cancel=None, on_wait=None):
+    """Вызов под лимитом: ожидание и время самого вызова идут в метрики ratelimit."""
+    acquire(api_key, model, tokens, kind, should_cancel, on_wait)
+    started = time.time()
+    try:
+        yield
+    finally:
+        incr_metric("ratelimit", f"{kind}_calls")
+        incr_metric("ratelimit", f"{kind}_call_s", round(time.time() - started, 3))
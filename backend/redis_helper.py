@@ -0,0 +1,67 @@
+# backend/redis_helper.py
+import os
+import redis
+
+# Тот же Redis, что и у Celery (отдельный сервис не нужен)
+REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0"))
+
+_client = None
+
+
+def get_redis():
+    """Ленивое подключение: один клиент (с пулом соединений) на процесс."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _client
+
+
+def incr_metric(group: str, field: str, amount=1):
+    """
+    Счетчик метрики в хеше metrics:<group>.
+    Ошибки Redis не должны ронять анализ - только пишем в лог.
+    """
+    try:
+        r = get_redis()
+        if isinstance(amount, float):
+            r.hincrbyfloat(f"metrics:{group}", field, amount)
+        else:
+            r.hincrby(f"metrics:{group}", field, amount)
+    except Exception as e:
+        print(f"⚠️ Metrics Error: {e}")
+
+
+def get_metrics(group: str) -> dict:
+    """Возвращает все счетчики группы (значения приводим к числам)."""
+    try:
+        raw = get_redis().hgetall(f"metrics:{group}")
+    except Exception as e:
+        print(f"⚠️ Metrics Error: {e}")
+        return {}
+
+    result = {}
+    for k, v in raw.items():
+        try:
+            result[k] = int(v)
+        except ValueError:
+            result[k] = round(float(v), 3)
+    return result
+
+
+# --- ОТМЕНА ЗАДАЧ ---
+CANCEL_TTL_S = 24 * 3600
+
+
+def request_cancel(task_id: str):
+    """Флаг cancel:<task_id>: воркер проверяет его во время долгих этапов."""
+    get_redis().set(f"cancel:{task_id}", "1", ex=CANCEL_TTL_S)
+
+
+def is_cancelled(task_id: str) -> bool:
+    if not task_id:
+        return False
+    try:
+        return bool(get_redis().exists(f"cancel:{task_id}"))
+    except Exception as e:
+        print(f"⚠️ Cancel Check Error: {e}")
+        return False
@@ -0,0 +1,289 @@
+# backend/registry_index.py
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import struct
+import threading
+
+from lexicon import normalize, _split_name
+from updater import iter_json_array, _iter_file_chunks
+
+# Компилированный индекс реестров: отсортированные нормализованные ключи + смещения
+# в одном бинарном файле. Каждый процесс открывает его через mmap только на чтение,
+# поэтому страницы лежат в общем page cache, а не копируются в память процесса
+# (как было бы при json.load нескольких мегабайт).
+#
+# Индекс читают:
+#   - лексикон воркера (lexicon.Lexicon): точные совпадения имен из реестров ищутся
+#     бинарным поиском по фразам текста, а не автоматом в памяти каждого процесса;
+#   - нечеткий поиск иноагентов (name_matcher.load_records): записи берутся из payload,
+#     JSON реестров воркер не читает;
+#   - GET /registries/lookup.
+# Ключи - полное имя, алиасы и части в скобках ("ФБК (Фонд ...)" -> "фбк", "фонд ...").
+#
+# Формат (little-endian):
+#   header:  magic "RIDX" | format u16 | max_words u16 | count u32 | built_at u64
+#            (max_words - сколько слов в самом длинном ключе: дальше фразу не удлиняем)
+#   records: count x (key_off u32, key_len u32, payload_off u32, payload_len u32), по возрастанию ключа
+#   blob:    ключи (UTF-8) и payload (JSON записи) подряд
+REGISTRIES_DIR = os.getenv("REGISTRIES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "registries"))
+INDEX_PATH = os.path.join(REGISTRIES_DIR, "registry.idx")
+SOURCES = ["foreign_agents.json", "extremist_materials.json", "rosfin_terrorists.json", "blacklist.json"]
+
+MAGIC = b"RIDX"
+FORMAT = 2
+_HEADER = struct.Struct("<4sHHIQ")
+_RECORD = struct.Struct("<IIII")
+_SPACES = re.compile(r"[^\w]+")
+
+
+def normalize_key(name: str) -> str:
+    """Тот же нормализатор, что у лексикона, плюс пунктуация -> один пробел."""
+    norm, _ = normalize(name)
+    return _SPACES.sub(" ", norm).strip()
+
+
+def _records(sources):
+    """(ключ, payload) по всем именам/алиасам/текстам из реестров."""
+    for source in sources:
+        path = os.path.join(REGISTRIES_DIR, source)
+        if not os.path.exists(path):
+            continue
+        for item in iter_json_array(_iter_file_chunks(path)):
+            if isinstance(item, str):
+                names, payload = [item], {"text": item}
+            elif isinstance(item, dict):
+                names = [item.get("name"), item.get("official_name"), item.get("text"), *(item.get("aliases") or [])]
+                payload = {k: item.get(k) for k in ("name", "official_name", "aliases", "status", "law", "text")
+                           if item.get(k)}
+            else:
+                continue
+            payload["source"] = source
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            for name in filter(None, names):
+                for part in {str(name), *_split_name(str(name))}:
+                    key = normalize_key(part)
+                    if key:
+                        yield key.encode("utf-8"), data
+
+
+def compile_index(sources=None, path: str = None) -> int:
+    """Собирает индекс во временный файл и атомарно публикует. Возвращает число ключей."""
+    path = path or INDEX_PATH
+    records = sorted(set(_records(sources or SOURCES)))
+
+    # Одинаковые payload (алиасы одной записи) храним один раз
+    blob = bytearray()
+    payload_offsets = {}
+    table = []
+    for key, data in records:
+        key_off = len(blob)
+        blob += key
+        if data not in payload_offsets:
+            payload_offsets[data] = len(blob)
+            blob += data
+        table.append(_RECORD.pack(key_off, len(key), payload_offsets[data], len(data)))
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        max_words = max((key.count(b" ") + 1 for key, _ in records), default=0)
+        f.write(_HEADER.pack(MAGIC, FORMAT, min(max_words, 0xFFFF), len(records), int(time.time())))
+        f.write(b"".join(table))
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    print(f"🗂️ Индекс реестров: {len(records)} ключей, {os.path.getsize(path) // 1024} КБ")
+    return len(records)
+
+
+class RegistryIndex:
+    def __init__(self, path: str = None):
+        self.path = path or INDEX_PATH
+        with open(self.path, "rb") as f:
+            self._stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.max_words, self.count, self.built_at = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError(f"Bad registry index: {self.path}")
+        self._table = _HEADER.size
+        self._blob = self._table + self.count * _RECORD.size
+
+    def _record(self, i: int):
+        return _RECORD.unpack_from(self._mm, self._table + i * _RECORD.size)
+
+    def _key(self, i: int) -> bytes:
+        key_off, key_len, _, _ = self._record(i)
+        start = self._blob + key_off
+        return self._mm[start:start + key_len]
+
+    def _lower_bound(self, key: bytes) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _payload(self, payload_off: int, payload_len: int) -> dict:
+        start = self._blob + payload_off
+        return json.loads(self._mm[start:start + payload_len])
+
+    def lookup_key(self, key: str) -> list:
+        """Записи по уже нормализованному ключу (normalize_key): O(log n)."""
+        key = key.encode("utf-8")
+        i = self._lower_bound(key)
+        results = []
+        while i < self.count and self._key(i) == key:
+            _, _, payload_off, payload_len = self._record(i)
+            results.append(self._payload(payload_off, payload_len))
+            i += 1
+        return results
+
+    def lookup(self, name: str) -> list:
+        """Точное совпадение по нормализованному имени: O(log n), список записей реестров."""
+        return self.lookup_key(normalize_key(name))
+
+    def has_prefix(self, prefix: str) -> bool:
+        """Есть ли ключ, начинающийся с prefix (фразу текста есть смысл удлинять)."""
+        prefix = prefix.encode("utf-8")
+        i = self._lower_bound(prefix)
+        return i < self.count and self._key(i).startswith(prefix)
+
+    def iter_payloads(self, sources=None):
+        """Каждая запись реестров один раз (алиасы одной записи делят payload)."""
+        seen = set()
+        for i in range(self.count):
+            _, _, payload_off, payload_len = self._record(i)
+            if payload_off in seen:
+                continue
+            seen.add(payload_off)
+            payload = self._payload(payload_off, payload_len)
+            if sources is None or payload.get("source") in sources:
+                yield payload
+
+    def __contains__(self, name: str) -> bool:
+        key = normalize_key(name).encode("utf-8")
+        i = self._lower_bound(key)
+        return i < self.count and self._key(i) == key
+
+    def __len__(self):
+        return self.count
+
+    def is_stale(self) -> bool:
+        """Файл заменили новой версией (os.replace меняет inode)."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (st.st_ino, st.st_mtime_ns) != (self._stat.st_ino, self._stat.st_mtime_ns)
+
+    def close(self):
+        self._mm.close()
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс процесса; переоткрывается, если опубликована новая версия. None - индекса нет."""
+    global _index
+    with _lock:
+        if _index is None or _index.is_stale():
+            if not os.path.exists(INDEX_PATH):
+                return None
+            # Старый mmap не закрываем: им может пользоваться другой поток, его освободит GC
+            _index = RegistryIndex()
+    return _index
+
+
+def ensure_index():
+    """
+    Индекс для лексикона воркера. Файла нет или он старого формата (первый старт,
+    обновление кода) - собираем из JSON реестров. None - собрать не вышло.
+    """
+    try:
+        index = get_index()
+    except (ValueError, struct.error) as e:
+        print(f"⚠️ Registry Index Error: {e}. Пересобираем.")
+        index = None
+    if index is None:
+        try:
+            compile_index()
+            index = get_index()
+        except Exception as e:
+            print(f"⚠️ Registry Index Error: {e}")
+            return None
+    return index
+
+
+# --- БЕНЧМАРК ---
+
+def _rss_kb() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _bench_json(queries):
+    rss = _rss_kb()
+    started = time.perf_counter()
+    table = {}
+    for source in SOURCES:
+        path = os.path.join(REGISTRIES_DIR, source)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for item in json.load(f):
+                    name = item if isinstance(item, str) else (item.get("name") or item.get("text") or "")
+                    table.setdefault(normalize_key(name), []).append(item)
+    load_s = time.perf_counter() - started
+    started = time.perf_counter()
+    for q in queries:
+        table.get(normalize_key(q))
+    return load_s, (time.perf_counter() - started) / len(queries), _rss_kb() - rss
+
+
+def _bench_mmap(queries):
+    rss = _rss_kb()
+    started = time.perf_counter()
+    index = RegistryIndex()
+    load_s = time.perf_counter() - started
+    started = time.perf_counter()
+    for q in queries:
+        index.lookup(q)
+    return load_s, (time.perf_counter() - started) / len(queries), _rss_kb() - rss
+
+
+def bench(mode: str, n_queries: int = 20000):
+    """Один режим на процесс, чтобы RSS не смешивался: python registry_index.py bench json|mmap"""
+    index = RegistryIndex()
+    step = max(1, index.count // n_queries)
+    # Половина запросов - существующие ключи, половина - промахи
+    queries = []
+    for i in range(0, index.count, step):
+        key = index._key(i).decode("utf-8")
+        queries += [key, key + " нет"]
+    index.close()
+    load_s, per_lookup, rss_kb = (_bench_mmap if mode == "mmap" else _bench_json)(queries[:n_queries])
+    print(json.dumps({"mode": mode, "queries": len(queries[:n_queries]), "load_ms": round(load_s * 1000, 1),
+                      "lookup_us": round(per_lookup * 1e6, 2), "rss_delta_kb": rss_kb}))
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        compile_index()
+    elif command == "bench":
+        bench(sys.argv[2] if len(sys.argv) > 2 else "mmap")
+    elif command == "lookup":
+        print(json.dumps(RegistryIndex().lookup(" ".join(sys.argv[2:])), ensure_ascii=False, indent=2))
+    else:
+        print("usage: python registry_index.py build | bench json|mmap | lookup <имя>")
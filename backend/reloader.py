@@ -0,0 +1,136 @@
+# backend/reloader.py
+import os
+import time
+import threading
+from datetime import datetime
+
+from sqlalchemy import text
+
+from redis_helper import get_redis
+
+# Горячая перезагрузка реестров и таксономии без рестарта worker/backend.
+# Источник правды - счетчик reload:version в Redis: обновление реестров, /reload
+# или сид политик увеличивают его, процессы сверяются с ним и собирают новый снимок.
+#
+# Снимок (Snapshot) неизменяемый: задача берет его в начале и пользуется до конца,
+# а новый снимок просто подменяет ссылку на "текущий". Старый живет, пока на него
+# ссылается хоть одна задача, и освобождается сборщиком мусора.
+VERSION_KEY = "reload:version"
+INFO_KEY = "reload:last"
+# Как часто процесс вне задач (API) сверяет версию с Redis
+CHECK_INTERVAL_S = float(os.getenv("RELOAD_CHECK_INTERVAL_S", "10"))
+
+
+class Snapshot:
+    def __init__(self, version: int, lexicon, taxonomy_text: str = None):
+        self.version = version
+        self.lexicon = lexicon
+        # None - таксономию прочитать не удалось, build_prompt возьмет ее из базы сам
+        self.taxonomy_text = taxonomy_text
+        self.built_at = datetime.utcnow().isoformat()
+
+    def info(self) -> dict:
+        return {"version": self.version, "built_at": self.built_at, "lexicon": len(self.lexicon),
+                "names": len(self.lexicon.names) if self.lexicon.names is not None else 0}
+
+
+_current = None
+_checked_at = 0.0
+_build_lock = threading.Lock()
+
+
+def bump(reason: str) -> int:
+    """Новая версия для всех процессов. Возвращает ее номер (0 - Redis недоступен)."""
+    try:
+        r = get_redis()
+        version = r.incr(VERSION_KEY)
+        r.hset(INFO_KEY, mapping={"version": version, "reason": reason, "at": datetime.utcnow().isoformat()})
+        print(f"🔄 Версия конфигурации {version}: {reason}")
+        return version
+    except Exception as e:
+        print(f"⚠️ Reload Bump Error: {e}")
+        return 0
+
+
+def remote_version():
+    """Версия в Redis; None - Redis недоступен (работаем на том, что есть)."""
+    try:
+        return int(get_redis().get(VERSION_KEY) or 0)
+    except Exception as e:
+        print(f"⚠️ Reload Check Error: {e}")
+        return None
+
+
+def load_taxonomy_text():
+    from database import SessionLocal
+    db = SessionLocal()
+    try:
+        rows = db.execute(text("SELECT code, title FROM taxonomy_label ORDER BY code")).fetchall()
+        return "\n".join([f"- {t.code}: {t.title}" for t in rows])
+    except Exception as e:
+        print(f"⚠️ Taxonomy Load Error: {e}")
+        return None
+    finally:
+        db.close()
+
+
+def build(version: int) -> Snapshot:
+    from lexicon import build_lexicon
+    started = time.time()
+    snapshot = Snapshot(version, build_lexicon(), load_taxonomy_text())
+    print(f"📦 Снимок конфигурации v{version} собран за {time.time() - started:.1f} с")
+    return snapshot
+
+
+def refresh(force: bool = False) -> Snapshot:
+    """
+    Сверка с Redis и, если версия сменилась, сборка нового снимка с подменой.
+    Вызывается воркером перед каждой задачей; сборка идет под отдельной блокировкой,
+    поэтому параллельные потоки не собирают одно и то же дважды.
+    """
+    global _current, _checked_at
+    version = remote_version()
+    _checked_at = time.time()
+    current = _current
+    if current is not None and not force and (version is None or version == current.version):
+        return current
+    with _build_lock:
+        current = _current
+        if current is not None and not force and current.version == (version or 0):
+            return current
+        # Подмена одной ссылкой: задачи, взявшие старый снимок, дорабатывают на нем
+        _current = build(version or 0)
+        return _current
+
+
+def _refresh_in_background():
+    if not _build_lock.locked():
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+def current() -> Snapshot:
+    """
+    Активный снимок процесса. Первый вызов собирает его синхронно; дальше не чаще
+    раза в CHECK_INTERVAL_S сверяет версию, а новую версию собирает в фоне -
+    запросы API до подмены обслуживает старый снимок.
+    """
+    global _checked_at
+    snapshot = _current
+    if snapshot is None:
+        return refresh()
+    if time.time() - _checked_at >= CHECK_INTERVAL_S:
+        _checked_at = time.time()
+        version = remote_version()
+        if version is not None and version != snapshot.version:
+            _refresh_in_background()
+    return snapshot
+
+
+def status() -> dict:
+    """Версия процесса и последняя версия в Redis (для /reload)."""
+    try:
+        last = get_redis().hgetall(INFO_KEY)
+    except Exception as e:
+        last = {"error": str(e)}
+    snapshot = _current
+    return {"active": snapshot.info() if snapshot else None, "last": last}
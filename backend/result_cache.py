@@ -0,0 +1,139 @@
+# backend/result_cache.py
+import json
+import hashlib
+from sqlalchemy import text
+
+from redis_helper import get_redis, incr_metric
+from prompts.instructions import SYSTEM_PROMPT_TEMPLATE
+
+# Готовый отчет переиспользуется, если совпали: байты файла, модель, профиль,
+# версия политик/таксономии и версия шаблона промпта.
+# Сами отчеты лежат в agent_run (колонка cache_key), Redis нужен только для блокировки.
+LOCK_TTL_S = 3600       # с запасом на 50-минутный лимит задачи
+# Повтор задачи-"последователя", пока лидер работает: 5 с, дальше реже, не больше минуты
+FOLLOW_FIRST_S = 5
+FOLLOW_MAX_S = 60
+# С запасом на TTL блокировки лидера: после него блокировку возьмет сам последователь
+FOLLOW_MAX_RETRIES = LOCK_TTL_S // FOLLOW_MAX_S + 20
+
+
+def prompt_version() -> str:
+    return hashlib.sha256(SYSTEM_PROMPT_TEMPLATE.encode("utf-8")).hexdigest()[:12]
+
+
+def policy_version(db) -> str:
+    """Отпечаток политик и таксономии: любая правка сидов меняет версию."""
+    row = db.execute(text("""
+        SELECT
+            (SELECT md5(coalesce(string_agg(req_code || ':' || summary || ':' || coalesce(full_text, ''), '|' ORDER BY req_code), ''))
+             FROM legal_requirement) AS pol,
+            (SELECT md5(coalesce(string_agg(code || ':' || title, '|' ORDER BY code), ''))
+             FROM taxonomy_label) AS tax
+    """)).fetchone()
+    return hashlib.sha256(f"{row.pol}:{row.tax}".encode("utf-8")).hexdigest()[:12]
+
+
+def make_key(content_hash: str, model_name: str, profile: str, pol_version: str, tpl_version: str,
+             variant: str = "full") -> str:
+    # variant - режим анализа (целиком, окнами и т.д.): отчеты разных режимов не смешиваем
+    raw = json.dumps([content_hash, model_name, profile, pol_version, tpl_version, variant])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def lookup(db, cache_key: str):
+    """Последний сохраненный отчет с таким ключом: (asset_id, output_json) или None."""
+    row = db.execute(text("""
+        SELECT asset_id, output_json
+        FROM agent_run
+        WHERE cache_key = :key
+        ORDER BY created_at DESC
+        LIMIT 1
+    """), {"key": cache_key}).fetchone()
+    if not row:
+        return None
+    output = row.output_json if isinstance(row.output_json, dict) else json.loads(row.output_json)
+    return str(row.asset_id), output
+
+
+# --- SINGLE-FLIGHT: одинаковые задачи не выполняются дважды ---
+
+# Блокировка свободна - берем; уже наша (повтор после паузы по квоте, тот же task_id) - продлеваем
+_ACQUIRE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 1
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('expire', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def acquire(cache_key: str, owner: str) -> bool:
+    try:
+        return bool(get_redis().eval(_ACQUIRE_SCRIPT, 1, f"singleflight:{cache_key}", owner, LOCK_TTL_S))
+    except Exception as e:
+        # Без Redis просто работаем без дедупликации
+        print(f"⚠️ Single-flight Error: {e}")
+        return True
+
+
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def extend(cache_key: str, owner: str, ttl_s: float) -> bool:
+    """Продлить свою блокировку (задача уходит на паузу и вернется с тем же owner)."""
+    try:
+        return bool(get_redis().eval(_EXTEND_SCRIPT, 1, f"singleflight:{cache_key}", owner, int(ttl_s)))
+    except Exception as e:
+        print(f"⚠️ Single-flight Error: {e}")
+        return False
+
+
+def release(cache_key: str, owner: str):
+    # Снимаем только свою блокировку (по истечении TTL ее мог взять другой)
+    try:
+        get_redis().eval(_RELEASE_SCRIPT, 1, f"singleflight:{cache_key}", owner)
+    except Exception as e:
+        print(f"⚠️ Single-flight Error: {e}")
+
+
+class LeaderRunning(Exception):
+    """Такой же анализ уже идет в задаче leader: задача уходит на повтор, а не ждет в слоте воркера."""
+
+    def __init__(self, leader: str, countdown: float):
+        super().__init__(f"Такой же файл уже анализируется (задача {leader}), проверим снова через {int(countdown)} с")
+        self.leader = leader
+        self.countdown = countdown
+
+
+def follow_countdown(attempt: int) -> float:
+    return min(FOLLOW_MAX_S, FOLLOW_FIRST_S * 1.5 ** attempt)
+
+
+def leader(cache_key: str):
+    """Владелец блокировки (task_id лидера) или None."""
+    try:
+        return get_redis().get(f"singleflight:{cache_key}")
+    except Exception as e:
+        print(f"⚠️ Single-flight Error: {e}")
+        return None
+
+
+def record(outcome: str):
+    """outcome: hit / miss / shared / bypass"""
+    incr_metric("result_cache", outcome)
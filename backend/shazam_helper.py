@@ -1,6 +1,25 @@
 # backend/shazam_helper.py
+import os
+import json
+import asyncio
+import tempfile
+
 from shazamio import Shazam
 
+# Режим "cue sheet": звук режется на перекрывающиеся окна, окна распознаются
+# параллельно (с лимитом и предохранителем), соседние одинаковые совпадения
+# склеиваются в музыкальные фрагменты с началом и концом.
+CUE_WINDOW_S = float(os.getenv("MUSIC_CUE_WINDOW_S", "12"))
+CUE_HOP_S = float(os.getenv("MUSIC_CUE_HOP_S", "8"))
+CUE_CONCURRENCY = int(os.getenv("MUSIC_CUE_CONCURRENCY", "4"))
+# Сколько окон подряд без совпадения не разрывают фрагмент (тихое место в треке)
+CUE_MAX_GAP = int(os.getenv("MUSIC_CUE_MAX_GAP", "1"))
+# Предохранитель: после стольких ошибок подряд (бан, сеть) оставшиеся окна не отправляем
+BREAKER_FAILURES = int(os.getenv("MUSIC_BREAKER_FAILURES", "5"))
+# shazam | stub (локальные тесты: совпадения из JSON MUSIC_STUB_CUES, без сети)
+RECOGNIZER = os.getenv("MUSIC_RECOGNIZER", "shazam")
+STUB_CUES = os.getenv("MUSIC_STUB_CUES", "")
+
 
 async def recognize_music(file_path: str):
     """
@@ -23,3 +42,213 @@ async def recognize_music(file_path: str):
     except Exception as e:
         print(f"Shazam error: {e}")
         return None
+
+
+# --- РАСПОЗНАВАТЕЛИ ---
+# Распознаватель: async (segment_path, start_s, end_s) -> {"key", "title", "artist"} | None.
+# Ошибка (сеть, лимиты) - исключение: ее считает предохранитель, "не нашлось" - None.
+
+class ShazamRecognizer:
+    def __init__(self):
+        self.shazam = Shazam()
+
+    async def __call__(self, segment_path: str, start_s: float, end_s: float):
+        out = await self.shazam.recognize(segment_path)
+        track = out.get("track")
+        if not track:
+            return None
+        return {
+            "key": str(track.get("key") or f"{track.get('title')}|{track.get('subtitle')}"),
+            "title": track.get("title", "Unknown Title"),
+            "artist": track.get("subtitle", "Unknown Artist"),
+        }
+
+
+class StubRecognizer:
+    """
+    Без сети: "узнает" трек, если середина окна попадает в заданный интервал.
+    cues - [{"start_s", "end_s", "title", "artist"}] (или путь к такому JSON).
+    """
+
+    def __init__(self, cues):
+        if isinstance(cues, str):
+            with open(cues, "r", encoding="utf-8") as f:
+                cues = json.load(f)
+        self.cues = cues
+
+    async def __call__(self, segment_path: str, start_s: float, end_s: float):
+        middle = (start_s + end_s) / 2
+        for cue in self.cues:
+            if cue["start_s"] <= middle < cue["end_s"]:
+                return {"key": f"{cue['title']}|{cue['artist']}", "title": cue["title"], "artist": cue["artist"]}
+        return None
+
+
+def get_recognizer():
+    if RECOGNIZER == "stub":
+        return StubRecognizer(STUB_CUES or [])
+    return ShazamRecognizer()
+
+
+class CircuitBreaker:
+    """Размыкается после BREAKER_FAILURES ошибок подряд; удачный ответ сбрасывает счетчик."""
+
+    def __init__(self, threshold: int = None):
+        self.threshold = threshold or BREAKER_FAILURES
+        self.failures = 0
+        self.open = False
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold and not self.open:
+            self.open = True
+            print(f"⚠️ Music recognition breaker open after {self.failures} errors")
+
+
+# --- CUE SHEET ---
+
+def plan_windows(duration_s: float, window_s: float = None, hop_s: float = None):
+    """[(start_s, end_s)] перекрывающихся окон; последнее прижато к концу файла."""
+    window_s = window_s or CUE_WINDOW_S
+    hop_s = hop_s or CUE_HOP_S
+    if duration_s <= window_s:
+        return [(0.0, duration_s)] if duration_s > 0 else []
+    windows = []
+    start = 0.0
+    while start + window_s < duration_s:
+        windows.append((start, start + window_s))
+        start += hop_s
+    windows.append((max(0.0, duration_s - window_s), duration_s))
+    return windows
+
+
+async def _cut_segment(input_path: str, start_s: float, end_s: float, output_path: str):
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y", "-ss", f"{start_s:.3f}", "-t", f"{end_s - start_s:.3f}", "-i", input_path,
+        "-vn", "-ac", "1", "-ar", "16000", output_path,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    if await process.wait() != 0:
+        raise RuntimeError(f"ffmpeg segment {start_s:.0f}-{end_s:.0f}s failed")
+
+
+def collapse_matches(matches, max_gap: int = None):
+    """
+    [(start_s, end_s, match|None)] по порядку окон -> фрагменты
+    [{"start_ms", "end_ms", "title", "artist", "windows"}]. Одинаковые совпадения
+    подряд (с пропуском до max_gap окон) - один фрагмент.
+    """
+    max_gap = CUE_MAX_GAP if max_gap is None else max_gap
+    cues = []
+    current, gap = None, 0
+    for start_s, end_s, match in matches:
+        if match is None:
+            gap += 1
+            if current and gap > max_gap:
+                current = None
+            continue
+        if current and current["key"] == match["key"]:
+            current["end_ms"] = int(end_s * 1000)
+            current["windows"] += 1
+        else:
+            current = {"key": match["key"], "title": match["title"], "artist": match["artist"],
+                       "start_ms": int(start_s * 1000), "end_ms": int(end_s * 1000), "windows": 1}
+            cues.append(current)
+        gap = 0
+    # Окна перекрываются, поэтому соседние фрагменты тоже: границу ставим посередине
+    for prev, cue in zip(cues, cues[1:]):
+        if cue["start_ms"] < prev["end_ms"]:
+            prev["end_ms"] = cue["start_ms"] = (prev["end_ms"] + cue["start_ms"]) // 2
+    return cues
+
+
+async def build_cue_sheet_async(input_path: str, duration_s: float, recognizer=None,
+                                on_progress=None, should_cancel=None, skip_spans=None):
+    """
+    Распознает все окна (не больше CUE_CONCURRENCY одновременно) и склеивает фрагменты.
+    skip_spans - [(start_ms, end_ms)], уже опознанные локально (audio_landmarks): окна,
+    чья середина внутри, во внешний сервис не отправляются. Возвращает (cues, stats).
+    """
+    recognizer = recognizer or get_recognizer()
+    windows = plan_windows(duration_s)
+    known = [(s / 1000, e / 1000) for s, e in skip_spans or []]
+    breaker = CircuitBreaker()
+    semaphore = asyncio.Semaphore(CUE_CONCURRENCY)
+    results = [None] * len(windows)
+    stats = {"windows": len(windows), "recognized": 0, "failed": 0, "skipped": 0, "local": 0}
+    done = 0
+
+    with tempfile.TemporaryDirectory(prefix="cues_") as tmp_dir:
+        async def run_window(i, start_s, end_s):
+            nonlocal done
+            if any(s <= (start_s + end_s) / 2 < e for s, e in known):
+                stats["local"] += 1
+                done += 1
+                if on_progress:
+                    on_progress(done, len(windows))
+                return
+            async with semaphore:
+                if breaker.open or (should_cancel and should_cancel()):
+                    stats["skipped"] += 1
+                    return
+                segment = os.path.join(tmp_dir, f"w{i:05d}.wav")
+                try:
+                    await _cut_segment(input_path, start_s, end_s, segment)
+                    results[i] = await recognizer(segment, start_s, end_s)
+                    breaker.success()
+                    if results[i]:
+                        stats["recognized"] += 1
+                except Exception as e:
+                    print(f"⚠️ Music window {start_s:.0f}s Error: {e}")
+                    stats["failed"] += 1
+                    breaker.failure()
+                finally:
+                    if os.path.exists(segment):
+                        os.remove(segment)
+                    done += 1
+                    if on_progress:
+                        on_progress(done, len(windows))
+
+        await asyncio.gather(*(run_window(i, s, e) for i, (s, e) in enumerate(windows)))
+
+    cues = collapse_matches([(s, e, results[i]) for i, (s, e) in enumerate(windows)])
+    stats["cues"] = len(cues)
+    stats["breaker_open"] = breaker.open
+    return cues, stats
+
+
+def build_cue_sheet(input_path: str, duration_s: float, recognizer=None, on_progress=None, should_cancel=None,
+                    skip_spans=None):
+    """Синхронная обертка (на долгоживущем event loop процесса, см. stage_graph)."""
+    import stage_graph
+    return stage_graph.run(
+        build_cue_sheet_async(input_path, duration_s, recognizer, on_progress, should_cancel, skip_spans)
+    )
+
+
+def _fmt(ms: int) -> str:
+    s = ms // 1000
+    return f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}"
+
+
+def cue_sheet_text(cues) -> str:
+    """Подсказка для промпта: какая музыка звучит и когда."""
+    if not cues:
+        return ""
+    lines = [f"{_fmt(c['start_ms'])}-{_fmt(c['end_ms'])} {c['title']} - {c['artist']}" for c in cues]
+    return "SHAZAM CUE SHEET (музыка по таймкодам):\n" + "\n".join(lines)
+
+
+def cues_to_evidence(cues, prefix: str = "music"):
+    """Фрагменты -> evidence типа audio_span (схема EvidenceItem)."""
+    return [{
+        "id": f"{prefix}_{i + 1}",
+        "type": "audio_span",
+        "start_ms": c["start_ms"],
+        "end_ms": c["end_ms"],
+        "text_quote": f"{c['title']} - {c['artist']}",
+        "notes": f"Shazam: музыкальный фрагмент (окон распознавания: {c['windows']})",
+    } for i, c in enumerate(cues)]
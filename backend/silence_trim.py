@@ -0,0 +1,116 @@
+# backend/silence_trim.py
+import os
+import re
+import bisect
+import subprocess
+
+# Вырезание тишины из аудио перед отправкой в модель (радиоэфиры, подкасты).
+# В модель уходят только куски со звуком, а таблица смещений возвращает
+# таймкоды доказательств на шкалу исходного файла.
+NOISE_DB = float(os.getenv("SILENCE_NOISE_DB", "-35"))
+MIN_SILENCE_S = float(os.getenv("SILENCE_MIN_S", "2.0"))
+# Сколько тишины оставляем по краям каждого куска, чтобы не резать слова
+PAD_S = float(os.getenv("SILENCE_PAD_S", "0.3"))
+# Если вырезать почти нечего - не тратим время на перекодирование
+MIN_REMOVED_PCT = float(os.getenv("SILENCE_MIN_REMOVED_PCT", "5"))
+
+_START_RE = re.compile(r"silence_start:\s*(-?[0-9.]+)")
+_END_RE = re.compile(r"silence_end:\s*([0-9.]+)")
+
+
+def detect_silence(path: str, duration_s: float):
+    """[(start_s, end_s)] тишины по фильтру silencedetect."""
+    command = [
+        "ffmpeg", "-i", path, "-vn",
+        "-af", f"silencedetect=noise={NOISE_DB}dB:d={MIN_SILENCE_S}",
+        "-f", "null", "-"
+    ]
+    proc = subprocess.run(command, capture_output=True, timeout=3000)
+    log = proc.stderr.decode("utf-8", "ignore")
+    starts = [max(0.0, float(x)) for x in _START_RE.findall(log)]
+    ends = [float(x) for x in _END_RE.findall(log)]
+    # Тишина до самого конца файла приходит без silence_end
+    if len(ends) < len(starts):
+        ends.append(duration_s)
+    return list(zip(starts, ends))
+
+
+def speech_spans(silences, duration_s: float):
+    """Дополнение к тишине (с запасом PAD_S по краям): [(start_s, end_s)] со звуком."""
+    spans = []
+    cursor = 0.0
+    for start, end in silences:
+        cut_start, cut_end = start + PAD_S, end - PAD_S
+        if cut_end - cut_start <= 0:
+            continue
+        if cut_start > cursor:
+            spans.append((cursor, cut_start))
+        cursor = cut_end
+    if cursor < duration_s:
+        spans.append((cursor, duration_s))
+    return spans
+
+
+def build_offset_table(spans):
+    """[(trimmed_start_ms, original_start_ms, length_ms)] - по строке на кусок."""
+    table = []
+    position = 0
+    for start, end in spans:
+        length = int((end - start) * 1000)
+        table.append((position, int(start * 1000), length))
+        position += length
+    return table
+
+
+def remap_ms(t_ms: int, table) -> int:
+    """Время в обрезанном файле -> время в исходном."""
+    if not table:
+        return t_ms
+    starts = [row[0] for row in table]
+    i = max(0, bisect.bisect_right(starts, t_ms) - 1)
+    trimmed_start, original_start, length = table[i]
+    return original_start + min(max(t_ms - trimmed_start, 0), length)
+
+
+def remap_report(report: dict, table) -> dict:
+    """Переносит start_ms/end_ms всех доказательств на шкалу исходного файла."""
+    for ev in report.get("evidence", []):
+        ev["start_ms"] = remap_ms(ev.get("start_ms") or 0, table)
+        ev["end_ms"] = remap_ms(ev.get("end_ms") or 0, table)
+    return report
+
+
+def trim_silence(input_path: str, duration_ms: int, output_path: str = None):
+    """
+    Возвращает (путь_к_обрезанному_файлу, таблица_смещений, статистика)
+    или (None, None, статистика), если резать нечего.
+    output_path - куда писать результат; input_path может быть прокси из общего кэша
+    (transcode_cache), поэтому задача передает свой путь, а не рядом с входом.
+    """
+    duration_s = duration_ms / 1000
+    spans = speech_spans(detect_silence(input_path, duration_s), duration_s)
+    kept_ms = sum(int((e - s) * 1000) for s, e in spans)
+    stats = {
+        "original_ms": duration_ms,
+        "kept_ms": kept_ms,
+        "removed_ms": duration_ms - kept_ms,
+        "removed_pct": round((duration_ms - kept_ms) / duration_ms * 100, 1) if duration_ms else 0.0,
+        "spans": len(spans),
+    }
+    if not spans or stats["removed_pct"] < MIN_REMOVED_PCT:
+        # Файл отправляется целиком - фактически ничего не вырезано
+        stats.update({"kept_ms": duration_ms, "removed_ms": 0, "removed_pct": 0.0, "applied": False})
+        return None, None, stats
+    stats["applied"] = True
+
+    # aselect оставляет только нужные куски, asetpts склеивает их без пауз
+    select = "+".join(f"between(t,{s:.3f},{e:.3f})" for s, e in spans)
+    output_path = output_path or f"{os.path.splitext(input_path)[0]}_trimmed.m4a"
+    command = [
+        "ffmpeg", "-y", "-i", input_path, "-vn",
+        "-af", f"aselect='{select}',asetpts=N/SR/TB",
+        "-ac", "1", "-ar", "16000", "-c:a", "aac",
+        output_path
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=3000)
+    return output_path, build_offset_table(spans), stats
@@ -0,0 +1,142 @@
+# backend/stage_graph.py
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Этапы задачи анализа как маленький граф зависимостей: этап стартует, как только
+# готовы его зависимости, независимые этапы (распознавание музыки, загрузка в Gemini,
+# RAG) идут одновременно. Всё крутится на одном долгоживущем event loop процесса,
+# синхронные этапы (ffmpeg, SDK Gemini, SQLAlchemy) - в его пуле потоков.
+#
+# Отчет о прогоне (для run_meta и UI):
+#   {"wall_ms", "busy_ms", "stages": [{"name", "deps", "state", "start_ms", "end_ms", "error"?}]}
+# start_ms/end_ms - от старта графа; busy_ms > wall_ms - этапы перекрывались.
+STAGE_THREADS = int(os.getenv("STAGE_THREADS", "8"))
+
+_loop = None
+_loop_pid = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """Event loop процесса в фоновом потоке. После fork (prefork-пул Celery) создается заново."""
+    global _loop, _loop_pid
+    with _lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(STAGE_THREADS, thread_name_prefix="stage"))
+            threading.Thread(target=loop.run_forever, name="stage-loop", daemon=True).start()
+            _loop, _loop_pid = loop, os.getpid()
+    return _loop
+
+
+def run(coro, timeout: float = None):
+    """Выполнить корутину на loop процесса и дождаться результата (из синхронного кода)."""
+    loop = get_loop()
+    if threading.current_thread().name == "stage-loop":
+        coro.close()
+        raise RuntimeError("stage_graph.run() из самого event loop: используйте await")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+class Stage:
+    """
+    Этап графа. fn(results) - функция или корутина; results - словарь
+    {имя этапа: его результат} для уже готовых этапов.
+    optional=True: ошибка этапа пишется в отчет, результат None, зависимые идут дальше.
+    """
+
+    def __init__(self, name: str, fn, deps=(), optional: bool = False):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.optional = optional
+
+
+class StageSkipped(Exception):
+    """Этап не запускался: другой обязательный этап уже упал."""
+
+
+async def run_graph(stages, report: dict = None):
+    """
+    Выполняет этапы (перечислены в порядке зависимостей) и возвращает results.
+    Ошибка обязательного этапа - исключение после того, как уже идущие этапы
+    доработают (поток с ffmpeg или загрузкой не прервать, а их файлы надо убрать).
+    """
+    report = report if report is not None else {}
+    seen = set()
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in seen]
+        if missing:
+            raise ValueError(f"Stage {stage.name}: unknown or later dependencies {missing}")
+        seen.add(stage.name)
+
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    results, tasks, failed = {}, {}, []
+    entries = {s.name: {"name": s.name, "deps": list(s.deps), "state": "PENDING"} for s in stages}
+    report.update({"wall_ms": 0, "busy_ms": 0, "stages": list(entries.values())})
+
+    def elapsed_ms():
+        return int((time.monotonic() - started) * 1000)
+
+    async def run_stage(stage):
+        entry = entries[stage.name]
+        for dep in stage.deps:
+            await asyncio.wait([tasks[dep]])
+            if tasks[dep].exception() is not None:
+                entry["state"] = "SKIPPED"
+                raise StageSkipped(dep)
+        if failed:
+            entry["state"] = "SKIPPED"
+            raise StageSkipped(failed[0])
+        entry.update(state="RUNNING", start_ms=elapsed_ms())
+        try:
+            if asyncio.iscoroutinefunction(stage.fn):
+                value = await stage.fn(results)
+            else:
+                value = await loop.run_in_executor(None, stage.fn, results)
+            entry["state"] = "DONE"
+        except Exception as e:
+            entry.update(state="FAILED", error=str(e)[:300])
+            if not stage.optional:
+                failed.append(stage.name)
+                raise
+            print(f"⚠️ Stage {stage.name} Error: {e}")
+            value = None
+        finally:
+            entry["end_ms"] = elapsed_ms()
+        results[stage.name] = value
+        return value
+
+    for stage in stages:
+        tasks[stage.name] = loop.create_task(run_stage(stage))
+    try:
+        await asyncio.wait(list(tasks.values()))
+    finally:
+        report["wall_ms"] = elapsed_ms()
+        report["busy_ms"] = sum(e.get("end_ms", 0) - e.get("start_ms", 0) for e in entries.values()
+                                if "start_ms" in e)
+
+    # Первая настоящая ошибка (не "пропущен из-за другого"), в порядке этапов
+    errors = [tasks[s.name].exception() for s in stages]
+    for error in errors:
+        if error is not None and not isinstance(error, StageSkipped):
+            raise error
+    return results
+
+
+def execute(stages, report: dict = None) -> dict:
+    """Синхронная обертка для воркера: граф на loop процесса, report заполняется и при ошибке."""
+    return run(run_graph(stages, report))
+
+
+def format_report(report: dict) -> str:
+    """Одна строка на этап для лога: имя, интервал, состояние."""
+    lines = [f"⏱ Этапы: {report.get('wall_ms', 0)} мс по часам, {report.get('busy_ms', 0)} мс работы"]
+    for e in report.get("stages", []):
+        span = f"{e['start_ms']}-{e['end_ms']} мс" if "start_ms" in e else "-"
+        lines.append(f"   {e['name']:<10} {span:<18} {e['state']}")
+    return "\n".join(lines)
@@ -1,19 +1,50 @@
 import os
 import json
 import re
-import subprocess
-import asyncio
 import time
 import random
+import uuid
 import google.generativeai as genai
 from sqlalchemy import text
 
 from celery_app import app
 from prompts.instructions import SYSTEM_PROMPT_TEMPLATE
-from shazam_helper import recognize_music
+from shazam_helper import recognize_music, build_cue_sheet_async, cue_sheet_text, cues_to_evidence
+from ffmpeg_helper import (
+    probe_media, choose_transcode_path, record_transcode, use_segmented, encode_segmented,
+    run_ffmpeg, TranscodeCancelled
+)
 from database import SessionLocal, init_db
+import transcode_cache
+from redis_helper import incr_metric, is_cancelled
+from celery import states
+from celery.exceptions import Ignore
+import result_cache
+from windowing import analyze_windows, window_instruction, WINDOW_S
+from keyframes import (
+    extract_keyframes, keyframe_parts, payload_report, KEYFRAME_INSTRUCTION, cleanup as cleanup_keyframes
+)
+from fingerprint import compute_fingerprints, find_near_duplicates, save_fingerprints
+from proxy_planner import plan_encoding, video_args as planned_video_args
+import silence_trim
+from documents import (
+    is_document, iter_pages, iter_chunks, scan_pages, analyze_chunks, DOCUMENT_INSTRUCTION, DOCUMENT_MIME, PAGE_MS
+)
+from lexicon import scan_report, to_evidence, format_hints
+import reloader
+import audio_landmarks
+import stage_graph
+import rate_limiter
+import checkpoint
+import gemini_uploader
+import file_registry
+import policy_index
+from stage_graph import Stage, format_report
+from celery.signals import task_prerun
 
 # --- НАСТРОЙКИ ---
+# Сколько раз задача может уйти на паузу по квоте (429), прежде чем ждать в процессе
+QUOTA_MAX_RETRIES = int(os.getenv("QUOTA_MAX_RETRIES", "5"))
 SAFETY_SETTINGS = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
@@ -26,11 +57,12 @@ def get_embedding(text_to_embed: str, api_key: str):
     try:
         genai.configure(api_key=api_key)
         # Используем специальную легкую модель для векторов
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=text_to_embed,
-            task_type="retrieval_document"
-        )
+        with rate_limiter.limited(api_key, "embed", kind="embed"):
+            result = genai.embed_content(
+                model="models/text-embedding-004",
+                content=text_to_embed,
+                task_type="retrieval_document"
+            )
         return result['embedding']
     except Exception as e:
         print(f"⚠️ Embedding Error: {e}")
@@ -42,26 +74,62 @@ def clean_json_text(text: str) -> str:
     text = re.sub(r"```$", "", text, flags=re.MULTILINE)
     return text.strip()
 
-def compress_media(input_path: str) -> tuple[str, str]:
+def compress_media(input_path: str, probe: dict = None, content_hash: str = None,
+                   plan: dict = None, on_progress=None, should_cancel=None) -> tuple[str, str]:
     """
     Возвращает (путь_к_сжатому_файлу, mime_type)
-    Если это видео - сжимает размер кадра, но ОСТАВЛЯЕТ ВИДЕО.
-    Если аудио - конвертирует в легкий AAC.
+    Путь выбирается по данным ffprobe (см. choose_transcode_path):
+    перепаковка без перекодирования, извлечение аудио или полное сжатие видео.
+    plan - ступень из proxy_planner: размер, fps и битрейт видео под бюджет.
+    on_progress(info) получает процент/скорость/ETA, should_cancel() - флаг отмены:
+    при отмене ffmpeg останавливается, недописанный файл удаляется, летит TranscodeCancelled.
+    Готовые прокси кэшируются по SHA-256 исходника (см. transcode_cache) -
+    файл из кэша принадлежит кэшу, удалять его нельзя.
     """
-    # Определяем, видео это или аудио, с помощью ffprobe (или по расширению)
-    ext = input_path.split('.')[-1].lower()
-    is_video = ext in ['mp4', 'mov', 'avi', 'mkv', 'webm']
-    
+    if probe is None:
+        probe = probe_media(input_path)
+
+    if probe:
+        path_kind = choose_transcode_path(probe)
+        duration_s = probe["duration_ms"] / 1000
+        # Перепаковка сохраняет исходный размер и fps - если они не влезают в план, кодируем
+        if path_kind == "copy" and plan and (
+                (probe.get("size") or 0) > plan["target_bytes"] or plan["fps"] < 1):
+            path_kind = "encode"
+    else:
+        # ffprobe не справился - действуем по старинке, по расширению
+        ext = input_path.split('.')[-1].lower()
+        path_kind = "encode" if ext in ['mp4', 'mov', 'avi', 'mkv', 'webm'] else "audio"
+        duration_s = 0
+    is_video = path_kind in ("copy", "encode")
+    if plan is not None:
+        plan["path"] = path_kind  # какой путь реально выбран (для записи в agent_run.meta)
+
     output_filename = f"{os.path.splitext(input_path)[0]}_compressed"
-    
-    if is_video:
+
+    if path_kind == "copy":
+        # Видео уже подходит Gemini: только перепаковываем в mp4 (секунды вместо минут).
+        # Лишние потоки (субтитры, таймкод) отбрасываем, аудио копируем, если это уже AAC.
+        output_path = f"{output_filename}.mp4"
+        audio_codec = ["-c:a", "copy"] if (probe.get("audio") or {}).get("codec") == "aac" \
+            else ["-c:a", "aac", "-ac", "1", "-ar", "16000"]
+        command = [
+            "ffmpeg", "-y", "-i", input_path,
+            "-map", "0:v:0", "-map", "0:a:0?",
+            "-c:v", "copy",
+            *audio_codec,
+            "-movflags", "+faststart",
+            output_path
+        ]
+        mime = "video/mp4"
+    elif path_kind == "encode":
         # Сжимаем ВИДЕО:
         # -vf scale=640:-2 : Уменьшаем ширину до 640px (высота авто), чтобы Gemini видел картинку, но файл был легким
         # -crf 28 : Среднее качество (чем выше число, тем хуже качество и меньше вес)
         # -r 24 : 24 кадра в секунду
+        # Если есть план (см. proxy_planner) - берем его ступень вместо этих значений
         output_path = f"{output_filename}.mp4"
-        command = [
-            "ffmpeg", "-y", "-i", input_path,
+        video_args = planned_video_args(plan) if plan else [
             "-vf", "scale=640:-2,format=yuv420p", # Принудительный формат пикселей yuv420p
             "-c:v", "libx264", 
             "-profile:v", "high", # Профиль совместимости
@@ -69,12 +137,12 @@ def compress_media(input_path: str) -> tuple[str, str]:
             "-crf", "28", 
             "-preset", "faster", 
             "-r", "24",
-            "-c:a", "aac", "-ac", "1", "-ar", "16000",
-            output_path
         ]
+        audio_args = ["-c:a", "aac", "-ac", "1", "-ar", "16000"]
+        command = ["ffmpeg", "-y", "-i", input_path, *video_args, *audio_args, output_path]
         mime = "video/mp4"
     else:
-        # Сжимаем АУДИО (как раньше):
+        # Видеодорожки нет - извлекаем легкий AAC:
         output_path = f"{output_filename}.m4a"
         command = [
             "ffmpeg", "-y", "-i", input_path,
@@ -83,13 +151,45 @@ def compress_media(input_path: str) -> tuple[str, str]:
         ]
         mime = "audio/mp4"
 
+    # Кэш прокси: тот же исходник + те же параметры ffmpeg = тот же результат
+    cache_key = None
+    if transcode_cache.enabled():
+        try:
+            content_hash = content_hash or transcode_cache.file_sha256(input_path)
+            cache_key = transcode_cache.make_key(content_hash, [path_kind, *command[4:-1]])
+            cached = transcode_cache.lookup(cache_key, os.path.splitext(output_path)[1])
+            if cached:
+                return cached, mime
+        except Exception as e:
+            print(f"⚠️ Transcode Cache Error: {e}")
+
     try:
-        print(f"🎬 Starting Compression ({mime}) for {input_path}...")
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print(f"🎬 Starting Compression [{path_kind}] ({mime}) for {input_path}...")
+        started = time.time()
+        done = False
+        # Длинный фильм кодируем кусками параллельно (TRANSCODE_SEGMENTED=off - отключить)
+        if path_kind == "encode" and use_segmented(duration_s):
+            done = encode_segmented(input_path, output_path, video_args, audio_args, duration_s,
+                                    on_progress=on_progress, should_cancel=should_cancel,
+                                    has_audio=bool(probe["audio"]) if probe else True)
+            if done:
+                path_kind = "segmented"
+            else:
+                print("⚠️ Сегментное кодирование не удалось, кодируем одним процессом")
+        if not done:
+            run_ffmpeg(command, duration_s, on_progress=on_progress, should_cancel=should_cancel)
         if os.path.exists(output_path):
+            record_transcode(path_kind, duration_s, time.time() - started)
             size_mb = os.path.getsize(output_path) / (1024 * 1024)
             print(f"✅ Compression success: {output_path} ({size_mb:.2f} MB)")
+            if cache_key:
+                output_path = transcode_cache.store(cache_key, output_path)
             return output_path, mime
+    except TranscodeCancelled:
+        print(f"⛔ Compression cancelled: {input_path}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
     except Exception as e:
         print(f"⚠️ FFmpeg Error: {e}")
         # Если сжатие не вышло, вернем оригинал
@@ -97,48 +197,87 @@ def compress_media(input_path: str) -> tuple[str, str]:
     
     return input_path, "application/octet-stream"
 
-def upload_to_gemini(path: str, mime_type: str):
-    """Загрузка с мгновенным отловом ошибок обработки"""
+def upload_to_gemini(path: str, mime_type: str, api_key: str = None, on_progress=None, should_cancel=None):
+    """Загрузка (gemini_uploader: куски с прогрессом, опрос ACTIVE с нарастающим интервалом). None - не вышло."""
     print(f"☁️ Uploading to Gemini: {path}")
     try:
-        file = genai.upload_file(path, mime_type=mime_type)
-        
-        # Ждем готовности
-        start_time = time.time()
-        while file.state.name == "PROCESSING":
-            time.sleep(3)
-            file = genai.get_file(file.name)
-            # Если маленький файл обрабатывается дольше 40 секунд - это уже подозрительно
-            if time.time() - start_time > 300:
-                print("❌ Google застрял на обработке (возможно, несовместимый кодек).")
-                return None
-
-        if file.state.name == "FAILED":
-            print(f"❌ Google не смог обработать файл. Состояние: {file.state.name}")
-            return None
-
-        print(f"✅ Файл ACTIVE за {int(time.time() - start_time)} сек.")
-        return file
+        return gemini_uploader.upload_file(path, mime_type, api_key, on_progress, should_cancel)
+    except TranscodeCancelled:
+        raise
     except Exception as e:
         print(f"❌ Ошибка API Google при загрузке: {e}")
         return None
 
-def get_rag_context(db, profile, query_text, api_key):
-    """Ищет в базе 5 самых похожих исправленных кейсов через векторный поиск"""
+def quota_backoff(error: Exception, attempt: int, base_wait: float = 15) -> float:
+    """Пауза после 429: подсказка Google (retry_delay), иначе экспонента с разбросом."""
+    hint = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    if hint:
+        return int(hint.group(1)) + random.uniform(1, 5)
+    return base_wait * (2 ** attempt) + random.uniform(1, 5)
+
+def generate_report(model_name: str, content: list, on_status=None, api_key: str = None, est_tokens: int = None,
+                    should_cancel=None, reschedule: bool = False):
+    """
+    Генерация под общим лимитом (rate_limiter) с повтором при 429.
+    reschedule=True: при 429 не ждем в процессе, а бросаем QuotaExceeded -
+    задача сохранит чекпоинт и перезапустится с отсрочкой.
+    Возвращает разобранный JSON или None (пустой ответ).
+    """
+    model = genai.GenerativeModel(model_name)
+    est_tokens = est_tokens or rate_limiter.estimate_tokens(content)
+
+    def report_wait(wait_s, position):
+        if on_status:
+            on_status(f'Очередь к Google: ~{int(wait_s)}с' + (f', впереди {position}' if position else ''))
+
+    response = None
+    max_retries = 5
+    base_wait = 15
+    
+    for attempt in range(max_retries):
+        try:
+            with rate_limiter.limited(api_key, model_name, est_tokens, should_cancel=should_cancel,
+                                      on_wait=report_wait):
+                response = model.generate_content(
+                    content,
+                    generation_config={"response_mime_type": "application/json"},
+                    safety_settings=SAFETY_SETTINGS
+                )
+            usage = getattr(response, "usage_metadata", None)
+            rate_limiter.settle(api_key, model_name, est_tokens, getattr(usage, "total_token_count", None))
+            break
+        except Exception as e:
+            if "429" in str(e) or "Quota" in str(e):
+                wait = quota_backoff(e, attempt, base_wait)
+                if reschedule:
+                    raise rate_limiter.QuotaExceeded(wait, str(e)[:300])
+                if on_status:
+                    on_status(f'Лимит Google. Ждем {int(wait)}с...')
+                # Пауза ставится на ведро всего кластера: следующая попытка ждет в общей
+                # очереди вместе со всеми, а не ломится одновременно с ними
+                if not rate_limiter.penalize(api_key, model_name, wait):
+                    time.sleep(wait)
+            else: raise e
+
+    if not response or not response.text: return None
+    return json.loads(clean_json_text(response.text))
+
+def get_rag_context(db, profile, query_text, api_key, policy_stats: dict = None, select_policies: bool = True):
+    """
+    Политики профиля (обязательные + самые близкие к материалу, см. policy_index)
+    и 5 самых похожих исправленных кейсов через векторный поиск.
+    select_policies=False (нет описания материала) - в промпт все политики профиля.
+    """
     try:
-        # 1. Загружаем Политики (как и раньше)
+        # Один вектор описания материала - и для политик, и для памяти
+        vector = get_embedding(query_text, api_key)
+
+        # 1. Политики (эмбеддинги требований считаются при сиде / /reload, не здесь)
         pub_query = "YouTube%" if profile == "youtube" else "НТВ%"
-        sql_pol = text("""
-            SELECT r.req_code, r.summary, r.full_text 
-            FROM legal_requirement r
-            JOIN legal_doc d ON r.doc_id = d.id
-            WHERE d.publisher LIKE :pub
-        """)
-        policies = db.execute(sql_pol, {"pub": pub_query}).fetchall()
-        policies_text = "\n".join([f"- [{p.req_code}] {p.summary}" for p in policies])
+        policies = policy_index.select(db, pub_query, vector if select_policies else None, policy_stats)
+        policies_text = policy_index.format_policies(policies)
 
         # 2. ВЕКТОРНЫЙ ПОИСК ПО ПАМЯТИ (Semantic RAG)
-        vector = get_embedding(query_text, api_key)
         human_examples = "Похожих примеров не найдено."
         
         if vector:
@@ -161,21 +300,70 @@ def get_rag_context(db, profile, query_text, api_key):
         print(f"⚠️ RAG Error: {e}")
         return "Ошибка политик", "Ошибка памяти"
 
-def save_results_to_db(db, asset_id, result_json, model_name):
+def build_prompt(db, profile, query_text, api_key, taxonomy_text=None, policy_stats: dict = None,
+                 select_policies: bool = True):
+    """
+    Системный промпт с политиками, таксономией и похожими кейсами. Возвращает (prompt, human_examples).
+    policy_stats (если передан) - сколько политик отобрано и оценка токенов промпта до/после отбора.
+    """
+    policy_stats = policy_stats if policy_stats is not None else {}
+    policies_text, human_examples = get_rag_context(db, profile, query_text, api_key, policy_stats,
+                                                    select_policies)
+    
+    # Таксономия - из снимка конфигурации (reloader); если его нет - напрямую из базы
+    if taxonomy_text is None:
+        taxonomy_res = db.execute(text("SELECT code, title FROM taxonomy_label")).fetchall()
+        taxonomy_text = "\n".join([f"- {t.code}: {t.title}" for t in taxonomy_res])
+
+    # Собираем финальный промпт через .replace (чтобы не сломать JSON-скобки)
+    prompt = SYSTEM_PROMPT_TEMPLATE.replace("{policies_text}", policies_text)
+    prompt = prompt.replace("{taxonomy_text}", taxonomy_text)
+    prompt = prompt.replace("{human_examples}", human_examples)
+
+    if "tokens_all" in policy_stats:
+        # Промпт, как он был бы со всеми политиками, и фактический - для сравнения
+        prompt_tokens = rate_limiter.estimate_tokens([prompt])
+        policy_stats["prompt_tokens_all"] = prompt_tokens + policy_stats["tokens_all"] - policy_stats["tokens_selected"]
+        policy_stats["prompt_tokens"] = prompt_tokens
+        incr_metric("policies", "prompt_tokens_all", policy_stats["prompt_tokens_all"])
+        incr_metric("policies", "prompt_tokens", prompt_tokens)
+        incr_metric("policies", "prompts")
+        print(f"📜 Политики: {policy_stats['selected']} из {policy_stats['total']} "
+              f"(обязательных {policy_stats['mandatory']}), промпт ~{policy_stats['prompt_tokens_all']} "
+              f"-> ~{prompt_tokens} токенов")
+    return prompt, human_examples
+
+def save_asset(db, filename, mime_type, duration_ms, metadata):
+    init_db()
+    asset_res = db.execute(text("""
+        INSERT INTO media_asset (filename, mime_type, duration_ms, metadata)
+        VALUES (:fn, :mime, :dur, :meta)
+        RETURNING id
+    """), {
+        "fn": filename,
+        "mime": mime_type,
+        "dur": duration_ms,
+        "meta": json.dumps(metadata)
+    }).fetchone()
+    return asset_res.id
+
+def save_results_to_db(db, asset_id, result_json, model_name, cache_key=None, run_meta=None):
     try:
         risk = result_json.get('overall', {}).get('risk_level', 'UNKNOWN')
         conf = result_json.get('overall', {}).get('confidence', 0.0)
         
         run_res = db.execute(text("""
-            INSERT INTO agent_run (asset_id, model, output_json, overall_risk, overall_confidence)
-            VALUES (:aid, :model_name, :json, :risk, :conf)
+            INSERT INTO agent_run (asset_id, model, output_json, overall_risk, overall_confidence, cache_key, meta)
+            VALUES (:aid, :model_name, :json, :risk, :conf, :cache_key, :meta)
             RETURNING id
         """), {
             "aid": asset_id,
             "model_name": model_name,  # <--- ВОТ ЭТОГО НЕ ХВАТАЛО
             "json": json.dumps(result_json),
             "risk": risk,
-            "conf": conf
+            "conf": conf,
+            "cache_key": cache_key,
+            "meta": json.dumps(run_meta) if run_meta else None
         }).fetchone()
         run_id = run_res.id
 
@@ -221,14 +409,120 @@ def save_results_to_db(db, asset_id, result_json, model_name):
     
     
 
+def _cached_result(cached, source: str) -> dict:
+    """Отчет из agent_run в том же виде, что отдает свежий анализ."""
+    asset_id, output = cached
+    result = dict(output)
+    result['_asset_id'] = asset_id
+    result['_cache'] = source
+    return result
+
+def analyze_document_file(db, file_path, filename, api_key, model_name, profile, cache_key, report_status, snapshot):
+    """Текстовый путь: страницы -> куски -> запросы к модели -> один отчет."""
+    started = time.time()
+    report_status('Чтение документа...')
+    # Словарный прескрининг идет тем же проходом по страницам
+    hits = []
+    chunks = list(iter_chunks(scan_pages(iter_pages(file_path), snapshot.lexicon, hits)))
+    if not chunks:
+        return {"error": "Document has no extractable text."}
+    pages = chunks[-1]["page_end"]
+    chars = sum(len(c["text"]) for c in chunks)
+    print(f"📄 Документ: {pages} стр., {chars} символов, {len(chunks)} кусков, словарь: {len(hits)} совпадений")
+
+    policy_stats = {}
+    prompt, human_examples = build_prompt(db, profile, f"{filename} {chunks[0]['text'][:1000]}", api_key,
+                                          snapshot.taxonomy_text, policy_stats)
+    instruction = f"ПРОФИЛЬ ПРОВЕРКИ: {profile.upper()}. Анализируй контент строго по предоставленным политикам."
+
+    def build_content(chunk):
+        chunk_hits = [h for h in hits if chunk['page_start'] <= h['page'] <= chunk['page_end']]
+        content = [prompt, instruction, DOCUMENT_INSTRUCTION,
+                   f"Файл: {filename}. Страницы {chunk['page_start']}-{chunk['page_end']} из {pages}.",
+                   format_hints(chunk_hits), chunk["text"]]
+        return [x for x in content if x]
+
+    report_status('AI читает документ...')
+    result_data, failed = analyze_chunks(
+        chunks, build_content,
+        generate_fn=lambda c: generate_report(model_name, c, api_key=api_key),
+        on_progress=lambda done, total: report_status(f'AI читает документ: части {done}/{total}')
+    )
+    if result_data is None:
+        return {"error": "Empty response."}
+
+    document = {"pages": pages, "chars": chars, "chunks": len(chunks), "failed_chunks": failed,
+                "lexicon_hits": len(hits), "seconds": round(time.time() - started, 1)}
+    ext = os.path.splitext(file_path)[1].lower()
+    asset_id = save_asset(db, filename, DOCUMENT_MIME.get(ext, "application/octet-stream"),
+                          (pages + 1) * PAGE_MS, {"document": document})
+    save_results_to_db(db, asset_id, result_data, model_name, cache_key,
+                       run_meta={"document": document, "config_version": snapshot.version,
+                                 "policies": policy_stats})
+
+    result_data['_asset_id'] = str(asset_id)
+    result_data['_retrieved_context'] = human_examples
+    result_data['_document'] = document
+    result_data['_policies'] = policy_stats
+    result_data['_config_version'] = snapshot.version
+    result_data['_prescreen'] = to_evidence(hits)
+    return result_data
+
+@task_prerun.connect
+def refresh_config(**kwargs):
+    # Между задачами: если вышла новая версия реестров/таксономии - собираем снимок до старта
+    try:
+        reloader.refresh()
+    except Exception as e:
+        print(f"⚠️ Reload Error: {e}")
+
 # --- MAIN TASK ---
 
 @app.task(bind=True)
-def analyze_media_task(self, file_path: str, filename: str, api_key: str, model_name: str, profile: str = "ntv"):
+def analyze_media_task(self, file_path: str, filename: str, api_key: str, model_name: str, profile: str = "ntv",
+                       content_hash: str = None, use_cache: bool = True, reuse_duplicates: bool = False,
+                       analysis_mode: str = "full", trim_silence: bool = False, cue_sheet: bool = False):
     # ^^^ ДОБАВИЛ model_name В АРГУМЕНТЫ ^^^
     
     files_cleanup = []
     compressed_path = None
+    trimmed_path = None
+    keyframes_dir = None
+    db = None
+    cache_key = None
+    run_key = None
+    lock_owner = None
+    resumed = None
+    rescheduled = False
+    # Пауз по квоте до этой попытки (self.request.retries считает и повторы последователя)
+    quota_attempt = 0
+    # Файл в Google из реестра (file_registry): удаляет не задача, а sweep_idle, когда он никому не нужен
+    proxy_hash = None
+    leased = False
+
+    # self.request - thread-local, а этапы графа идут в других потоках: id берем заранее
+    task_id = self.request.id
+
+    def report_status(status, **extra):
+        self.update_state(task_id=task_id, state='PROGRESS', meta={'status': status, **extra})
+
+    # Отмена: флаг cancel:<task_id> в Redis (ставит POST /cancel/{task_id})
+    def should_cancel():
+        return is_cancelled(task_id)
+
+    def check_cancel():
+        if should_cancel():
+            raise TranscodeCancelled()
+
+    def report_compress_progress(info):
+        parts = ["Сжатие видео/аудио"]
+        if info["percent"] is not None:
+            parts.append(f"{info['percent']:.0f}%")
+        if info["speed"]:
+            parts.append(f"x{info['speed']}")
+        if info["eta_s"] is not None:
+            parts.append(f"осталось ~{info['eta_s'] // 60}:{info['eta_s'] % 60:02d}")
+        report_status(" ".join(parts), progress=info)
     
     try:
         genai.configure(api_key=api_key)
@@ -237,98 +531,490 @@ def analyze_media_task(self, file_path: str, filename: str, api_key: str, model_
         print(f"🤖 Using Model: {model_name}")
         MODEL_NAME = model_name 
 
-        # 1. ОБРАБОТКА (ТЕПЕРЬ С ВИДЕО!)
-        self.update_state(state='PROGRESS', meta={'status': 'Сжатие видео/аудио...'})
-        # Функция теперь возвращает путь И mime-type
-        compressed_path, mime_type = compress_media(file_path)
-        
-        target_file = compressed_path if compressed_path else file_path
+        db = SessionLocal()
+        init_db()
+        # Реестры и таксономия этой задачи: снимок не меняется до ее конца,
+        # даже если во время анализа выйдет новая версия
+        snapshot = reloader.current()
 
-        # 2. Shazam
-        shazam_text = ""
+        # Повтор после паузы по квоте: все до генерации уже сделано и лежит в чекпоинте.
+        # Файлы прошлой попытки берем сразу: если задача закончится раньше генерации
+        # (готовый отчет в кэше), их уберет finally
+        resumed = checkpoint.load(task_id) if self.request.retries else None
+        if resumed:
+            print(f"⏯ Продолжаем задачу {task_id} с генерации (повтор {self.request.retries})")
+            compressed_path, trimmed_path = resumed["compressed_path"], resumed["trimmed_path"]
+            keyframes_dir = resumed["keyframes_dir"]
+            proxy_hash, leased = resumed.get("proxy_hash"), resumed.get("leased", False)
+            if resumed["media_file"] and not leased:
+                files_cleanup.append(resumed["media_file"])
+
+        # 0. КЭШ РЕЗУЛЬТАТОВ: тот же файл + модель + профиль + версии политик = готовый отчет
         try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            res = loop.run_until_complete(recognize_music(target_file))
-            loop.close()
-            if res: shazam_text = f"SHAZAM IDENTIFICATION: {res}"
-        except: pass
-
-        # 3. Загрузка (С подробным дебагом)
-        self.update_state(state='PROGRESS', meta={'status': 'Отправка в Google Cloud...'})
-        media_f = upload_to_gemini(target_file, mime_type)
-        
-        if not media_f:
-            # Возвращаем клиенту подробную ошибку (она будет в консоли воркера)
-            return {"error": "Upload failed. Check Worker Logs for details."}
-            
-        files_cleanup.append(media_f)
+            if content_hash is None:
+                content_hash = transcode_cache.file_sha256(file_path)
+            run_params = (
+                MODEL_NAME, profile,
+                result_cache.policy_version(db), result_cache.prompt_version(),
+                analysis_mode + ("+trim" if trim_silence else "") + ("+cues" if cue_sheet else "")
+                + (f"+cat{audio_landmarks.catalog_version()}" if audio_landmarks.catalog_version() else "")
+                + (f"+pol{policy_index.TOP_K}" if policy_index.TOP_K > 0 else "")
+            )
+            cache_key = result_cache.make_key(content_hash, *run_params)
+            # Тот же ключ без хеша файла: отчет похожего актива годится, только если он
+            # получен с теми же моделью, профилем и версиями политик (см. reuse_duplicates)
+            run_key = result_cache.make_key(None, *run_params)
+        except Exception as e:
+            print(f"⚠️ Result Cache Error: {e}")
+            db.rollback()
 
-        # 4. RAG
-        db = SessionLocal()
-        
-        policies_text, human_examples = get_rag_context(db, profile, f"{filename} {shazam_text}", api_key)
-        
-        # Мы берем таксономию напрямую из базы, так как она статична
-        taxonomy_res = db.execute(text("SELECT code, title FROM taxonomy_label")).fetchall()
-        taxonomy_text = "\n".join([f"- {t.code}: {t.title}" for t in taxonomy_res])
+        if cache_key and not use_cache:
+            # Принудительный перезапуск: не читаем кэш и не ждем чужих задач
+            result_cache.record("bypass")
+        elif cache_key:
+            cached = result_cache.lookup(db, cache_key)
+            if cached:
+                # На повторе - отчет лидера, которого мы ждали
+                outcome = "shared" if self.request.retries else "hit"
+                result_cache.record(outcome)
+                return _cached_result(cached, outcome)
 
-        # Собираем финальный промпт через .replace (чтобы не сломать JSON-скобки)
-        prompt = SYSTEM_PROMPT_TEMPLATE.replace("{policies_text}", policies_text)
-        prompt = prompt.replace("{taxonomy_text}", taxonomy_text)
-        prompt = prompt.replace("{human_examples}", human_examples)
-        
-        visual_instruction = f"ПРОФИЛЬ ПРОВЕРКИ: {profile.upper()}. Анализируй контент строго по предоставленным политикам. ВАЖНО: Анализируй ВИДЕОРЯД. Обращай внимание на мимику, жесты и контекст происходящего (комедия, ссора, игра)."
+            # Single-flight: если такой же анализ уже идет - второй не запускаем и не ждем
+            # его в слоте воркера, а уходим на повтор (LeaderRunning); лидер упал без
+            # результата - блокировку на повторе возьмет первый успевший последователь
+            owner = task_id or str(uuid.uuid4())
+            if not result_cache.acquire(cache_key, owner):
+                raise result_cache.LeaderRunning(result_cache.leader(cache_key),
+                                                 result_cache.follow_countdown(self.request.retries))
+            lock_owner = owner
+            # Лидер мог сохранить отчет и снять блокировку между lookup и acquire
+            cached = result_cache.lookup(db, cache_key)
+            if cached:
+                result_cache.record("shared")
+                return _cached_result(cached, "shared")
+            result_cache.record("miss")
 
-        content = [prompt, visual_instruction, f"Файл: {filename}. {shazam_text}", media_f]
-        content = [x for x in content if x is not None]
+        # Документы (PDF/DOCX): только текст - без ffmpeg, Shazam и загрузки файла
+        if is_document(file_path):
+            return analyze_document_file(db, file_path, filename, api_key, MODEL_NAME, profile,
+                                         cache_key, report_status, snapshot)
 
-        # 5. Генерация
-        self.update_state(state='PROGRESS', meta={'status': 'AI думает...'})
-        model = genai.GenerativeModel(MODEL_NAME)
-        
-        response = None
-        max_retries = 5
-        base_wait = 15
-        
-        for attempt in range(max_retries):
+        # 1. ОБРАБОТКА (ТЕПЕРЬ С ВИДЕО!)
+        # Сначала ffprobe: от него зависит, нужно ли вообще перекодировать
+        probe = resumed["probe"] if resumed else probe_media(file_path)
+
+        # 1a. Отпечатки: не перезаливка ли это уже проверенной программы?
+        prints = resumed["prints"] if resumed else compute_fingerprints(file_path, probe)
+        near_duplicates = []
+        if resumed:
+            near_duplicates = resumed["near_duplicates"]
+        else:
             try:
-                response = model.generate_content(
-                    content,
-                    generation_config={"response_mime_type": "application/json"},
-                    safety_settings=SAFETY_SETTINGS
-                )
-                break
+                near_duplicates = find_near_duplicates(db, prints)
             except Exception as e:
-                if "429" in str(e) or "Quota" in str(e):
-                    wait = base_wait * (2 ** attempt) + random.uniform(1, 5)
-                    self.update_state(state='PROGRESS', meta={'status': f'Лимит Google. Ждем {int(wait)}с...'})
-                    time.sleep(wait)
-                else: raise e
+                print(f"⚠️ Fingerprint Lookup Error: {e}")
+                db.rollback()
+        if near_duplicates:
+            print(f"👯 Похожие активы: {near_duplicates}")
+        if reuse_duplicates and near_duplicates and run_key:
+            # Берем самый похожий актив, у которого есть прогон с тем же run_key
+            for best in near_duplicates:
+                try:
+                    run = db.execute(text("""
+                        SELECT output_json FROM agent_run
+                        WHERE asset_id = :aid AND model = :model AND meta->>'run_key' = :run_key
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    """), {"aid": best["asset_id"], "model": MODEL_NAME, "run_key": run_key}).fetchone()
+                except Exception as e:
+                    print(f"⚠️ Near Duplicate Lookup Error: {e}")
+                    db.rollback()
+                    break
+                if run:
+                    output = run.output_json if isinstance(run.output_json, dict) else json.loads(run.output_json)
+                    result = _cached_result((best["asset_id"], output), "near_duplicate")
+                    result['_near_duplicates'] = near_duplicates
+                    return result
 
-        if not response or not response.text: return {"error": "Empty response."}
+        # 1b-5. Дальше - граф этапов (stage_graph): на критическом пути только
+        # сжатие -> загрузка -> генерация, а каталог/Shazam и RAG идут параллельно
+        # с загрузкой и ожиданием обработки файла в Google
+        frames = []
+        proxy_plan = None
+        mime_type = None
+        target_file = file_path
+        trim_table, trim_stats = None, None
+        analysis_duration_ms = probe["duration_ms"] if probe else 0
+        payload = None
+        windowed = False
+        shazam_text = ""
+        cues, cue_stats = [], None
+        catalog_cues, catalog_stats = [], None
+        media_f = None
+        prompt, human_examples = None, None
+        policy_stats = {}
+        visual_instruction = f"ПРОФИЛЬ ПРОВЕРКИ: {profile.upper()}. Анализируй контент строго по предоставленным политикам. ВАЖНО: Анализируй ВИДЕОРЯД. Обращай внимание на мимику, жесты и контекст происходящего (комедия, ссора, игра)."
+        result_data, windows_status = None, None
+        stage_report = {}
+
+        def checkpoint_state():
+            return {
+                "probe": probe, "prints": prints, "near_duplicates": near_duplicates,
+                "frames": frames, "proxy_plan": proxy_plan, "mime_type": mime_type, "target_file": target_file,
+                "compressed_path": compressed_path, "trimmed_path": trimmed_path, "keyframes_dir": keyframes_dir,
+                "trim_table": trim_table, "trim_stats": trim_stats, "analysis_duration_ms": analysis_duration_ms,
+                "payload": payload, "windowed": windowed, "shazam_text": shazam_text,
+                "cues": cues, "cue_stats": cue_stats, "catalog_cues": catalog_cues, "catalog_stats": catalog_stats,
+                "prompt": prompt, "human_examples": human_examples, "policy_stats": policy_stats,
+                "media_file": media_f.name if media_f else None, "stage_report": stage_report,
+                "proxy_hash": proxy_hash, "leased": leased, "quota_attempt": quota_attempt + 1,
+            }
+
+        if resumed:
+            frames, proxy_plan, mime_type = resumed["frames"], resumed["proxy_plan"], resumed["mime_type"]
+            target_file, compressed_path = resumed["target_file"], resumed["compressed_path"]
+            trimmed_path, keyframes_dir = resumed["trimmed_path"], resumed["keyframes_dir"]
+            trim_table, trim_stats = resumed["trim_table"], resumed["trim_stats"]
+            analysis_duration_ms, payload = resumed["analysis_duration_ms"], resumed["payload"]
+            windowed, shazam_text = resumed["windowed"], resumed["shazam_text"]
+            cues, cue_stats = resumed["cues"], resumed["cue_stats"]
+            catalog_cues, catalog_stats = resumed["catalog_cues"], resumed["catalog_stats"]
+            prompt, human_examples = resumed["prompt"], resumed["human_examples"]
+            policy_stats = resumed.get("policy_stats") or {}
+            quota_attempt = resumed.get("quota_attempt", 0)
+
+        def stage_transcode(results):
+            nonlocal keyframes_dir, frames, proxy_plan, compressed_path, mime_type, target_file
+            # Режим "ключевые кадры + аудио": кадры по сменам сцен, в прокси - только звук
+            if analysis_mode == "keyframes" and probe and probe.get("video"):
+                report_status('Поиск смен сцен...')
+                keyframes_dir = f"{os.path.splitext(file_path)[0]}_keyframes"
+                try:
+                    frames = extract_keyframes(file_path, keyframes_dir)
+                except Exception as e:
+                    print(f"⚠️ Keyframes Error: {e}. Переходим на обычное видео.")
+
+            check_cancel()
+            report_status('Сжатие видео/аудио...')
+            # Функция теперь возвращает путь И mime-type
+            if frames:
+                compressed_path, mime_type = compress_media(file_path, {**probe, "video": None}, content_hash,
+                                                            on_progress=report_compress_progress,
+                                                            should_cancel=should_cancel)
+            else:
+                # План прокси по длительности: ступень лестницы под бюджет токенов и размера
+                proxy_plan = plan_encoding(probe, window_s=WINDOW_S if analysis_mode == "windowed" else None)
+                if proxy_plan and proxy_plan["over_budget"]:
+                    print(f"⚠️ Материал не влезает в бюджет даже на ступени {proxy_plan['name']} "
+                          f"(~{proxy_plan['est_tokens']} токенов) - лучше оконный режим")
+                compressed_path, mime_type = compress_media(file_path, probe, content_hash, proxy_plan,
+                                                            on_progress=report_compress_progress,
+                                                            should_cancel=should_cancel)
+
+            target_file = compressed_path if compressed_path else file_path
+            if proxy_plan:
+                proxy_plan["actual_bytes"] = os.path.getsize(target_file)
+                print(f"📐 План прокси: {proxy_plan['name']} ({proxy_plan['path']}), "
+                      f"оценка {proxy_plan['est_bytes'] / 1048576:.1f} MB, факт {proxy_plan['actual_bytes'] / 1048576:.1f} MB")
+
+        def stage_trim(results):
+            nonlocal trimmed_path, trim_table, trim_stats, target_file, analysis_duration_ms, payload, windowed
+            # Тишина: из аудио (радио, подкасты) вырезаем паузы, таймкоды вернем перед сохранением
+            if trim_silence and not frames and mime_type.startswith("audio") and analysis_duration_ms:
+                report_status('Поиск тишины...')
+                try:
+                    # Прокси может лежать в общем кэше: результат пишем рядом с загрузкой, с task_id в имени
+                    trimmed_path, trim_table, trim_stats = silence_trim.trim_silence(
+                        target_file, analysis_duration_ms,
+                        output_path=f"{os.path.splitext(file_path)[0]}_{task_id}_trimmed.m4a")
+                    print(f"🔇 Тишина: вырезано {trim_stats['removed_pct']}% ({trim_stats['spans']} кусков)")
+                except Exception as e:
+                    print(f"⚠️ Silence Trim Error: {e}")
+                if trimmed_path:
+                    target_file = trimmed_path
+                    analysis_duration_ms = trim_stats["kept_ms"]
+                    incr_metric("payload", "silence_removed_ms", trim_stats["removed_ms"])
+
+            # Сколько байт уходит в модель (для сравнения режимов)
+            if frames:
+                payload = payload_report(frames, target_file, probe["duration_ms"])
+            else:
+                payload = {"mode": analysis_mode, "total_bytes": os.path.getsize(target_file)}
+            incr_metric("payload", f"{payload['mode']}_runs")
+            incr_metric("payload", f"{payload['mode']}_bytes", payload["total_bytes"])
+
+            # Оконный режим: длинный материал режется на окна, каждое загружается отдельно
+            windowed = analysis_mode == "windowed" and analysis_duration_ms > 0
+
+        def stage_catalog(results):
+            nonlocal catalog_cues, catalog_stats
+            # Сначала свой каталог (локальные отпечатки, без сети): он знает библиотечную
+            # музыку и черный список, а уже опознанные места не уходят во внешний сервис
+            catalog_index = audio_landmarks.get_index() if audio_landmarks.CATALOG_MODE != "off" else None
+            if catalog_index is None or not (probe and probe.get("audio")):
+                return
+            report_status('Поиск музыки в каталоге...')
+            catalog_cues, catalog_stats = catalog_index.match(compressed_path or file_path)
+            print(f"🎼 Каталог: {len(catalog_cues)} фрагментов, {catalog_stats}")
+
+        async def stage_music(results):
+            nonlocal shazam_text, cues, cue_stats
+            # Shazam режет прокси до вырезания тишины, чтобы таймкоды сразу были по исходному файлу
+            external_music = audio_landmarks.CATALOG_MODE != "only"
+            if external_music and cue_sheet and analysis_duration_ms:
+                # Все музыкальные фрагменты по окнам
+                report_status('Распознавание музыки...')
+                try:
+                    cues, cue_stats = await build_cue_sheet_async(
+                        compressed_path or file_path, probe["duration_ms"] / 1000,
+                        on_progress=lambda done, total: report_status(f'Распознавание музыки: окна {done}/{total}'),
+                        should_cancel=should_cancel,
+                        skip_spans=[(c["start_ms"], c["end_ms"]) for c in catalog_cues]
+                    )
+                    shazam_text = cue_sheet_text(cues)
+                    print(f"🎵 Cue sheet: {len(cues)} фрагментов, {cue_stats}")
+                except Exception as e:
+                    print(f"⚠️ Cue Sheet Error: {e}")
+            elif external_music and not catalog_cues:
+                try:
+                    res = await recognize_music(compressed_path or file_path)
+                    if res: shazam_text = f"SHAZAM IDENTIFICATION: {res}"
+                except: pass
+            if catalog_cues:
+                shazam_text = "\n\n".join(filter(None, [audio_landmarks.cue_sheet_text(catalog_cues), shazam_text]))
+
+        def stage_upload(results):
+            nonlocal media_f, proxy_hash, leased
+            # 3. Загрузка (С подробным дебагом)
+            if windowed:
+                return
+            check_cancel()
+            # Тот же прокси уже в Google (прогон с другим профилем или моделью) - берем готовый файл
+            proxy_hash = transcode_cache.file_sha256(target_file)
+            media_f = file_registry.lookup(api_key, proxy_hash, task_id)
+            if media_f:
+                leased = True
+                print(f"♻️ Файл {media_f.name} уже в Google, загрузка не нужна")
+                report_status('Файл уже в Google Cloud, загрузка не нужна', progress={"percent": 100.0})
+                return
+            report_status('Отправка в Google Cloud...')
+
+            def report_upload(sent, total):
+                percent = sent * 100 / total if total else 100.0
+                report_status(f'Отправка в Google Cloud: {sent / 1048576:.0f} из {total / 1048576:.0f} MB',
+                              progress={"percent": percent})
+
+            media_f = upload_to_gemini(target_file, mime_type, api_key, report_upload, should_cancel)
+            if not media_f:
+                # Возвращаем клиенту подробную ошибку (она будет в консоли воркера)
+                raise RuntimeError("Upload failed. Check Worker Logs for details.")
+            incr_metric("gemini_files", "uploaded")
+            leased = file_registry.register(api_key, proxy_hash, media_f, task_id)
+            if not leased:
+                files_cleanup.append(media_f)
+
+        def stage_rag(results):
+            nonlocal prompt, human_examples
+            # 4. RAG; из этапов графа сессией db пользуется только он
+            # Политики подбираются по краткому описанию материала (кадры, музыка);
+            # без ключевых кадров описание строится по нескольким кадрам исходника
+            has_video = bool(probe and probe.get("video"))
+            query_text, summarized = policy_index.quick_summary(
+                frames, filename, shazam_text, api_key, should_cancel,
+                media_path=file_path if has_video else None,
+                duration_ms=probe["duration_ms"] if has_video else 0)
+            policy_stats["summary"] = summarized
+            prompt, human_examples = build_prompt(db, profile, query_text, api_key,
+                                                  snapshot.taxonomy_text, policy_stats, summarized)
+
+        def stage_generate(results):
+            nonlocal result_data, windows_status
+            # 5. Генерация
+            report_status('AI думает...')
+            if windowed:
+                def build_window_content(window_file, start_ms, end_ms):
+                    return [prompt, visual_instruction, window_instruction(start_ms, end_ms),
+                            f"Файл: {filename}. {shazam_text}", window_file]
+
+                result_data, windows_status = analyze_windows(
+                    target_file, mime_type, analysis_duration_ms, build_window_content,
+                    upload_fn=lambda path, mime: upload_to_gemini(path, mime, api_key),
+                    upload_many_fn=lambda items, on_progress: gemini_uploader.iter_uploads(
+                        items, api_key, on_progress, should_cancel
+                    ),
+                    generate_fn=lambda c: generate_report(MODEL_NAME, c, api_key=api_key, should_cancel=should_cancel),
+                    on_progress=lambda done, total, snapshot: report_status(
+                        f'AI думает: окна {done}/{total}', windows=snapshot
+                    ),
+                    # Окна режем рядом с загрузкой задачи, а не рядом с прокси в общем кэше
+                    work_dir=os.path.dirname(file_path)
+                )
+                return
+
+            content = [prompt, visual_instruction, f"Файл: {filename}. {shazam_text}", media_f]
+            if frames:
+                content += [KEYFRAME_INSTRUCTION, *keyframe_parts(frames)]
+            content = [x for x in content if x is not None]
+            # Пока есть попытки - при 429 не ждем в процессе, а уходим на повтор с чекпоинтом
+            result_data = generate_report(
+                MODEL_NAME, content, on_status=report_status, api_key=api_key, should_cancel=should_cancel,
+                est_tokens=rate_limiter.estimate_tokens(content, proxy_plan["est_tokens"] if proxy_plan else None),
+                reschedule=quota_attempt < QUOTA_MAX_RETRIES
+            )
+
+        def stage_reattach(results):
+            nonlocal media_f
+            # Файл уже в Google с прошлой попытки (живет 48 часов) - загружать заново не нужно
+            if not resumed["media_file"]:
+                return
+            media_f = genai.get_file(resumed["media_file"])
+            if media_f.state.name != "ACTIVE":
+                raise RuntimeError(f"Uploaded file {media_f.name} is {media_f.state.name}")
+            if leased:
+                file_registry.renew(api_key, proxy_hash, task_id)
+
+        if resumed:
+            stages = [Stage("reattach", stage_reattach), Stage("generate", stage_generate, deps=["reattach"])]
+        else:
+            stages = [
+                Stage("transcode", stage_transcode),
+                Stage("trim", stage_trim, deps=["transcode"]),
+                Stage("catalog", stage_catalog, deps=["transcode"], optional=True),
+                Stage("music", stage_music, deps=["catalog"], optional=True),
+                Stage("upload", stage_upload, deps=["trim"]),
+                Stage("rag", stage_rag, deps=["music"]),
+                Stage("generate", stage_generate, deps=["upload", "rag"]),
+            ]
+        try:
+            stage_graph.execute(stages, stage_report)
+        finally:
+            print(format_report(stage_report))
+        if resumed:
+            # В отчет - и прогон до паузы, чтобы было видно, сколько заняло ожидание квоты
+            stage_report["before_retry"] = resumed["stage_report"]
+
+        if windowed and not any(w["state"] == "DONE" for w in windows_status):
+            return {"error": "All analysis windows failed.", "_windows": windows_status}
+
+        if result_data is None: return {"error": "Empty response."}
+        if trim_table:
+            # Таймкоды модели - по обрезанному файлу, в базу пишем по исходному
+            silence_trim.remap_report(result_data, trim_table)
+        if cues:
+            # Музыка из cue sheet - отдельные доказательства audio_span (попадут в таблицу evidence)
+            result_data.setdefault('evidence', []).extend(cues_to_evidence(cues))
+        if catalog_cues:
+            result_data.setdefault('evidence', []).extend(audio_landmarks.cues_to_evidence(catalog_cues))
+
+        # Словарный проход по репликам из отчета: мат и реестры, которые модель могла не отметить
+        try:
+            prescreen = to_evidence(scan_report(result_data, snapshot.lexicon))
+        except Exception as e:
+            print(f"⚠️ Lexicon Error: {e}")
+            prescreen = []
 
         # 6. Финиш
-        result_data = json.loads(clean_json_text(response.text))
+        asset_id = save_asset(db, filename, mime_type, probe["duration_ms"] if probe else 0, {"probe": probe})
         
-        init_db()
-        asset_res = db.execute(text("INSERT INTO media_asset (filename, duration_ms) VALUES (:fn, 0) RETURNING id"), {"fn": filename}).fetchone()
-        asset_id = asset_res.id
-        
-        save_results_to_db(db, asset_id, result_data, MODEL_NAME)
-        db.close()
+        run_meta = {"config_version": snapshot.version, "stages": stage_report, "run_key": run_key}
+        if proxy_plan:
+            run_meta["proxy_plan"] = proxy_plan
+        if trim_stats:
+            run_meta["silence_trim"] = trim_stats
+        if cue_stats:
+            run_meta["cue_sheet"] = cue_stats
+        if catalog_stats:
+            run_meta["music_catalog"] = catalog_stats
+        if policy_stats:
+            run_meta["policies"] = policy_stats
+        save_results_to_db(db, asset_id, result_data, MODEL_NAME, cache_key, run_meta=run_meta)
+        try:
+            save_fingerprints(db, asset_id, prints)
+        except Exception as e:
+            print(f"⚠️ Fingerprint Save Error: {e}")
+            db.rollback()
         
         result_data['_asset_id'] = str(asset_id)
         result_data['_retrieved_context'] = human_examples 
+        result_data['_near_duplicates'] = near_duplicates
+        if windows_status:
+            result_data['_windows'] = windows_status
+        result_data['_payload'] = payload
+        result_data['_config_version'] = snapshot.version
+        result_data['_stages'] = stage_report
+        if prescreen:
+            result_data['_prescreen'] = prescreen
+        if proxy_plan:
+            result_data['_proxy_plan'] = proxy_plan
+        if trim_stats:
+            result_data['_silence_trim'] = trim_stats
+        if cue_stats:
+            result_data['_cue_sheet'] = {**cue_stats, "cues": [{k: c[k] for k in ("start_ms", "end_ms", "title", "artist")} for c in cues]}
+        if catalog_stats:
+            result_data['_music_catalog'] = {**catalog_stats, "cues": [
+                {k: c[k] for k in ("start_ms", "end_ms", "title", "artist", "status", "track_offset_s", "votes")}
+                for c in catalog_cues
+            ]}
+        if frames:
+            result_data['_keyframes'] = [{"index": f["index"], "t_ms": f["t_ms"]} for f in frames]
+        if policy_stats:
+            result_data['_policies'] = policy_stats
 
         return result_data
 
+    except result_cache.LeaderRunning as e:
+        # Повтор после паузы по квоте, чью блокировку за время паузы взяли: чекпоинт и файлы ему еще нужны
+        rescheduled = resumed is not None
+        print(f"⏳ {e}")
+        raise self.retry(exc=e, countdown=e.countdown,
+                         max_retries=result_cache.FOLLOW_MAX_RETRIES + QUOTA_MAX_RETRIES)
+    except rate_limiter.QuotaExceeded as e:
+        # 429: сохраняем сделанное и отпускаем слот воркера до повтора, а не спим в нем
+        countdown = quota_backoff(e, quota_attempt)
+        rate_limiter.penalize(api_key, model_name, countdown)
+        if lock_owner:
+            # Блокировку single-flight держим до повтора: иначе такая же задача возьмет ее
+            # и пройдет весь конвейер второй раз, пока мы ждем квоту
+            result_cache.extend(cache_key, lock_owner, countdown + result_cache.LOCK_TTL_S)
+            lock_owner = None
+        try:
+            checkpoint.save(task_id, checkpoint_state(), countdown, quota_attempt)
+            rescheduled = True
+        except Exception as save_error:
+            # Без чекпоинта повтор просто пройдет задачу заново
+            print(f"⚠️ Checkpoint Save Error: {save_error}")
+        print(f"⏸ Квота Google: задача {task_id} продолжится через {int(countdown)} с")
+        raise self.retry(exc=e, countdown=countdown,
+                         max_retries=result_cache.FOLLOW_MAX_RETRIES + QUOTA_MAX_RETRIES)
+    except TranscodeCancelled:
+        # Временные файлы уберет finally; REVOKED + Ignore, чтобы Celery не перезаписал статус
+        print(f"⛔ Task {self.request.id} cancelled")
+        self.update_state(state=states.REVOKED, meta={'status': 'Отменено'})
+        raise Ignore()
     except Exception as e:
         print(f"CRITICAL: {e}")
         return {"error": str(e)}
     finally:
-        for f in files_cleanup: 
-            try: f.delete() 
-            except: pass
-        if compressed_path and os.path.exists(compressed_path): 
-            os.remove(compressed_path)
\ No newline at end of file
+        if lock_owner:
+            result_cache.release(cache_key, lock_owner)
+        if db is not None:
+            db.close()
+        # При паузе по квоте файл в Google, прокси и кадры нужны повтору - их уберет он
+        if not rescheduled:
+            if resumed:
+                checkpoint.drop(task_id)
+            if leased:
+                file_registry.release(api_key, proxy_hash, task_id)
+                # Ключ есть только у задачи: заодно убираем давно никому не нужные файлы этого ключа
+                file_registry.sweep_idle(api_key)
+            for f in files_cleanup:
+                # Строка - имя файла в Google из чекпоинта (handle не получали)
+                try: genai.delete_file(f) if isinstance(f, str) else f.delete()
+                except: pass
+            if compressed_path and compressed_path != file_path and os.path.exists(compressed_path) \
+                    and not transcode_cache.is_cached_path(compressed_path):
+                os.remove(compressed_path)
+            if keyframes_dir:
+                cleanup_keyframes(keyframes_dir)
+            if trimmed_path and os.path.exists(trimmed_path):
+                os.remove(trimmed_path)
\ No newline at end of file
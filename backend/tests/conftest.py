@@ -0,0 +1,18 @@
+# backend/tests/conftest.py
+import os
+import sys
+
+import pytest
+
+# Модули backend плоские (в контейнере WORKDIR /app): импортируем их так же, как воркер
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Redis для всех модулей backend (redis_helper.get_redis) - fakeredis в памяти, Lua через lupa."""
+    fakeredis = pytest.importorskip("fakeredis")
+    import redis_helper
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_helper, "_client", client)
+    return client
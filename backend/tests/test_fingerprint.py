@@ -0,0 +1,38 @@
+# backend/tests/test_fingerprint.py
+import types
+
+import pytest
+
+pytest.importorskip("numpy")
+import fingerprint
+from fingerprint import find_near_duplicates
+
+AUDIO = [(0, 0x0123456789ABCDEF), (1000, 0x0F0F0F0F0F0F0F0F), (2000, 0x7777000011112222)]
+
+
+class FakeDB:
+    """asset_fingerprint - все отпечатки одного актива; media_asset/agent_run - одна строка."""
+
+    def __init__(self, stored):
+        self.stored = stored
+
+    def execute(self, query, params):
+        if "FROM asset_fingerprint" in str(query):
+            rows = [types.SimpleNamespace(asset_id="a1", hash=h, **{f"c{i}": c for i, c in
+                                                                     enumerate(fingerprint._chunks(h))})
+                    for _, h in self.stored.get(params["kind"], [])]
+            return types.SimpleNamespace(fetchall=lambda: rows)
+        row = types.SimpleNamespace(filename="old.m4a", run_id="r1", model="m", overall_risk="LOW")
+        return types.SimpleNamespace(fetchone=lambda: row)
+
+
+def test_kind_without_query_hashes_does_not_halve_the_score():
+    # Аудиофайл: видеоотпечатков у запроса нет, совпал весь звук
+    found = find_near_duplicates(FakeDB({"audio": AUDIO}), {"video": [], "audio": AUDIO}, threshold=0.9)
+    assert [(d["asset_id"], d["score"]) for d in found] == [("a1", 1.0)]
+
+
+def test_both_kinds_are_averaged():
+    video = [(0, 0x1111111111111111), (1000, 0x2222222222222222)]
+    found = find_near_duplicates(FakeDB({"audio": AUDIO}), {"video": video, "audio": AUDIO}, threshold=0.1)
+    assert found[0]["score"] == 0.5
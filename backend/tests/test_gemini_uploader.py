@@ -0,0 +1,145 @@
+# backend/tests/test_gemini_uploader.py
+import uuid
+import socket
+import asyncio
+import threading
+
+import pytest
+
+web = pytest.importorskip("aiohttp.web")
+pytest.importorskip("google.generativeai")
+import gemini_uploader
+from gemini_uploader import iter_uploads, upload_file, UploadError
+
+GRANULARITY = 256 * 1024
+PROCESSING_POLLS = 3
+
+
+def file_service_app(state):
+    """
+    Локальная заглушка Files API: resumable-загрузка (start, куски с проверкой смещения,
+    finalize) и PROCESSING на несколько опросов. Поведение файла - по имени:
+    ready - сразу ACTIVE, bad - FAILED, stuck - PROCESSING навсегда.
+    """
+    async def start(request):
+        body = await request.json()
+        sid = uuid.uuid4().hex
+        state["sessions"][sid] = {
+            "size": int(request.headers["X-Goog-Upload-Header-Content-Length"]),
+            "mime": request.headers["X-Goog-Upload-Header-Content-Type"],
+            "display": body["file"]["display_name"], "got": 0,
+        }
+        return web.Response(headers={"X-Goog-Upload-URL": f"http://{request.host}/up/{sid}",
+                                     "X-Goog-Upload-Chunk-Granularity": str(GRANULARITY)})
+
+    async def chunk(request):
+        session = state["sessions"][request.match_info["sid"]]
+        data = await request.read()
+        if int(request.headers["X-Goog-Upload-Offset"]) != session["got"]:
+            return web.Response(status=400, text="bad offset")
+        session["got"] += len(data)
+        state["chunks"].append((session["display"], len(data)))
+        if "finalize" not in request.headers["X-Goog-Upload-Command"]:
+            return web.Response()
+        if session["got"] != session["size"]:
+            return web.Response(status=400, text="size mismatch")
+        name = f"files/{uuid.uuid4().hex[:8]}"
+        state["files"][name] = {"display": session["display"], "mime": session["mime"], "polls": 0}
+        return web.json_response({"file": resource(name, "ACTIVE" if "ready" in session["display"] else "PROCESSING")})
+
+    async def get(request):
+        name = f"files/{request.match_info['id']}"
+        file = state["files"][name]
+        file["polls"] += 1
+        state["polls"].append(file["display"])
+        if "bad" in file["display"]:
+            status = "FAILED" if file["polls"] >= 2 else "PROCESSING"
+        elif "stuck" in file["display"]:
+            status = "PROCESSING"
+        else:
+            status = "ACTIVE" if file["polls"] >= PROCESSING_POLLS else "PROCESSING"
+        return web.json_response(resource(name, status))
+
+    def resource(name, status):
+        file = state["files"][name]
+        return {"name": name, "displayName": file["display"], "mimeType": file["mime"],
+                "uri": f"http://files.local/v1beta/{name}", "state": status}
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/upload/v1beta/files", start)
+    app.router.add_post("/up/{sid}", chunk)
+    app.router.add_get("/v1beta/files/{id}", get)
+    return app
+
+
+@pytest.fixture
+def file_service(monkeypatch, fake_redis):
+    """Заглушка на своем event loop в отдельном потоке; загрузчик ходит в нее по HTTP."""
+    state = {"sessions": {}, "files": {}, "chunks": [], "polls": []}
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(file_service_app(state))
+    loop.run_until_complete(runner.setup())
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    loop.run_until_complete(web.SockSite(runner, sock).start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(gemini_uploader, "API_BASE", f"http://127.0.0.1:{sock.getsockname()[1]}")
+    monkeypatch.setattr(gemini_uploader, "CHUNK_BYTES", GRANULARITY)
+    monkeypatch.setattr(gemini_uploader, "POLL_FIRST_S", 0.05)
+    monkeypatch.setattr(gemini_uploader, "POLL_MAX_S", 0.2)
+    yield state
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+
+
+def media(tmp_path, name: str, size: int) -> str:
+    path = tmp_path / name
+    path.write_bytes(b"\0" * size)
+    return str(path)
+
+
+def test_chunked_upload_with_progress_until_active(file_service, tmp_path):
+    size = 2 * GRANULARITY + 1000
+    progress = []
+    handle = upload_file(media(tmp_path, "clip.mp4", size), "video/mp4", "K",
+                         on_progress=lambda sent, total: progress.append((sent, total)))
+    assert handle.name.startswith("files/")
+    assert handle.state.name == "ACTIVE"
+    assert [n for _, n in file_service["chunks"]] == [GRANULARITY, GRANULARITY, 1000]
+    assert progress == [(GRANULARITY, size), (2 * GRANULARITY, size), (size, size)]
+    assert file_service["polls"].count("clip.mp4") == PROCESSING_POLLS
+
+
+def test_handles_are_returned_as_they_become_active(file_service, tmp_path):
+    items = [(media(tmp_path, "slow.mp4", 1000), "video/mp4"),
+             (media(tmp_path, "ready.mp4", 1000), "video/mp4")]
+    results = list(iter_uploads(items, "K"))
+    assert [i for i, _, _ in results] == [1, 0]
+    assert all(handle is not None and error is None for _, handle, error in results)
+    # Готовый сразу файл не опрашивается вовсе
+    assert "ready.mp4" not in file_service["polls"]
+
+
+def test_many_files_in_flight_and_one_failure(file_service, tmp_path):
+    items = [(media(tmp_path, f"part{i}.mp4", 5000), "video/mp4") for i in range(5)]
+    items.append((media(tmp_path, "bad.mp4", 5000), "video/mp4"))
+    results = {i: (handle, error) for i, handle, error in iter_uploads(items, "K")}
+    assert sorted(results) == list(range(6))
+    assert all(results[i][0] is not None for i in range(5))
+    handle, error = results[5]
+    assert handle is None and "FAILED" in error
+
+
+def test_processing_timeout(file_service, tmp_path, monkeypatch):
+    monkeypatch.setattr(gemini_uploader, "PROCESSING_TIMEOUT_S", 0.3)
+    with pytest.raises(UploadError, match="still PROCESSING"):
+        upload_file(media(tmp_path, "stuck.mp4", 1000), "video/mp4", "K")
+
+
+def test_upload_error_is_reported(file_service, tmp_path, monkeypatch):
+    monkeypatch.setattr(gemini_uploader, "API_BASE", gemini_uploader.API_BASE + "/missing")
+    with pytest.raises(UploadError, match="upload: start 404"):
+        upload_file(media(tmp_path, "clip.mp4", 1000), "video/mp4", "K")
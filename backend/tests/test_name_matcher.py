@@ -0,0 +1,26 @@
+# backend/tests/test_name_matcher.py
+from name_matcher import NameMatcher
+
+RECORDS = [
+    {"name": name, "status": "Иноагент", "req_code": "RF_255_MENTION_LABEL", "source": "foreign_agents.json"}
+    for name in ["Навальный Алексей Анатольевич", "Певчих Мария Константиновна", "Медуза"]
+]
+
+
+def names(matcher, text):
+    return [(h["quote"], h["term"]) for h in matcher.scan(text)]
+
+
+def test_surname_in_any_form_matches():
+    matcher = NameMatcher(RECORDS)
+    for mention in ["Навальному", "А. Навальный", "Alexei Navalny", "Навальный Алексей"]:
+        assert matcher.match(mention)[0]["name"] == "Навальный Алексей Анатольевич", mention
+    assert names(matcher, "Вчера Марию Певчих спросили") == [("Марию Певчих", "Певчих Мария Константиновна")]
+
+
+def test_lone_first_name_does_not_match():
+    matcher = NameMatcher(RECORDS)
+    # В таком реестре у "Алексей" тот же IDF, что у фамилии, но это не упоминание Навального
+    assert matcher.match("Алексей") == []
+    assert matcher.match("Алексей Анатольевич") != []
+    assert names(matcher, "Ведущий Алексей и гость Мария обсудили погоду.") == []
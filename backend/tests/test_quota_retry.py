@@ -0,0 +1,151 @@
+# backend/tests/test_quota_retry.py
+import os
+import time
+import types
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("google.generativeai")
+# database.py создает engine при импорте; соединение не открывается - базу заменяет FakeDB
+os.environ.setdefault("DATABASE_URL", "postgresql+psycopg2://test@localhost/test")
+import tasks
+import checkpoint
+import rate_limiter
+import result_cache
+
+QUOTA_ERROR = "429 Resource has been exhausted (e.g. check quota). retry_delay { seconds: 1 }"
+
+
+class FakeDB:
+    def execute(self, *args, **kwargs):
+        raise RuntimeError("no database in tests")
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeFile:
+    def __init__(self, name):
+        self.name = name
+        self.state = types.SimpleNamespace(name="ACTIVE")
+
+    def delete(self):
+        pass
+
+
+@pytest.fixture
+def pipeline(monkeypatch, fake_redis, tmp_path):
+    """
+    Конвейер analyze_media_task без ffmpeg, Google и Postgres: каждый этап пишет
+    себя в calls, первая генерация отвечает 429. Celery в apply() выполняет
+    self.retry сразу (eager), так что повтор идет в том же вызове.
+    """
+    calls, seen = [], {"lock_ttl": [], "countdown": [], "blocked_for": []}
+    media = tmp_path / "film.m4a"
+    media.write_bytes(b"\0" * 1000)
+
+    monkeypatch.setattr(tasks, "SessionLocal", FakeDB)
+    monkeypatch.setattr(tasks, "init_db", lambda: None)
+    monkeypatch.setattr(tasks.reloader, "current",
+                        lambda: types.SimpleNamespace(version=1, taxonomy_text="", lexicon=None))
+    monkeypatch.setattr(tasks.transcode_cache, "file_sha256", lambda path: "hash")
+    monkeypatch.setattr(result_cache, "policy_version", lambda db: "p1")
+    monkeypatch.setattr(result_cache, "lookup", lambda db, key: None)
+    monkeypatch.setattr(result_cache, "LOCK_TTL_S", 2)
+    # Без разброса: пауза ровно retry_delay из ответа Google
+    monkeypatch.setattr(tasks.random, "uniform", lambda a, b: 0)
+
+    def probe(path):
+        calls.append("probe")
+        return {"duration_ms": 60000, "audio": {"codec": "aac"}, "video": None}
+
+    def compress(path, probe, content_hash, plan=None, on_progress=None, should_cancel=None):
+        calls.append("transcode")
+        return None, "audio/mp4"
+
+    def upload(path, mime, api_key=None, on_progress=None, should_cancel=None):
+        calls.append("upload")
+        return FakeFile("files/abc")
+
+    def get_file(name):
+        calls.append(f"reattach {name}")
+        return FakeFile(name)
+
+    async def recognize(path):
+        return None
+
+    class Model:
+        def __init__(self, name):
+            pass
+
+        def generate_content(self, content, **kwargs):
+            calls.append("generate")
+            if calls.count("generate") == 1:
+                raise Exception(QUOTA_ERROR)
+            return types.SimpleNamespace(text='{"overall": {"risk_level": "LOW"}, "evidence": []}',
+                                         usage_metadata=types.SimpleNamespace(total_token_count=100))
+
+    monkeypatch.setattr(tasks, "probe_media", probe)
+    monkeypatch.setattr(tasks, "compute_fingerprints", lambda path, probe: {"audio": [1, 2, 3]})
+    monkeypatch.setattr(tasks, "find_near_duplicates", lambda db, prints: [])
+    monkeypatch.setattr(tasks, "plan_encoding", lambda probe, window_s=None: None)
+    monkeypatch.setattr(tasks, "compress_media", compress)
+    monkeypatch.setattr(tasks, "upload_to_gemini", upload)
+    monkeypatch.setattr(tasks, "recognize_music", recognize)
+    monkeypatch.setattr(tasks.policy_index, "quick_summary", lambda *args, **kwargs: ("film", False))
+    monkeypatch.setattr(tasks, "build_prompt", lambda *args: ("PROMPT", []))
+    monkeypatch.setattr(tasks, "scan_report", lambda report, lexicon: [])
+    monkeypatch.setattr(tasks, "save_asset", lambda *args: "asset-1")
+    monkeypatch.setattr(tasks, "save_results_to_db", lambda *args, **kwargs: None)
+    monkeypatch.setattr(tasks, "save_fingerprints", lambda *args: None)
+    monkeypatch.setattr(tasks.genai, "configure", lambda **kwargs: None)
+    monkeypatch.setattr(tasks.genai, "get_file", get_file)
+    monkeypatch.setattr(tasks.genai, "GenerativeModel", Model)
+    monkeypatch.setattr(tasks.analyze_media_task, "update_state", lambda *args, **kwargs: None)
+
+    save = checkpoint.save
+
+    def save_and_inspect(task_id, state, countdown, attempt):
+        save(task_id, state, countdown, attempt)
+        lock = fake_redis.keys("singleflight:*")
+        seen["lock_ttl"].append(fake_redis.ttl(lock[0]) if lock else None)
+
+    monkeypatch.setattr(checkpoint, "save", save_and_inspect)
+
+    retry = tasks.analyze_media_task.retry
+
+    def retry_and_inspect(*args, **kwargs):
+        seen["countdown"].append(kwargs["countdown"])
+        blocked_until = fake_redis.hget(rate_limiter.bucket_key("K", "m"), "blocked_until")
+        seen["blocked_for"].append(int(blocked_until) / 1000 - time.time() if blocked_until else None)
+        return retry(*args, **kwargs)
+
+    monkeypatch.setattr(tasks.analyze_media_task, "retry", retry_and_inspect)
+    return types.SimpleNamespace(media=str(media), calls=calls, seen=seen)
+
+
+def test_quota_pause_checkpoints_and_resumes_at_generation(pipeline, fake_redis):
+    result = tasks.analyze_media_task.apply(args=(pipeline.media, "film.m4a", "K", "m"), task_id="t-1")
+    assert result.state == "SUCCESS", result.result
+    report = result.result
+
+    # Повтор не перекодирует и не загружает: файл из чекпоинта и сразу генерация
+    assert pipeline.calls == ["probe", "transcode", "upload", "generate", "reattach files/abc", "generate"]
+    assert "before_retry" in report["_stages"]
+    assert report["overall"]["risk_level"] == "LOW"
+
+    # Блокировка single-flight продлена на паузу: countdown + LOCK_TTL_S, а не просто LOCK_TTL_S
+    assert pipeline.seen["lock_ttl"] == [int(1 + result_cache.LOCK_TTL_S)]
+
+    # Отсрочка повтора - та же пауза, что поставлена на ведро лимитера
+    (countdown,), (blocked_for,) = pipeline.seen["countdown"], pipeline.seen["blocked_for"]
+    assert countdown == 1
+    assert blocked_for == pytest.approx(countdown, abs=0.5)
+
+    # После успешного повтора не остается ни чекпоинта, ни блокировки
+    assert not fake_redis.keys("checkpoint:*")
+    assert not fake_redis.keys("singleflight:*")
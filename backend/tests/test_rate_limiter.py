@@ -0,0 +1,113 @@
+# backend/tests/test_rate_limiter.py
+import time
+import threading
+
+import pytest
+
+import rate_limiter
+from redis_helper import get_metrics
+
+
+@pytest.fixture
+def limits(monkeypatch, fake_redis):
+    """Квоты тестовой модели "m"; BURST_S маленький, чтобы тесты шли секунды."""
+    def configure(burst_s: float, **quota):
+        monkeypatch.setitem(rate_limiter.LIMITS, "m", quota)
+        monkeypatch.setattr(rate_limiter, "BURST_S", burst_s)
+    return configure
+
+
+def test_burst_then_steady_rate(limits):
+    # 600 rpm = 10 запросов/с, емкость ведра 5: пять сразу, остальные по 100 мс
+    limits(0.5, rpm=600)
+    started = time.time()
+    for _ in range(5):
+        rate_limiter.acquire("K", "m")
+    assert time.time() - started < 0.3
+    for _ in range(10):
+        rate_limiter.acquire("K", "m")
+    assert 0.8 < time.time() - started < 2.5
+
+
+def test_tokens_per_minute(limits):
+    # 60000 tpm = 1000 токенов/с, емкость 1000
+    limits(1, tpm=60000)
+    assert rate_limiter.acquire("K", "m", 1000) < 0.1
+    waited = rate_limiter.acquire("K", "m", 500)
+    assert 0.35 < waited < 1.5
+
+
+def test_settle_returns_unused_tokens(limits, fake_redis):
+    limits(1, tpm=60000)
+    rate_limiter.acquire("K", "m", 800)
+    rate_limiter.settle("K", "m", 800, 300)
+    assert float(fake_redis.hget(rate_limiter.bucket_key("K", "m"), "tok")) >= 700
+
+
+def test_keys_and_models_have_separate_buckets(limits):
+    limits(0.1, rpm=600)
+    started = time.time()
+    rate_limiter.acquire("K1", "m")
+    rate_limiter.acquire("K2", "m")
+    rate_limiter.acquire("K1", "other")
+    assert time.time() - started < 0.2
+
+
+def test_penalize_pauses_everyone(limits):
+    limits(1, rpm=600)
+    assert rate_limiter.penalize("K", "m", 0.5)
+    waited = rate_limiter.acquire("K", "m")
+    assert 0.4 < waited < 1.5
+
+
+def test_waiters_are_served_in_arrival_order(limits):
+    # Ведро на один запрос: первый его съедает, остальные встают в очередь по порядку прихода
+    limits(0.1, rpm=600)
+    rate_limiter.acquire("K", "m")
+    served = []
+
+    def waiter(i):
+        rate_limiter.acquire("K", "m")
+        served.append(i)
+
+    threads = []
+    for i in range(4):
+        thread = threading.Thread(target=waiter, args=(i,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join(10)
+    assert served == [0, 1, 2, 3]
+
+
+def test_timeout_leaves_queue(limits, fake_redis, monkeypatch):
+    limits(0.1, rpm=60)
+    monkeypatch.setattr(rate_limiter, "ACQUIRE_TIMEOUT_S", 0.2)
+    rate_limiter.acquire("K", "m")
+    with pytest.raises(rate_limiter.RateLimitTimeout):
+        rate_limiter.acquire("K", "m")
+    assert fake_redis.zcard(f"{rate_limiter.bucket_key('K', 'm')}:queue") == 0
+
+
+def test_wait_and_call_metrics(limits):
+    limits(1, rpm=600)
+    with rate_limiter.limited("K", "m", kind="generate"):
+        time.sleep(0.05)
+    metrics = get_metrics("ratelimit")
+    assert metrics["generate_calls"] == 1
+    assert metrics["generate_call_s"] >= 0.05
+    assert "generate_wait_s" in metrics
+
+
+def test_redis_down_fails_open(limits, monkeypatch):
+    limits(0.1, rpm=1)
+
+    def broken():
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(rate_limiter, "get_redis", broken)
+    started = time.time()
+    for _ in range(3):
+        rate_limiter.acquire("K", "m")
+    assert time.time() - started < 0.5
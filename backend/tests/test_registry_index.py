@@ -0,0 +1,88 @@
+# backend/tests/test_registry_index.py
+import json
+
+import pytest
+
+import lexicon
+import name_matcher
+import registry_index
+
+FOREIGN_AGENTS = [
+    {"name": "Навальный Алексей Анатольевич", "status": "Иноагент"},
+    {"name": "Фонд борьбы с коррупцией (ФБК)", "aliases": ["FBK"], "status": "Иноагент"},
+    "Медуза",
+]
+TERRORISTS = [
+    {"name": "Исламское государство (ИГИЛ)", "aliases": ["Даиш"], "status": "Террористическая организация"},
+    "Движение Таблиги Джамаат",
+]
+BLACKLIST = [{"name": "Meta", "aliases": ["Instagram"], "status": "Экстремистская организация"}]
+MAT_ROOTS = [{"root": "хуй", "match": "prefix"}]
+
+
+@pytest.fixture
+def registries(tmp_path, monkeypatch):
+    for name, data in [("foreign_agents.json", FOREIGN_AGENTS), ("rosfin_terrorists.json", TERRORISTS),
+                       ("blacklist.json", BLACKLIST), ("mat_roots.json", MAT_ROOTS)]:
+        (tmp_path / name).write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    for module in (registry_index, lexicon, name_matcher):
+        monkeypatch.setattr(module, "REGISTRIES_DIR", str(tmp_path))
+    monkeypatch.setattr(registry_index, "INDEX_PATH", str(tmp_path / "registry.idx"))
+    monkeypatch.setattr(registry_index, "_index", None)
+    return tmp_path
+
+
+def test_lookup_aliases_and_parenthesised_parts(registries):
+    registry_index.compile_index()
+    index = registry_index.get_index()
+    assert index.lookup("ФБК")[0]["name"] == "Фонд борьбы с коррупцией (ФБК)"
+    assert index.lookup("фонд  борьбы, с коррупцией")[0]["aliases"] == ["FBK"]
+    assert index.lookup("Даиш")[0]["source"] == "rosfin_terrorists.json"
+    assert index.lookup("Медуза") == [{"text": "Медуза", "source": "foreign_agents.json"}]
+    assert index.lookup("Неизвестный") == []
+    assert index.has_prefix("исламское") and not index.has_prefix("исламский")
+    assert index.max_words == 5  # "фонд борьбы с коррупцией фбк"
+
+
+def test_payloads_are_listed_once_per_record(registries):
+    registry_index.compile_index()
+    payloads = list(registry_index.get_index().iter_payloads({"foreign_agents.json"}))
+    assert len(payloads) == len(FOREIGN_AGENTS)
+
+
+def test_index_is_rebuilt_when_missing_or_stale(registries):
+    assert registry_index.ensure_index() is not None
+    (registries / "registry.idx").write_bytes(b"RIDX\x01\x00" + b"\0" * 32)
+    assert registry_index.ensure_index().lookup("Медуза")
+
+
+def test_lexicon_reads_names_from_the_index(registries, monkeypatch):
+    lex = lexicon.build_lexicon()
+    assert lex.index is not None
+    # В автомате остается только мат: имена реестров ищутся по индексу
+    assert {e["source"] for e in lex.entries} == {"mat_roots.json"}
+
+    text = ("Навальному передали привет от ФБК, Instagram принадлежит Meta, "
+            "бойцы ИГИЛ и Движение Таблиги Джамаат. Ну нахуй.")
+    hits = {h["quote"]: h for h in lex.scan(text) if h.get("match") != "fuzzy"}
+    assert hits["ФБК"]["req_code"] == "RF_255_MENTION_LABEL"
+    assert hits["Instagram"]["req_code"] == "RF_114_MEDIA_BAN"
+    assert hits["ИГИЛ"]["category"] == "Террористическая организация"
+    assert "Движение Таблиги Джамаат" in hits
+    assert "нахуй" in hits
+
+
+def test_index_and_json_lexicons_agree(registries):
+    text = "Медузе, ФБК и Фонду борьбы с коррупцией, а также Meta и Даишу. Медузаааа. Фбкшный"
+    exact = lambda lex: sorted((h["start"], h["end"], h["req_code"]) for h in lex.scan(text))
+    from_json = lexicon.Lexicon(lexicon.load_entries())
+    from_index = lexicon.build_lexicon()
+    from_index.names = None
+    assert exact(from_index) == exact(from_json)
+
+
+def test_name_matcher_records_from_the_index(registries):
+    registry_index.compile_index()
+    from_index = name_matcher.load_records(index=registry_index.get_index())
+    key = lambda r: (r["name"], r["source"])
+    assert sorted(from_index, key=key) == sorted(name_matcher.load_records(), key=key)
@@ -0,0 +1,121 @@
+# backend/tests/test_shazam_helper.py
+import json
+import asyncio
+
+import pytest
+
+pytest.importorskip("shazamio")
+import shazam_helper
+from shazam_helper import StubRecognizer, build_cue_sheet_async, cues_to_evidence
+
+CUES = [
+    {"start_s": 0, "end_s": 40, "title": "Intro", "artist": "Band"},
+    {"start_s": 60, "end_s": 100, "title": "Theme", "artist": "Composer"},
+]
+
+
+@pytest.fixture(autouse=True)
+def windows(monkeypatch):
+    """Окна 12 с с шагом 8 с; ffmpeg не нужен - заглушке достаточно пустого файла."""
+    monkeypatch.setattr(shazam_helper, "CUE_WINDOW_S", 12.0)
+    monkeypatch.setattr(shazam_helper, "CUE_HOP_S", 8.0)
+    monkeypatch.setattr(shazam_helper, "CUE_MAX_GAP", 1)
+
+    async def cut(input_path, start_s, end_s, output_path):
+        open(output_path, "wb").close()
+
+    monkeypatch.setattr(shazam_helper, "_cut_segment", cut)
+
+
+def test_plan_windows_covers_the_end():
+    windows = shazam_helper.plan_windows(30)
+    assert windows[0] == (0.0, 12.0)
+    assert windows[-1] == (18.0, 30.0)
+    assert shazam_helper.plan_windows(5) == [(0.0, 5)]
+    assert shazam_helper.plan_windows(0) == []
+
+
+def test_stub_cues_collapse_into_fragments():
+    cues, stats = asyncio.run(build_cue_sheet_async("in.m4a", 120, StubRecognizer(CUES)))
+    assert [(c["title"], c["start_ms"], c["end_ms"]) for c in cues] == [
+        ("Intro", 0, 44000),
+        ("Theme", 56000, 100000),
+    ]
+    assert stats["windows"] == len(shazam_helper.plan_windows(120))
+    assert stats["recognized"] == sum(c["windows"] for c in cues)
+    assert stats["cues"] == 2 and not stats["breaker_open"]
+
+
+def test_short_gap_does_not_split_a_fragment():
+    matches = [
+        (0, 12, {"key": "a", "title": "A", "artist": "X"}),
+        (8, 20, None),
+        (16, 28, {"key": "a", "title": "A", "artist": "X"}),
+    ]
+    cues = shazam_helper.collapse_matches(matches)
+    assert len(cues) == 1 and cues[0]["end_ms"] == 28000 and cues[0]["windows"] == 2
+
+
+def test_overlapping_neighbours_split_in_the_middle():
+    matches = [
+        (0, 12, {"key": "a", "title": "A", "artist": "X"}),
+        (8, 20, {"key": "b", "title": "B", "artist": "Y"}),
+    ]
+    first, second = shazam_helper.collapse_matches(matches)
+    assert first["end_ms"] == second["start_ms"] == 10000
+
+
+def test_circuit_breaker_stops_sending_windows(monkeypatch):
+    monkeypatch.setattr(shazam_helper, "BREAKER_FAILURES", 3)
+    monkeypatch.setattr(shazam_helper, "CUE_CONCURRENCY", 1)
+    calls = []
+
+    async def failing(segment_path, start_s, end_s):
+        calls.append(start_s)
+        raise ConnectionError("banned")
+
+    cues, stats = asyncio.run(build_cue_sheet_async("in.m4a", 120, failing))
+    assert cues == []
+    assert len(calls) == stats["failed"] == 3
+    assert stats["skipped"] == stats["windows"] - 3
+    assert stats["breaker_open"]
+
+
+def test_locally_known_spans_are_not_sent():
+    sent = []
+    stub = StubRecognizer(CUES)
+
+    async def recognizer(segment_path, start_s, end_s):
+        sent.append((start_s, end_s))
+        return await stub(segment_path, start_s, end_s)
+
+    cues, stats = asyncio.run(build_cue_sheet_async("in.m4a", 120, recognizer, skip_spans=[(0, 40000)]))
+    assert all((s + e) / 2 >= 40 for s, e in sent)
+    assert stats["local"] == stats["windows"] - len(sent)
+    assert [c["title"] for c in cues] == ["Theme"]
+
+
+def test_cancel_skips_remaining_windows():
+    cues, stats = asyncio.run(build_cue_sheet_async("in.m4a", 120, StubRecognizer(CUES),
+                                                     should_cancel=lambda: True))
+    assert cues == [] and stats["skipped"] == stats["windows"]
+
+
+def test_stub_recognizer_from_env_json(tmp_path, monkeypatch):
+    path = tmp_path / "cues.json"
+    path.write_text(json.dumps(CUES), encoding="utf-8")
+    monkeypatch.setattr(shazam_helper, "RECOGNIZER", "stub")
+    monkeypatch.setattr(shazam_helper, "STUB_CUES", str(path))
+    recognizer = shazam_helper.get_recognizer()
+    assert isinstance(recognizer, StubRecognizer)
+    assert asyncio.run(recognizer("w.wav", 60, 72))["title"] == "Theme"
+    assert asyncio.run(recognizer("w.wav", 40, 52)) is None
+
+
+def test_cues_become_audio_span_evidence():
+    cues, _ = asyncio.run(build_cue_sheet_async("in.m4a", 120, StubRecognizer(CUES)))
+    evidence = cues_to_evidence(cues)
+    assert [e["id"] for e in evidence] == ["music_1", "music_2"]
+    assert all(e["type"] == "audio_span" for e in evidence)
+    assert evidence[1]["text_quote"] == "Theme - Composer"
+    assert "Theme - Composer" in shazam_helper.cue_sheet_text(cues)
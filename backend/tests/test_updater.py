@@ -0,0 +1,150 @@
+# backend/tests/test_updater.py
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+import updater
+from updater import iter_json_array, publish, download_json
+
+AGENTS = [{"name": "Медуза", "status": "Иноагент"}, {"name": "Дождь", "status": "Иноагент"}]
+MATERIALS = [{"id": 1, "text": "Книга «А»"}, {"id": 2, "name": "Песня «Б»"}, {"id": 3, "text": ""}]
+ETAG = '"v1"'
+LAST_MODIFIED = "Sat, 17 Oct 2026 10:00:00 GMT"
+
+
+@pytest.fixture
+def registries(tmp_path, monkeypatch):
+    monkeypatch.setattr(updater, "REGISTRIES_FOLDER", str(tmp_path))
+    monkeypatch.setattr(updater, "STATE_FILE", str(tmp_path / ".state.json"))
+    return tmp_path
+
+
+@pytest.fixture
+def source():
+    """
+    Локальная заглушка зеркала открытых данных: отдает fixtures[path] кусками,
+    с ETag/Last-Modified (если etag задан) и 304 на совпавший If-None-Match.
+    """
+    state = {"fixtures": {"/agents.json": AGENTS, "/materials.json": MATERIALS}, "etag": ETAG, "requests": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"].append((self.path, dict(self.headers)))
+            if self.path not in state["fixtures"]:
+                self.send_response(404)
+                self.end_headers()
+                return
+            if state["etag"] and self.headers.get("If-None-Match") == state["etag"]:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps(state["fixtures"][self.path], ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if state["etag"]:
+                self.send_header("ETag", state["etag"])
+                self.send_header("Last-Modified", LAST_MODIFIED)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+    thread.join(10)
+
+
+def read(registries, filename):
+    return json.loads((registries / filename).read_text(encoding="utf-8"))
+
+
+def test_array_is_parsed_across_chunk_boundaries():
+    data = [{"name": "Фонд «Свобода»"}, 12345, "строка", [1, 2], None, -0.5]
+    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    # По байту: режутся и многобайтовые буквы, и числа
+    assert list(iter_json_array(raw[i:i + 1] for i in range(len(raw)))) == data
+    assert list(iter_json_array([b"\xef\xbb\xbf [ ]"])) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'{"a": 1}']))
+
+
+def test_items_are_yielded_before_the_whole_file_is_read():
+    read_chunks = []
+
+    def chunks():
+        for chunk in (b'[{"name": "A"},', b' {"name": "B"}', b"]"):
+            read_chunks.append(chunk)
+            yield chunk
+
+    items = iter_json_array(chunks())
+    assert next(items) == {"name": "A"}
+    assert len(read_chunks) == 1
+
+
+def test_conditional_request_skips_unchanged_source(registries, source):
+    assert download_json(f"{source['url']}/agents.json", "foreign_agents.json") == 2
+    assert read(registries, "foreign_agents.json") == AGENTS
+    entry = updater.load_state()["foreign_agents.json"]
+    assert (entry["version"], entry["etag"], entry["last_modified"]) == (1, ETAG, LAST_MODIFIED)
+
+    source["fixtures"]["/agents.json"] = AGENTS[:1]
+    assert download_json(f"{source['url']}/agents.json", "foreign_agents.json") == 2
+    _, headers = source["requests"][-1]
+    assert headers["If-None-Match"] == ETAG
+    assert headers["If-Modified-Since"] == LAST_MODIFIED
+    # 304: файл и версия прежние, хотя у "источника" уже другой список
+    assert read(registries, "foreign_agents.json") == AGENTS
+    assert updater.load_state()["foreign_agents.json"]["version"] == 1
+
+
+def test_source_without_etag_publishes_only_real_changes(registries, source):
+    source["etag"] = None
+    url = f"{source['url']}/agents.json"
+    download_json(url, "foreign_agents.json")
+    download_json(url, "foreign_agents.json")
+    assert updater.load_state()["foreign_agents.json"]["version"] == 1
+
+    source["fixtures"]["/agents.json"] = [AGENTS[0], {"name": "Навальный"}]
+    assert download_json(url, "foreign_agents.json") == 2
+    entry = updater.load_state()["foreign_agents.json"]
+    assert entry["version"] == 2
+    assert entry["diff"]["added_sample"] == ["Навальный"]
+    assert entry["diff"]["removed_sample"] == ["Дождь"]
+
+
+def test_key_filter_keeps_only_descriptions(registries, source):
+    assert download_json(f"{source['url']}/materials.json", "extremist_materials.json", key_filter="text") == 2
+    assert read(registries, "extremist_materials.json") == ["Книга «А»", "Песня «Б»"]
+
+
+def test_failed_download_keeps_the_published_version(registries, source):
+    download_json(f"{source['url']}/agents.json", "foreign_agents.json")
+    assert download_json(f"{source['url']}/missing.json", "foreign_agents.json") == 2
+    assert read(registries, "foreign_agents.json") == AGENTS
+    # Первого файла нет и источник недоступен - пустой массив, чтобы сервер не падал
+    download_json(f"{source['url']}/missing.json", "extremist_materials.json")
+    assert read(registries, "extremist_materials.json") == []
+
+
+def test_publish_is_atomic(registries):
+    publish("foreign_agents.json", AGENTS)
+
+    def broken():
+        yield {"name": "Новый"}
+        raise ConnectionError("connection reset")
+
+    with pytest.raises(ConnectionError):
+        publish("foreign_agents.json", broken())
+    # Недописанная версия не видна читателям и не остается на диске
+    assert read(registries, "foreign_agents.json") == AGENTS
+    assert sorted(p.name for p in registries.iterdir()) == [".state.json", "foreign_agents.json"]
+    assert updater.load_state()["foreign_agents.json"]["version"] == 1
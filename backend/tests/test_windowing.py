@@ -0,0 +1,89 @@
+# backend/tests/test_windowing.py
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import windowing
+from windowing import merge_window_reports, plan_windows
+
+
+def report(*evidence):
+    return {"overall": {"risk_level": "LOW", "confidence": 0.9, "age_rating": "12+", "summary": "ok"},
+            "labels": [], "policy_hits": [], "recommendations": [], "evidence": list(evidence)}
+
+
+def frame(eid, start_ms, end_ms, quote=""):
+    return {"id": eid, "type": "frame_span", "start_ms": start_ms, "end_ms": end_ms, "text_quote": quote}
+
+
+def test_plan_windows_overlap():
+    assert plan_windows(1500 * 1000, window_s=600, overlap_s=30) == [
+        (0, 600000), (570000, 1170000), (1140000, 1500000)]
+
+
+def test_distinct_findings_of_one_window_are_kept():
+    merged = merge_window_reports([(0, report(frame("e1", 10000, 11000), frame("e2", 11500, 12000)))],
+                                  spans=[(0, 600000)])
+    assert [e["id"] for e in merged["evidence"]] == ["w0_e1", "w0_e2"]
+
+
+def test_twin_in_the_overlap_zone_is_merged():
+    spans = [(0, 600000), (570000, 1170000)]
+    merged = merge_window_reports([
+        (0, report(frame("e1", 580000, 585000, "бутылка пива"))),
+        (570000, report(frame("e1", 10500, 16000, "бутылка пива в кадре"))),
+    ], spans=spans)
+    assert len(merged["evidence"]) == 1
+    twin = merged["evidence"][0]
+    assert (twin["start_ms"], twin["end_ms"]) == (580000, 586000)
+    assert twin["text_quote"] == "бутылка пива в кадре"
+
+
+def test_similar_findings_outside_the_overlap_are_kept():
+    spans = [(0, 600000), (570000, 1170000)]
+    merged = merge_window_reports([
+        (0, report(frame("e1", 100000, 101000))),
+        (570000, report(frame("e1", 200000, 201000))),
+    ], spans=spans)
+    assert len(merged["evidence"]) == 2
+
+
+def test_one_twin_absorbs_at_most_one_finding_per_window():
+    spans = [(0, 600000), (570000, 1170000)]
+    merged = merge_window_reports([
+        (0, report(frame("e1", 580000, 582000))),
+        (570000, report(frame("a", 10000, 12000), frame("b", 11000, 13000))),
+    ], spans=spans)
+    assert len(merged["evidence"]) == 2
+
+
+def test_without_spans_nothing_is_merged():
+    merged = merge_window_reports([(0, report(frame("e1", 0, 1000))), (0, report(frame("e1", 0, 1000)))])
+    assert len(merged["evidence"]) == 2
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="нужен ffmpeg")
+def test_windows_are_cut_outside_the_proxy_dir(tmp_path, monkeypatch):
+    cache_dir, work_dir = tmp_path / "cache", tmp_path / "uploads"
+    cache_dir.mkdir()
+    work_dir.mkdir()
+    proxy = cache_dir / "proxy.m4a"
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "sine=duration=5",
+                    "-c:a", "aac", str(proxy)], check=True)
+    seen = []
+
+    def upload(path, mime):
+        seen.append(path)
+        assert os.path.dirname(os.path.dirname(path)) == str(work_dir)
+        return type("File", (), {"delete": lambda self: None})()
+
+    monkeypatch.setattr(windowing, "WINDOW_S", 2)
+    monkeypatch.setattr(windowing, "OVERLAP_S", 1)
+    merged, status = windowing.analyze_windows(
+        str(proxy), "audio/mp4", 5000, lambda f, s, e: [f], upload, lambda c: report(), work_dir=str(work_dir))
+    assert len(seen) == len(status) > 1
+    assert all(w["state"] == "DONE" for w in status)
+    assert os.listdir(cache_dir) == ["proxy.m4a"]
+    assert os.listdir(work_dir) == []
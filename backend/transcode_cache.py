@@ -0,0 +1,116 @@
+# backend/transcode_cache.py
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+
+from redis_helper import incr_metric
+
+# Кэш сжатых прокси живет рядом с загрузками (тот же volume у backend и worker)
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
+CACHE_DIR = os.path.join(UPLOAD_DIR, ".transcode_cache")
+# Бюджет на диске; 0 - кэш выключен
+MAX_BYTES = int(float(os.getenv("TRANSCODE_CACHE_MAX_GB", "20")) * 1024 ** 3)
+
+
+def enabled() -> bool:
+    return MAX_BYTES > 0
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 файла потоково, кусками по 4 МБ (мастера бывают по 10+ ГБ)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(content_hash: str, params: list) -> str:
+    """Ключ = хеш содержимого исходника + набор параметров ffmpeg."""
+    raw = json.dumps({"src": content_hash, "params": params}, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def is_cached_path(path: str) -> bool:
+    """Файлы из кэша нельзя удалять в finally задачи."""
+    return bool(path) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(CACHE_DIR)
+
+
+def lookup(key: str, ext: str):
+    """Возвращает путь к готовому прокси или None. Попадание обновляет mtime (LRU)."""
+    path = os.path.join(CACHE_DIR, f"{key}{ext}")
+    if os.path.exists(path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        incr_metric("transcode_cache", "hit")
+        print(f"♻️ Прокси найден в кэше: {path}")
+        return path
+
+    incr_metric("transcode_cache", "miss")
+    return None
+
+
+def store(key: str, src_path: str) -> str:
+    """
+    Переносит готовый прокси в кэш атомарно: сначала во временное имя внутри
+    CACHE_DIR, затем os.replace. Читатели никогда не увидят недописанный файл.
+    Возвращает новый путь (или исходный, если положить в кэш не удалось).
+    """
+    ext = os.path.splitext(src_path)[1]
+    final_path = os.path.join(CACHE_DIR, f"{key}{ext}")
+    tmp_path = os.path.join(CACHE_DIR, f".tmp-{uuid.uuid4().hex}{ext}")
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        shutil.move(src_path, tmp_path)
+        os.replace(tmp_path, final_path)
+        incr_metric("transcode_cache", "stored")
+    except Exception as e:
+        print(f"⚠️ Transcode Cache Error: {e}")
+        if os.path.exists(tmp_path):
+            shutil.move(tmp_path, src_path)
+        return src_path
+
+    evict()
+    return final_path
+
+
+def evict(max_bytes: int = None):
+    """Удаляет самые давно использованные прокси, пока кэш не влезет в бюджет."""
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    now = time.time()
+    try:
+        for name in os.listdir(CACHE_DIR):
+            path = os.path.join(CACHE_DIR, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.startswith(".tmp-"):
+                # Недописанные файлы упавших воркеров
+                if now - st.st_mtime > 3600:
+                    os.remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    except FileNotFoundError:
+        return
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            incr_metric("transcode_cache", "evicted")
+        except FileNotFoundError:
+            # Параллельный воркер уже удалил
+            total -= size
+
@@ -1,54 +1,266 @@
 import requests
 import json
 import os
+import time
+import codecs
+import hashlib
+from datetime import datetime
 
-REGISTRIES_FOLDER = "registries"
+REGISTRIES_FOLDER = os.getenv("REGISTRIES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "registries"))
 os.makedirs(REGISTRIES_FOLDER, exist_ok=True)
 
 # Ссылки на зеркала открытых данных (Open Data)
-URL_FOREIGN_AGENTS = "https://raw.githubusercontent.com/official-open-data/foreign-agents/main/json/agents.json"
+URL_FOREIGN_AGENTS = os.getenv(
+    "URL_FOREIGN_AGENTS", "https://raw.githubusercontent.com/official-open-data/foreign-agents/main/json/agents.json"
+)
 # Зеркало Федерального списка экстремистских материалов (обновляется сообществом)
-URL_EXTREMIST_MATERIALS = "https://raw.githubusercontent.com/official-open-data/extremist-materials/main/json/materials.json"
+URL_EXTREMIST_MATERIALS = os.getenv(
+    "URL_EXTREMIST_MATERIALS",
+    "https://raw.githubusercontent.com/official-open-data/extremist-materials/main/json/materials.json"
+)
 
+# Состояние обновлений: ETag / Last-Modified / версия / последний дифф по каждому файлу
+STATE_FILE = os.path.join(REGISTRIES_FOLDER, ".state.json")
+# Расписание (0 - не запускать автоматически) и защита от параллельного запуска
+UPDATE_INTERVAL_H = float(os.getenv("REGISTRY_UPDATE_HOURS", "24"))
+UPDATE_LOCK_TTL_S = 1800
+READ_CHUNK = 64 * 1024
+DIFF_SAMPLE = 20
+
+
+# --- ПОТОКОВЫЙ РАЗБОР JSON-МАССИВА ---
+
+def iter_json_array(chunks):
+    """
+    Элементы JSON-массива верхнего уровня по мере поступления байт:
+    файл на сотни мегабайт не материализуется целиком, в памяти - только текущий элемент.
+    chunks - итератор bytes (response.iter_content или чтение файла кусками).
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    started = False
+    eof = False
+    chunks = iter(chunks)
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+    while True:
+        # Пропускаем пробелы, запятые и открывающую скобку
+        while pos < len(buf):
+            ch = buf[pos]
+            if ch in " \t\r\n,\ufeff":
+                pos += 1
+            elif ch == "[" and not started:
+                started = True
+                pos += 1
+            else:
+                break
+        if pos >= len(buf):
+            if eof:
+                return
+            more()
+            continue
+        if not started:
+            raise ValueError("Top-level JSON array expected")
+        if buf[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more()
+            continue
+        # Число на границе куска могло обрезаться ("12" из "123", "-0" из "-0.5") - дочитываем
+        if not eof and isinstance(item, (int, float)) and not isinstance(item, bool) \
+                and (end == len(buf) or buf[end] in "0123456789.eE+-"):
+            more()
+            continue
+        pos = end
+        yield item
+
+
+def _iter_file_chunks(path: str):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+# --- СОСТОЯНИЕ И ПУБЛИКАЦИЯ ---
+
+def load_state() -> dict:
+    if not os.path.exists(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Registry State Error: {e}")
+        return {}
+
+
+def _atomic_write_json(path: str, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_state(state: dict):
+    _atomic_write_json(STATE_FILE, state)
+
+
+def _identity(item) -> str:
+    """Ключ записи для диффа: имя/текст, иначе весь объект."""
+    if isinstance(item, dict):
+        key = item.get("name") or item.get("text") or item.get("official_name")
+        if key:
+            return str(key)
+    if isinstance(item, str):
+        return item
+    return json.dumps(item, ensure_ascii=False, sort_keys=True)
+
+
+def _digest(item) -> str:
+    return hashlib.sha1(json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _snapshot_index(path: str) -> dict:
+    """identity -> хеш содержимого для опубликованной версии (читается потоково)."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        return {_identity(item): _digest(item) for item in iter_json_array(_iter_file_chunks(path))}
+    except Exception as e:
+        print(f"⚠️ Registry Snapshot Error ({os.path.basename(path)}): {e}")
+        return {}
+
+
+def publish(filename: str, items, meta: dict = None) -> dict:
+    """
+    Пишет записи во временный файл (по одной на строку, без indent), считает дифф
+    с прошлой версией и атомарно подменяет файл через os.replace: читатель видит
+    либо старую версию целиком, либо новую. Возвращает запись состояния.
+    Пустой дифф (источник без ETag отдал то же самое) - файл и версия не меняются,
+    обновляются только meta (ETag, хеш содержимого).
+    """
+    path = os.path.join(REGISTRIES_FOLDER, filename)
+    previous = _snapshot_index(path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+
+    count, added, changed = 0, [], 0
+    seen = set()
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("[\n")
+            for item in items:
+                f.write((",\n" if count else "") + json.dumps(item, ensure_ascii=False))
+                count += 1
+                key = _identity(item)
+                seen.add(key)
+                if key not in previous:
+                    added.append(key)
+                elif previous[key] != _digest(item):
+                    changed += 1
+            f.write("\n]\n")
+            f.flush()
+            os.fsync(f.fileno())
+        removed = [key for key in previous if key not in seen]
+        unchanged = os.path.exists(path) and not (added or removed or changed)
+        if not unchanged:
+            os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    state = load_state()
+    entry = state.get(filename, {})
+    entry.update(meta or {})
+    if unchanged:
+        state[filename] = entry
+        save_state(state)
+        print(f"⏭️ {filename}: содержимое не изменилось, остается v{entry.get('version', 0)}")
+        return entry
+    entry.update({
+        "version": entry.get("version", 0) + 1,
+        "count": count,
+        "updated_at": datetime.utcnow().isoformat(),
+        "diff": {
+            "added": len(added), "removed": len(removed), "changed": changed,
+            "added_sample": added[:DIFF_SAMPLE], "removed_sample": removed[:DIFF_SAMPLE],
+        },
+    })
+    state[filename] = entry
+    save_state(state)
+    print(f"✅ {filename}: v{entry['version']}, записей {count} (+{len(added)} / -{len(removed)} / ~{changed})")
+    return entry
+
+
+# --- ИСТОЧНИКИ ---
 
 def download_json(url, filename, key_filter=None):
     """
     Скачивает JSON. Если указан key_filter, сохраняет только это поле,
     чтобы уменьшить размер файла (актуально для списка материалов).
+    Условный запрос (ETag / If-Modified-Since): неизменившийся источник не скачивается.
+    Ответ разбирается потоково и публикуется атомарно (см. publish).
+    Возвращает число записей в актуальной версии.
     """
     print(f"⬇️ Скачивание {filename}...")
+    state = load_state().get(filename, {})
+    path = os.path.join(REGISTRIES_FOLDER, filename)
+    headers = {}
+    if os.path.exists(path):
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
     try:
-        response = requests.get(url, timeout=30)  # Таймаут побольше, файлы большие
-        response.raise_for_status()
-
-        raw_data = response.json()
-
-        final_data = []
-        if key_filter:
-            # Оптимизация: берем только текст описания
-            print(f"⚙️ Оптимизация {filename}...")
-            for item in raw_data:
-                # В разных версиях JSON поле может называться 'name' или 'text'
-                val = item.get(key_filter) or item.get("name") or item.get("text")
-                if val:
-                    final_data.append(val)
-        else:
-            final_data = raw_data
+        with requests.get(url, headers=headers, stream=True, timeout=30) as response:  # Таймаут побольше, файлы большие
+            if response.status_code == 304:
+                print(f"⏭️ {filename} не изменился (304)")
+                return state.get("count", 0)
+            response.raise_for_status()
 
-        save_path = os.path.join(REGISTRIES_FOLDER, filename)
-        with open(save_path, "w", encoding="utf-8") as f:
-            json.dump(final_data, f, ensure_ascii=False, indent=2)
+            def items():
+                for item in iter_json_array(response.iter_content(READ_CHUNK)):
+                    if key_filter:
+                        # В разных версиях JSON поле может называться 'name' или 'text'
+                        if isinstance(item, dict):
+                            item = item.get(key_filter) or item.get("name") or item.get("text")
+                        if not item:
+                            continue
+                    yield item
 
-        print(f"✅ Успешно! Записей: {len(final_data)}")
-        return len(final_data)
+            entry = publish(filename, items(), {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "source": url,
+            })
+            return entry["count"]
 
     except Exception as e:
         print(f"❌ Ошибка скачивания {filename}: {e}")
         # Если не скачалось, создаем пустой файл, чтобы сервер не падал
-        if not os.path.exists(os.path.join(REGISTRIES_FOLDER, filename)):
-            with open(os.path.join(REGISTRIES_FOLDER, filename), "w") as f:
-                json.dump([], f)
-        return 0
+        if not os.path.exists(path):
+            _atomic_write_json(path, [])
+        return state.get("count", 0)
 
 
 def update_foreign_agents():
@@ -92,25 +304,86 @@ def update_rosfin_terrorists():
         {"name": "Свидетели Иеговы", "status": "Экстремистская"},
     ]
 
-    save_path = os.path.join(REGISTRIES_FOLDER, filename)
-    with open(save_path, "w", encoding="utf-8") as f:
-        json.dump(base_data, f, ensure_ascii=False, indent=2)
+    # Тот же перечень - новую версию не публикуем
+    digest = hashlib.sha1(json.dumps(base_data, ensure_ascii=False).encode("utf-8")).hexdigest()
+    state = load_state().get(filename, {})
+    if state.get("content_sha1") == digest and os.path.exists(os.path.join(REGISTRIES_FOLDER, filename)):
+        print(f"⏭️ {filename} не изменился")
+        return state.get("count", len(base_data))
 
-    print(f"✅ Базовый список террористов обновлен.")
+    publish(filename, base_data, {"content_sha1": digest, "source": "seed"})
     return len(base_data)
 
 
+def _versions() -> dict:
+    return {name: entry.get("version") for name, entry in load_state().items() if isinstance(entry, dict)}
+
+
 def run_global_update():
+    before = _versions()
     c1 = update_foreign_agents()
     c2 = update_rosfin_terrorists()
     c3 = update_extremist_materials()
+    changed = sorted(name for name, version in _versions().items() if version != before.get(name))
+    if changed:
+        # Пересобираем бинарный индекс до bump: по нему воркеры соберут новый лексикон
+        # (импорт здесь: registry_index сам зависит от updater)
+        try:
+            from registry_index import compile_index
+            compile_index()
+        except Exception as e:
+            print(f"⚠️ Registry Index Error: {e}")
+        # Воркеры и API подхватят новые реестры без рестарта (см. reloader)
+        from reloader import bump
+        bump(f"registries: {', '.join(changed)}")
     return {
         "status": "success",
         "updated_agents": c1,
         "updated_terrorists": c2,
         "updated_materials": c3,
+        "changed": changed,
     }
 
 
+# --- РАСПИСАНИЕ ---
+
+def locked_update():
+    """Запуск по расписанию: при нескольких процессах backend обновляет только один."""
+    from redis_helper import get_redis
+    owner = f"{os.getpid()}:{time.time()}"
+    try:
+        r = get_redis()
+        if not r.set("lock:registry_update", owner, nx=True, ex=UPDATE_LOCK_TTL_S):
+            print("⏭️ Обновление реестров уже идет в другом процессе")
+            return None
+    except Exception as e:
+        # Без Redis обновляемся без блокировки
+        print(f"⚠️ Registry Lock Error: {e}")
+        r = None
+    try:
+        return run_global_update()
+    finally:
+        if r is not None:
+            try:
+                if r.get("lock:registry_update") == owner:
+                    r.delete("lock:registry_update")
+            except Exception:
+                pass
+
+
+def start_scheduler():
+    """Фоновый планировщик APScheduler (вызывается при старте backend). None - если выключен."""
+    if UPDATE_INTERVAL_H <= 0:
+        return None
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler(daemon=True)
+    # Первый запуск - сразу после старта, дальше по интервалу
+    scheduler.add_job(locked_update, "interval", hours=UPDATE_INTERVAL_H, id="registry_update",
+                      next_run_time=datetime.now(), max_instances=1, coalesce=True)
+    scheduler.start()
+    print(f"🗓️ Обновление реестров каждые {UPDATE_INTERVAL_H} ч")
+    return scheduler
+
+
 if __name__ == "__main__":
     run_global_update()
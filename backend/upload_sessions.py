@@ -0,0 +1,209 @@
+# backend/upload_sessions.py
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+
+from starlette.concurrency import run_in_threadpool
+
+# Загрузка большими файлами по кускам: create -> PUT диапазонов -> finalize.
+# Состояние сессии хранится на диске (общий volume), поэтому клиент может
+# переподключиться к любому процессу API и продолжить с последнего смещения.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads")
+SESSIONS_DIR = os.path.join(UPLOAD_DIR, ".sessions")
+CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_MB", "8")) * 1024 * 1024
+SESSION_TTL_S = int(os.getenv("UPLOAD_SESSION_TTL_H", "24")) * 3600
+# Пишем на диск блоками, а не каждым сетевым пакетом
+WRITE_BUFFER = 1024 * 1024
+
+# Инкрементальные хешеры живут в памяти процесса: {upload_id: (offset, sha256)}.
+# Если процесс перезапустился - хеш досчитывается по уже записанной части.
+_hashers = {}
+# Два параллельных PUT в одну сессию внутри процесса выполняются по очереди
+_locks = {}
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str, offset: int = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.offset = offset
+
+
+def _meta_path(upload_id: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"{upload_id}.json")
+
+
+def _part_path(upload_id: str) -> str:
+    return os.path.join(SESSIONS_DIR, f"{upload_id}.part")
+
+
+def _save_meta(meta: dict):
+    # Атомарно: читатель видит либо старое, либо новое смещение
+    tmp = _meta_path(meta["upload_id"]) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, _meta_path(meta["upload_id"]))
+
+
+def load_session(upload_id: str) -> dict:
+    try:
+        uuid.UUID(upload_id)  # защита от ../ в пути
+        with open(_meta_path(upload_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        raise UploadError(404, "Upload session not found")
+
+
+def create_session(filename: str, size: int) -> dict:
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    _sweep_expired()
+
+    upload_id = str(uuid.uuid4())
+    meta = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "size": size,
+        "offset": 0,
+        "created_at": time.time(),
+    }
+    open(_part_path(upload_id), "wb").close()
+    _save_meta(meta)
+    _hashers[upload_id] = (0, hashlib.sha256())
+    return meta
+
+
+def parse_content_range(header: str):
+    """'bytes 0-8388607/10737418240' -> (start, end_inclusive, total)"""
+    try:
+        unit, rng = header.strip().split(" ", 1)
+        span, total = rng.split("/")
+        start, end = span.split("-")
+        if unit != "bytes":
+            raise ValueError
+        return int(start), int(end), int(total)
+    except ValueError:
+        raise UploadError(400, f"Bad Content-Range: {header}")
+
+
+def _hash_prefix(path: str, length: int):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(4 * 1024 * 1024, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h
+
+
+async def _get_hasher(meta: dict):
+    upload_id, offset = meta["upload_id"], meta["offset"]
+    state = _hashers.get(upload_id)
+    if state and state[0] == offset:
+        return state[1]
+    # Другой процесс API или рестарт: досчитываем хеш по записанной части
+    h = await run_in_threadpool(_hash_prefix, _part_path(upload_id), offset)
+    _hashers[upload_id] = (offset, h)
+    return h
+
+
+def _write_block(f, data: bytes):
+    f.write(data)
+
+
+def _commit(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+async def write_range(upload_id: str, start: int, total: int, body_stream) -> dict:
+    """
+    Дописывает кусок, начиная со start. Начало обязано совпадать с уже
+    подтвержденным смещением - иначе 409 и клиент продолжает с meta['offset'].
+    Байты пишутся в пуле потоков, хеш считается по ходу, в памяти - не больше буфера.
+    """
+    lock = _locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        return await _write_range_locked(upload_id, start, total, body_stream)
+
+
+async def _write_range_locked(upload_id: str, start: int, total: int, body_stream) -> dict:
+    meta = load_session(upload_id)
+    if total != meta["size"]:
+        raise UploadError(400, "Total size does not match the session")
+    if start != meta["offset"]:
+        raise UploadError(409, "Offset mismatch", offset=meta["offset"])
+
+    hasher = await _get_hasher(meta)
+    part = _part_path(upload_id)
+    written = 0
+
+    f = await run_in_threadpool(open, part, "r+b")
+    try:
+        # Хвост от оборванного куска (не подтвержденный в meta) отбрасываем
+        await run_in_threadpool(f.truncate, start)
+        f.seek(start)
+        buffer = bytearray()
+        async for chunk in body_stream:
+            buffer.extend(chunk)
+            if start + written + len(buffer) > meta["size"]:
+                raise UploadError(400, "Chunk exceeds declared size")
+            if len(buffer) >= WRITE_BUFFER:
+                data = bytes(buffer)
+                buffer.clear()
+                await run_in_threadpool(_write_block, f, data)
+                hasher.update(data)
+                written += len(data)
+        if buffer:
+            data = bytes(buffer)
+            await run_in_threadpool(_write_block, f, data)
+            hasher.update(data)
+            written += len(data)
+        await run_in_threadpool(_commit, f)
+    except BaseException:
+        # Обрыв соединения: смещение в meta не двигаем, хешер сбрасываем
+        _hashers.pop(upload_id, None)
+        raise
+    finally:
+        await run_in_threadpool(f.close)
+
+    meta["offset"] = start + written
+    _save_meta(meta)
+    _hashers[upload_id] = (meta["offset"], hasher)
+    return meta
+
+
+async def finalize(upload_id: str) -> tuple[str, str, dict]:
+    """Проверяет полноту файла и переносит его к остальным загрузкам. -> (путь, sha256, meta)"""
+    meta = load_session(upload_id)
+    if meta["offset"] != meta["size"]:
+        raise UploadError(409, "Upload is incomplete", offset=meta["offset"])
+
+    hasher = await _get_hasher(meta)
+    content_hash = hasher.hexdigest()
+
+    ext = os.path.splitext(meta["filename"])[1].lower()
+    final_path = os.path.join(UPLOAD_DIR, f"{upload_id}{ext}")
+    os.replace(_part_path(upload_id), final_path)
+    os.remove(_meta_path(upload_id))
+    _hashers.pop(upload_id, None)
+    _locks.pop(upload_id, None)
+    return final_path, content_hash, meta
+
+
+def _sweep_expired():
+    """Брошенные сессии (клиент так и не вернулся) старше TTL."""
+    now = time.time()
+    for name in os.listdir(SESSIONS_DIR):
+        path = os.path.join(SESSIONS_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > SESSION_TTL_S:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
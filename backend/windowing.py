@@ -0,0 +1,337 @@
+# backend/windowing.py
+import os
+import re
+import shutil
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pydantic import ValidationError
+from schemas import ComplianceReport
+
+# Оконный режим для длинных материалов: прокси режется на перекрывающиеся окна,
+# каждое окно загружается и анализируется отдельно (параллельно, с лимитом),
+# а доказательства переносятся на общую шкалу времени и склеиваются.
+WINDOW_S = int(os.getenv("ANALYSIS_WINDOW_S", "600"))
+OVERLAP_S = int(os.getenv("ANALYSIS_OVERLAP_S", "30"))
+WINDOW_CONCURRENCY = int(os.getenv("ANALYSIS_WINDOW_CONCURRENCY", "4"))
+WINDOW_RETRIES = int(os.getenv("ANALYSIS_WINDOW_RETRIES", "2"))
+
+RISK_ORDER = ["SAFE", "LOW", "MEDIUM", "HIGH", "CRITICAL"]
+PRIORITY_ORDER = ["P0", "P1", "P2"]
+AGE_ORDER = ["0+", "6+", "12+", "16+", "18+"]
+
+
+def plan_windows(duration_ms: int, window_s: int = None, overlap_s: int = None):
+    """[(start_ms, end_ms)] с перекрытием, чтобы сцена на стыке попала целиком хотя бы в одно окно."""
+    window_ms = (window_s or WINDOW_S) * 1000
+    step_ms = window_ms - (overlap_s if overlap_s is not None else OVERLAP_S) * 1000
+    if duration_ms <= window_ms:
+        return [(0, duration_ms)]
+
+    windows = []
+    start = 0
+    while start < duration_ms:
+        end = min(start + window_ms, duration_ms)
+        windows.append((start, end))
+        if end >= duration_ms:
+            break
+        start += step_ms
+    return windows
+
+
+def cut_window(proxy_path: str, start_ms: int, end_ms: int, index: int, out_dir: str) -> str:
+    """
+    Вырезает окно из прокси в out_dir. Видео перекодируется (точный старт, а не ближайший
+    ключевой кадр - иначе таймкоды поедут), аудио копируется без перекодирования.
+    Прокси может лежать в общем кэше (transcode_cache), поэтому окна - не рядом с ним,
+    а в своем каталоге задачи.
+    """
+    ext = os.path.splitext(proxy_path)[1]
+    out = os.path.join(out_dir, f"w{index:03d}{ext}")
+    if ext == ".mp4":
+        codec = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-pix_fmt", "yuv420p",
+                 "-c:a", "aac", "-ac", "1", "-ar", "16000"]
+    else:
+        codec = ["-c", "copy"]
+    command = [
+        "ffmpeg", "-y", "-ss", f"{start_ms / 1000:.3f}", "-i", proxy_path,
+        "-t", f"{(end_ms - start_ms) / 1000:.3f}", *codec, out
+    ]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return out
+
+
+def _ms_to_tc(ms: int) -> str:
+    s = ms // 1000
+    return f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}"
+
+
+def window_instruction(start_ms: int, end_ms: int) -> str:
+    return (f"ЭТО ФРАГМЕНТ ПОЛНОГО МАТЕРИАЛА: {_ms_to_tc(start_ms)} - {_ms_to_tc(end_ms)}. "
+            f"Таймкоды start_ms/end_ms в evidence указывай ОТ НАЧАЛА ФРАГМЕНТА.")
+
+
+def analyze_windows(proxy_path: str, mime_type: str, duration_ms: int, build_content,
+                    upload_fn, generate_fn, on_progress=None, upload_many_fn=None, work_dir: str = None):
+    """
+    Запускает анализ всех окон. build_content(media_file, start_ms, end_ms) -> content,
+    upload_fn(path, mime) -> file|None, generate_fn(content) -> dict|None.
+    upload_many_fn([(path, mime)], on_progress(i, sent, total)) -> (i, file|None, error) по мере
+    готовности: если задан, все окна нарезаются и грузятся сразу, а генерация окна стартует,
+    как только его файл стал ACTIVE.
+    Упавшее окно повторяется само по себе (до WINDOW_RETRIES раз), остальные не ждут.
+    Окна режутся во временный каталог внутри work_dir (по умолчанию системный tmp),
+    он удаляется в конце. Возвращает (склеенный отчет, список статусов окон).
+    """
+    windows = plan_windows(duration_ms)
+    cut_dir = tempfile.mkdtemp(prefix="windows_", dir=work_dir)
+    try:
+        return _analyze_windows(proxy_path, mime_type, windows, build_content, upload_fn, generate_fn,
+                                on_progress, upload_many_fn, cut_dir)
+    finally:
+        shutil.rmtree(cut_dir, ignore_errors=True)
+
+
+def _analyze_windows(proxy_path, mime_type, windows, build_content, upload_fn, generate_fn,
+                     on_progress, upload_many_fn, cut_dir):
+    status = [{"index": i, "start_ms": s, "end_ms": e, "state": "PENDING", "attempts": 0}
+              for i, (s, e) in enumerate(windows)]
+    lock = threading.Lock()
+
+    def progress():
+        if on_progress:
+            with lock:
+                done = sum(1 for w in status if w["state"] == "DONE")
+                snapshot = [dict(w) for w in status]
+            on_progress(done, len(windows), snapshot)
+
+    def run_window(i, uploaded=None):
+        # uploaded - (path, file) первой попытки, если окно уже загружено заранее
+        start_ms, end_ms = windows[i]
+        last_error = None
+        for attempt in range(WINDOW_RETRIES + 1):
+            status[i]["attempts"] = attempt + 1
+            status[i]["state"] = "RUNNING"
+            progress()
+            path, media_f = uploaded if attempt == 0 and uploaded else (None, None)
+            try:
+                if media_f is None:
+                    if path is None:
+                        path = cut_window(proxy_path, start_ms, end_ms, i, cut_dir) if len(windows) > 1 else proxy_path
+                    media_f = upload_fn(path, mime_type)
+                if not media_f:
+                    raise RuntimeError("upload failed")
+                report = generate_fn(build_content(media_f, start_ms, end_ms))
+                if report is None:
+                    raise RuntimeError("empty response")
+                status[i]["state"] = "DONE"
+                progress()
+                return i, report
+            except Exception as e:
+                last_error = e
+                print(f"⚠️ Окно {i} ({_ms_to_tc(start_ms)}-{_ms_to_tc(end_ms)}), попытка {attempt + 1}: {e}")
+            finally:
+                if media_f is not None:
+                    try: media_f.delete()
+                    except Exception: pass
+                if path and path != proxy_path and os.path.exists(path):
+                    os.remove(path)
+        status[i]["state"] = "FAILED"
+        status[i]["error"] = str(last_error)
+        progress()
+        return i, None
+
+    reports = [None] * len(windows)
+    with ThreadPoolExecutor(max_workers=WINDOW_CONCURRENCY) as pool:
+        if upload_many_fn and len(windows) > 1:
+            futures = [pool.submit(run_window, i, uploaded)
+                       for i, uploaded in _upload_windows(proxy_path, mime_type, windows, status, upload_many_fn,
+                                                          progress, pool, cut_dir)]
+        else:
+            futures = [pool.submit(run_window, i) for i in range(len(windows))]
+        for future in as_completed(futures):
+            i, report = future.result()
+            reports[i] = report
+
+    done = [i for i, r in enumerate(reports) if r is not None]
+    merged = merge_window_reports([(windows[i][0], reports[i]) for i in done], spans=[windows[i] for i in done])
+    return merged, status
+
+
+def _upload_windows(proxy_path, mime_type, windows, status, upload_many_fn, progress, pool, cut_dir):
+    """
+    Режет все окна (в пуле) и грузит их одной пачкой. Генератор (i, (path, file)) в порядке
+    готовности файлов; окно, которое не нарезалось или не загрузилось, отдается с file=None -
+    run_window повторит его обычным путем.
+    """
+    def cut(i):
+        try:
+            return cut_window(proxy_path, windows[i][0], windows[i][1], i, cut_dir)
+        except Exception as e:
+            print(f"⚠️ Окно {i}: нарезка не удалась: {e}")
+            return None
+
+    paths = list(pool.map(cut, range(len(windows))))
+    ready = [i for i, path in enumerate(paths) if path]
+    for i in range(len(windows)):
+        if paths[i] is None:
+            yield i, None
+        else:
+            status[i]["state"] = "UPLOADING"
+    progress()
+
+    def upload_progress(k, sent, total):
+        status[ready[k]]["uploaded_pct"] = round(sent * 100 / total) if total else 100
+
+    for k, media_f, error in upload_many_fn([(paths[i], mime_type) for i in ready], upload_progress):
+        i = ready[k]
+        if error:
+            print(f"⚠️ Окно {i}: загрузка не удалась: {error}")
+        yield i, (paths[i], media_f)
+
+
+# --- СКЛЕЙКА ОТЧЕТОВ ОКОН ---
+
+def _norm_quote(s) -> str:
+    return re.sub(r"\W+", " ", (s or "").lower()).strip()
+
+
+def _in_overlap(a: dict, b: dict, span_a, span_b) -> bool:
+    """Оба доказательства попадают в общую зону окон span_a и span_b (с допуском 2 с)."""
+    zone_start, zone_end = max(span_a[0], span_b[0]), min(span_a[1], span_b[1])
+    if zone_start >= zone_end:
+        return False
+    return all(e["start_ms"] <= zone_end + 2000 and max(e["end_ms"], e["start_ms"]) >= zone_start - 2000
+               for e in (a, b))
+
+
+def _same_evidence(a: dict, b: dict) -> bool:
+    """Одно и то же доказательство из двух перекрывающихся окон."""
+    if a.get("type") != b.get("type"):
+        return False
+    a_start, a_end = a.get("start_ms", 0), max(a.get("end_ms", 0), a.get("start_ms", 0))
+    b_start, b_end = b.get("start_ms", 0), max(b.get("end_ms", 0), b.get("start_ms", 0))
+    # Пересечение по времени (с допуском в 2 секунды на неточность модели)
+    if a_start > b_end + 2000 or b_start > a_end + 2000:
+        return False
+    qa, qb = _norm_quote(a.get("text_quote")), _norm_quote(b.get("text_quote"))
+    return not qa or not qb or qa in qb or qb in qa
+
+
+def _max_by(order, a, b):
+    ia = order.index(a) if a in order else -1
+    ib = order.index(b) if b in order else -1
+    return a if ia >= ib else b
+
+
+def merge_window_reports(window_reports, headings=None, spans=None):
+    """
+    window_reports: [(offset_ms, report)]. Таймкоды переносятся на шкалу актива,
+    id доказательств получают префикс окна, дубли из зон перекрытия схлопываются.
+    spans - [(start_ms, end_ms)] окон на шкале актива: дублями считаются только
+    доказательства из разных окон в общей зоне этих окон (без spans - ничего не склеиваем,
+    разные находки одного окна не схлопываются никогда).
+    headings - подписи частей в итоговом резюме (по умолчанию таймкод начала окна).
+    """
+    evidence = []
+    id_map = {}  # "w{i}_{old_id}" -> id итогового доказательства
+    windows_of = {}  # id итогового доказательства -> окна, чьи находки в него вошли
+
+    for wi, (offset, report) in enumerate(window_reports):
+        for ev in report.get("evidence", []):
+            item = dict(ev)
+            local_id = f"w{wi}_{ev.get('id')}"
+            item["id"] = local_id
+            item["start_ms"] = (ev.get("start_ms") or 0) + offset
+            item["end_ms"] = (ev.get("end_ms") or 0) + offset
+
+            twin = None
+            if spans:
+                twin = next((e for e in evidence
+                             if wi not in windows_of[e["id"]]
+                             and all(_in_overlap(e, item, spans[wj], spans[wi]) for wj in windows_of[e["id"]])
+                             and _same_evidence(e, item)), None)
+            if twin:
+                windows_of[twin["id"]].add(wi)
+                twin["start_ms"] = min(twin["start_ms"], item["start_ms"])
+                twin["end_ms"] = max(twin["end_ms"], item["end_ms"])
+                if len(item.get("text_quote") or "") > len(twin.get("text_quote") or ""):
+                    twin["text_quote"] = item["text_quote"]
+                id_map[local_id] = twin["id"]
+            else:
+                evidence.append(item)
+                id_map[local_id] = local_id
+                windows_of[local_id] = {wi}
+
+    def remap(wi, ids):
+        out = []
+        for eid in ids or []:
+            new_id = id_map.get(f"w{wi}_{eid}")
+            if new_id and new_id not in out:
+                out.append(new_id)
+        return out
+
+    labels, hits, recs = {}, {}, {}
+    for wi, (_, report) in enumerate(window_reports):
+        for lbl in report.get("labels", []):
+            ids = remap(wi, lbl.get("evidence_ids"))
+            cur = labels.get(lbl.get("code"))
+            if cur is None:
+                labels[lbl.get("code")] = {**lbl, "evidence_ids": ids}
+                continue
+            cur["evidence_ids"] += [x for x in ids if x not in cur["evidence_ids"]]
+            cur["severity"] = max(cur.get("severity") or 0, lbl.get("severity") or 0)
+            if (lbl.get("confidence") or 0) > (cur.get("confidence") or 0):
+                cur["confidence"] = lbl.get("confidence")
+                cur["rationale"] = lbl.get("rationale")
+            cur["policy_refs"] = sorted(set(cur.get("policy_refs", [])) | set(lbl.get("policy_refs", [])))
+
+        for hit in report.get("policy_hits", []):
+            ids = remap(wi, hit.get("evidence_ids"))
+            cur = hits.get(hit.get("req_code"))
+            if cur is None:
+                hits[hit.get("req_code")] = {**hit, "evidence_ids": ids}
+                continue
+            cur["evidence_ids"] += [x for x in ids if x not in cur["evidence_ids"]]
+            # P0 важнее P2
+            if hit.get("priority") in PRIORITY_ORDER and (
+                    cur.get("priority") not in PRIORITY_ORDER
+                    or PRIORITY_ORDER.index(hit["priority"]) < PRIORITY_ORDER.index(cur["priority"])):
+                cur["priority"] = hit["priority"]
+
+        for rec in report.get("recommendations", []):
+            ids = remap(wi, rec.get("target_evidence_ids"))
+            key = (rec.get("action"), tuple(sorted(ids)))
+            if key not in recs:
+                recs[key] = {**rec, "target_evidence_ids": ids}
+
+    overall = {"risk_level": "SAFE", "confidence": 1.0, "age_rating": "0+", "summary": ""}
+    summaries = []
+    for wi, (offset, report) in enumerate(window_reports):
+        o = report.get("overall", {})
+        overall["risk_level"] = _max_by(RISK_ORDER, overall["risk_level"], o.get("risk_level"))
+        overall["age_rating"] = _max_by(AGE_ORDER, overall["age_rating"], o.get("age_rating"))
+        overall["confidence"] = min(overall["confidence"], o.get("confidence", 1.0) or 0.0)
+        if o.get("summary"):
+            heading = headings[wi] if headings else _ms_to_tc(offset)
+            summaries.append(f"[{heading}] {o['summary']}")
+    overall["summary"] = "\n".join(summaries)
+    if not window_reports:
+        overall["confidence"] = 0.0
+
+    merged = {
+        "schema_version": "1.1",
+        "overall": overall,
+        "labels": list(labels.values()),
+        "evidence": evidence,
+        "policy_hits": list(hits.values()),
+        "recommendations": list(recs.values()),
+    }
+    try:
+        ComplianceReport.model_validate(merged)
+    except ValidationError as e:
+        # Модель иногда выходит за рамки схемы (например, action=OVERLAY) - не теряем отчет
+        print(f"⚠️ Merged report does not match ComplianceReport: {e.error_count()} issues")
+    return merged
@@ -116,6 +116,48 @@ def generate_premiere_xml(df, filename):
 
     return minidom.parseString(ET.tostring(root)).toprettyxml(indent="   ")
 
+def upload_in_chunks(uploaded_file, status_container, max_retries=5):
+    """
+    Загружает файл кусками (create -> PUT диапазонов -> finalize-ом занимается вызывающий).
+    При обрыве спрашивает у сервера подтвержденное смещение и продолжает с него.
+    Возвращает upload_id.
+    """
+    size = uploaded_file.size
+    res = requests.post(f"{BACKEND_URL}/uploads", json={"filename": uploaded_file.name, "size": size}, timeout=30)
+    res.raise_for_status()
+    session = res.json()
+    upload_id, chunk_size = session["upload_id"], session["chunk_size"]
+
+    offset, retries = 0, 0
+    progress = status_container.progress(0.0, text="📤 Загрузка файла на сервер...")
+    while offset < size:
+        uploaded_file.seek(offset)
+        chunk = uploaded_file.read(chunk_size)
+        end = offset + len(chunk) - 1
+        try:
+            r = requests.put(
+                f"{BACKEND_URL}/uploads/{upload_id}",
+                data=chunk,
+                headers={"Content-Range": f"bytes {offset}-{end}/{size}"},
+                timeout=120
+            )
+            if r.status_code == 409:
+                # Сервер уже принял другой объем - продолжаем с его смещения
+                offset = r.json()["detail"]["offset"]
+                continue
+            r.raise_for_status()
+            offset = r.json()["offset"]
+            retries = 0
+        except requests.RequestException:
+            retries += 1
+            if retries > max_retries:
+                raise
+            time.sleep(2 * retries)
+            offset = requests.get(f"{BACKEND_URL}/uploads/{upload_id}", timeout=30).json()["offset"]
+        progress.progress(offset / size, text=f"📤 Загрузка: {offset / 1024 / 1024:.0f} / {size / 1024 / 1024:.0f} МБ")
+
+    return upload_id
+
 def color_rows(row):
     """Раскраска таблицы"""
     sev = row.get('severity', 0)
@@ -167,6 +209,33 @@ with st.sidebar:
     if st.session_state.valid_key and model_opts:
         selected_model = st.selectbox("Модель:", model_opts, index=default_idx)
     
+    analysis_mode = st.selectbox(
+        "Режим анализа:",
+        ["full", "windowed", "keyframes"],
+        format_func=lambda x: {
+            "full": "🎞 Целиком (один запрос)",
+            "windowed": "🪟 Окнами (длинные фильмы)",
+            "keyframes": "🖼 Кадры сцен + аудио (ток-шоу, новости)",
+        }[x]
+    )
+    use_cache = st.checkbox("Использовать готовый отчет (кэш)", value=True,
+                            help="Если этот же файл уже проверялся той же моделью и профилем, отчет вернется сразу")
+    reuse_duplicates = st.checkbox("Брать отчет перезаливки", value=False,
+                                   help="Если найдена другая версия этой же программы (другой контейнер, битрейт, логотип), вернуть ее отчет")
+    trim_silence = st.checkbox("Вырезать тишину (аудио)", value=False,
+                               help="Для радио и подкастов: паузы не отправляются в модель, таймкоды остаются по исходному файлу")
+    cue_sheet = st.checkbox("Музыка по таймкодам (cue sheet)", value=False,
+                            help="Shazam по окнам: все музыкальные фрагменты с началом и концом, а не один трек на файл")
+
+    if st.session_state.get("running_task"):
+        if st.button("⛔ Отменить анализ"):
+            try:
+                requests.post(f"{BACKEND_URL}/cancel/{st.session_state.running_task}", timeout=10)
+                st.toast("Отмена отправлена")
+            except Exception as e:
+                st.error(f"Не удалось отменить: {e}")
+            st.session_state.running_task = None
+
     st.markdown("---")
     st.caption("🔴 Severity 3: CRITICAL")
     st.caption("🟠 Severity 2: MEDIUM")
@@ -189,23 +258,25 @@ if uploaded_file and st.session_state.valid_key:
         
         try:
             # Подготовка данных
-            ext = uploaded_file.name.split('.')[-1]
-            safe_filename = f"input_file.{ext}"
-            files = {"file": (safe_filename, uploaded_file, uploaded_file.type)}
-            data = {"original_filename": uploaded_file.name, "model_name": selected_model, "profile":profile}
+            data = {"model_name": selected_model, "profile": profile, "use_cache": use_cache,
+                    "reuse_duplicates": reuse_duplicates, "analysis_mode": analysis_mode,
+                    "trim_silence": trim_silence, "cue_sheet": cue_sheet}
             headers = {"X-API-Key": api_key}
             
             status_container.write("📤 Загрузка файла на сервер...")
             
-            # Отправка (таймаут 10 минут)
-            res = requests.post(f"{BACKEND_URL}/analyze", files=files, data=data, headers=headers, timeout=600)
+            # Загрузка кусками с докачкой, затем постановка задачи
+            upload_id = upload_in_chunks(uploaded_file, status_container)
+            res = requests.post(f"{BACKEND_URL}/uploads/{upload_id}/finalize", json=data, headers=headers, timeout=120)
             
             if res.status_code == 200:
                 task_id = res.json()['task_id']
                 status_container.write(f"⚙️ Задача ID: {task_id}. Анализ начат...")
+                st.session_state.running_task = task_id
                 
                 # Цикл опроса (Polling)
                 last_status_msg = ""  # <--- 1. Переменная для запоминания
+                progress_bar = None
                 
                 while True:
                     time.sleep(2)
@@ -215,6 +286,7 @@ if uploaded_file and st.session_state.valid_key:
                         state = s_data.get("state")
                         
                         if state == 'SUCCESS':
+                            st.session_state.running_task = None
                             status_container.update(label="✅ Анализ завершен!", state="complete", expanded=False)
                             
                             st.session_state.analysis_result = s_data.get("result", {})
@@ -225,13 +297,28 @@ if uploaded_file and st.session_state.valid_key:
                             break
                         
                         elif state == 'FAILURE':
+                            st.session_state.running_task = None
                             status_container.update(label="❌ Ошибка", state="error")
                             st.error(f"Ошибка задачи: {s_data.get('error')}")
                             break
+
+                        elif state == 'REVOKED':
+                            st.session_state.running_task = None
+                            status_container.update(label="⛔ Анализ отменен", state="error")
+                            break
                             
-                        elif state == 'PROGRESS':
+                        elif state in ('PROGRESS', 'RETRY'):
+                            # RETRY - пауза по квоте Google: в статусе время, когда задача продолжится
                             msg = s_data.get("status", "Обработка...")
                             
+                            # Живой прогресс сжатия: процент отдельно, чтобы не спамить лог статусов
+                            prog = s_data.get("progress")
+                            if prog and prog.get("percent") is not None:
+                                if progress_bar is None:
+                                    progress_bar = status_container.progress(0.0)
+                                progress_bar.progress(min(prog["percent"] / 100, 1.0), text=msg)
+                                continue
+                            
                             # <--- 2. ПРОВЕРКА: Пишем только если статус изменился
                             if msg != last_status_msg:
                                 status_container.write(f"🔄 {msg}")
@@ -272,6 +359,52 @@ if st.session_state.analysis_result:
         c4.metric("Найдено", len(res.get('labels', [])))
         
         st.info(f"📝 {overall.get('summary', 'Нет резюме')}")
+        if res.get('_cache') == 'near_duplicate':
+            st.caption("👯 Отчет взят у другой версии этой же программы.")
+        elif res.get('_cache'):
+            st.caption("♻️ Отчет взят из кэша: этот файл уже проверялся с теми же настройками.")
+        if res.get('_payload', {}).get('ratio'):
+            p = res['_payload']
+            st.caption(f"🖼 Кадров: {p['frames']}, отправлено {p['total_bytes'] / 1024 / 1024:.1f} МБ "
+                       f"({p['ratio'] * 100:.0f}% от обычного видео-прокси)")
+        if res.get('_document'):
+            d = res['_document']
+            st.caption(f"📄 Документ: {d['pages']} стр., {d['chunks']} частей, {d['seconds']} с"
+                       + (f", не удалось проверить частей: {d['failed_chunks']}" if d['failed_chunks'] else ""))
+        if res.get('_silence_trim'):
+            t = res['_silence_trim']
+            st.caption(f"🔇 Вырезано тишины: {t['removed_pct']}% ({t['removed_ms'] / 1000:.0f} с)")
+        if res.get('_proxy_plan'):
+            pp = res['_proxy_plan']
+            st.caption(f"📐 Прокси: {pp['name']} ({pp['width']}px, {pp['fps']} fps), "
+                       f"оценка {pp['est_bytes'] / 1024 / 1024:.1f} МБ / ~{pp['est_tokens']} токенов, "
+                       f"факт {pp['actual_bytes'] / 1024 / 1024:.1f} МБ")
+        if res.get('_prescreen'):
+            with st.expander(f"📚 Словарный прескрининг ({len(res['_prescreen'])})"):
+                st.dataframe(pd.DataFrame(res['_prescreen'])[['start_ms', 'text_quote', 'notes']], use_container_width=True)
+        if res.get('_cue_sheet'):
+            cs = res['_cue_sheet']
+            with st.expander(f"🎵 Музыка по таймкодам ({len(cs['cues'])} фрагментов)"):
+                if cs.get('breaker_open'):
+                    st.warning(f"Распознавание остановлено после серии ошибок: пропущено окон {cs['skipped']}")
+                if cs['cues']:
+                    st.dataframe(pd.DataFrame(cs['cues']), use_container_width=True)
+                else:
+                    st.caption("Музыка не распознана.")
+        if res.get('_music_catalog'):
+            mc = res['_music_catalog']
+            with st.expander(f"🎼 Музыка из каталога ({len(mc['cues'])} фрагментов)"):
+                if mc['cues']:
+                    st.dataframe(pd.DataFrame(mc['cues']), use_container_width=True)
+                else:
+                    st.caption(f"Совпадений с каталогом ({mc['tracks']} треков) нет.")
+        if res.get('_stages'):
+            sg = res['_stages']
+            with st.expander(f"⏱ Этапы обработки ({sg['wall_ms'] / 1000:.1f} с, работы {sg['busy_ms'] / 1000:.1f} с)"):
+                st.dataframe(pd.DataFrame(sg['stages']), use_container_width=True)
+        if res.get('_near_duplicates'):
+            with st.expander(f"👯 Похожие материалы в архиве ({len(res['_near_duplicates'])})"):
+                st.dataframe(pd.DataFrame(res['_near_duplicates']), use_container_width=True)
 
         retrieved_context = res.get('_retrieved_context', 'Нет данных')
         with st.expander("🔍 AI Context: На чем основано решение (RAG)"):